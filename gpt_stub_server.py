@@ -0,0 +1,394 @@
+# ==========================================
+# 🧪 LOKALER OPENAI-STAND-IN (STUB-SERVER)
+# ==========================================
+# Beantwortet /v1/chat/completions lokal, damit Parallelität, Rate-Limit-Verhalten und Cache
+# ohne API-Guthaben gemessen werden können. main.py wird per Basis-URL umgelenkt:
+#
+#   python gpt_stub_server.py synth --latenz 0.8 --fehlerquote 0.02 --burst-alle 30 --burst-dauer 3
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python main.py
+#
+# Modi:
+#   synth   – erzeugt Antworten selbst (Latenzverteilung, Fehlerquote, 429-Bursts, x-ratelimit-Header)
+#   replay  – spielt aufgezeichnete Antworten ab (Schlüssel = Hash des Request-Bodys)
+#   record  – leitet an die echte API weiter und zeichnet jede Antwort für späteres Replay auf
+#
+# Anfragen mit "stream": true werden in allen Modi als Server-Sent Events beantwortet.
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ==========================================
+# 🔑 ANFRAGE-SCHLÜSSEL & AUFNAHMEN
+# ==========================================
+
+def anfrage_hash(body):
+    # Kanonisches JSON – gleiche Anfrage, gleicher Schlüssel, unabhängig von der Feldreihenfolge des Clients
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def lade_aufnahme(pfad):
+    aufnahmen = {}
+    with open(pfad, encoding="utf-8") as f:
+        for zeile in f:
+            if zeile.strip():
+                eintrag = json.loads(zeile)
+                aufnahmen[eintrag["schluessel"]] = eintrag
+    print(f"📼 {len(aufnahmen)} aufgezeichnete Antworten geladen: {pfad}")
+    return aufnahmen
+
+class Aufnahme:
+    """Hängt Antworten threadsicher an eine JSONL-Datei an."""
+
+    def __init__(self, pfad, mit_anfrage=False):
+        self.pfad = pfad
+        self.mit_anfrage = mit_anfrage
+        self.lock = threading.Lock()
+
+    def schreiben(self, schluessel, body, status, antwort):
+        eintrag = {"schluessel": schluessel, "modell": body.get("model"), "status": status, "antwort": antwort}
+        if self.mit_anfrage:
+            eintrag["anfrage"] = body
+        with self.lock, open(self.pfad, "a", encoding="utf-8") as f:
+            f.write(json.dumps(eintrag, ensure_ascii=False) + "\n")
+
+# ==========================================
+# 🎲 SYNTHETISCHE ANTWORTEN
+# ==========================================
+
+def beispiel_aus_schema(schema, listenlaenge=1, kennung=""):
+    # Minimale, schema-konforme Instanz (Enum → erster Wert, Listen mit `listenlaenge` Elementen).
+    # `kennung` hängt an jeden Text, damit verschiedene Dokumente verschiedene Kopfdaten bekommen.
+    typ = schema.get("type")
+    typ = next((t for t in typ if t != "null"), "null") if isinstance(typ, list) else typ
+    if "enum" in schema:
+        return schema["enum"][0]
+    if typ == "object":
+        return {name: beispiel_aus_schema(teil, listenlaenge, kennung) for name, teil in schema.get("properties", {}).items()}
+    if typ == "array":
+        return [beispiel_aus_schema(schema.get("items", {}), listenlaenge, kennung) for _ in range(listenlaenge)]
+    if typ in ("number", "integer"):
+        return 1
+    if typ == "string":
+        return f"Stub{kennung}"
+    if typ == "boolean":
+        return True
+    return None
+
+def nachrichtentext(body):
+    teile = []
+    for nachricht in body.get("messages", []):
+        inhalt = nachricht.get("content")
+        if isinstance(inhalt, str):
+            teile.append(inhalt)
+        elif isinstance(inhalt, list):
+            teile += [teil.get("text", "") for teil in inhalt if teil.get("type") == "text"]
+    return "\n".join(teile)
+
+def prompt_tokens(body):
+    # Wie die API: Text ~4 Zeichen pro Token, Bilder pauschal (high detail) statt Base64-Länge
+    bilder = sum(
+        1 for nachricht in body.get("messages", []) if isinstance(nachricht.get("content"), list)
+        for teil in nachricht["content"] if teil.get("type") == "image_url"
+    )
+    return len(nachrichtentext(body)) // 4 + bilder * 1105
+
+def synthetischer_inhalt(body, positionen=1):
+    # Genug Struktur, damit die Pipeline aus main.py jede Stufe durchläuft
+    format_ = body.get("response_format") or {}
+    if format_.get("type") == "json_schema":
+        kennung = hashlib.sha256(json.dumps(body.get("messages"), sort_keys=True).encode()).hexdigest()[:6]
+        return json.dumps(beispiel_aus_schema(format_["json_schema"]["schema"], positionen, f"-{kennung}"),
+                          ensure_ascii=False)
+    if format_.get("type") == "json_object":
+        return json.dumps({"dokumenttyp": "rechnung", "kopfdaten": {}, "positionen": []})
+    text = nachrichtentext(body)
+    if "Artikelbezeichnung;Hauptkategorie;Unterkategorie" in text:
+        artikel = text.split("\n\n", 1)[-1].splitlines()
+        return "\n".join(["Artikelbezeichnung;Kategorie;Unterkategorie"] + [f"{a};Stub;Stub" for a in artikel if a])
+    if "fehlerhafte Zahl" in text:
+        return "0.0"
+    return "rechnung"
+
+def ablehnung(body):
+    return {
+        "id": f"chatcmpl-stub-{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": None,
+                                 "refusal": "I'm sorry, I can't help with that request."}}],
+        "usage": {"prompt_tokens": prompt_tokens(body), "completion_tokens": 12,
+                  "total_tokens": prompt_tokens(body) + 12},
+    }
+
+def stream_stuecke(daten, stueck_zeichen=16):
+    # Fertige Completion → Chunk-Objekte wie bei "stream": true (Inhalt bzw. Ablehnung in Stücken)
+    nachricht = daten["choices"][0]["message"]
+    kopf = {"id": daten["id"], "object": "chat.completion.chunk", "created": daten["created"], "model": daten["model"]}
+    yield {**kopf, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]}
+    feld = "refusal" if nachricht.get("refusal") else "content"
+    text = nachricht.get(feld) or ""
+    for start in range(0, len(text), stueck_zeichen):
+        yield {**kopf, "choices": [{"index": 0, "delta": {feld: text[start:start + stueck_zeichen]},
+                                    "finish_reason": None}]}
+    yield {**kopf, "choices": [{"index": 0, "delta": {}, "finish_reason": daten["choices"][0]["finish_reason"]}]}
+    yield {**kopf, "choices": [], "usage": daten.get("usage")}
+
+def completion(body, inhalt):
+    eingabe = prompt_tokens(body)
+    antwort_tokens = len(inhalt) // 4 + 1
+    return {
+        "id": f"chatcmpl-stub-{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": inhalt}}],
+        "usage": {"prompt_tokens": eingabe, "completion_tokens": antwort_tokens,
+                  "total_tokens": eingabe + antwort_tokens},
+    }
+
+class RateLimitFenster:
+    """Gleitendes 60-Sekunden-Fenster für Anfragen und Tokens – liefert x-ratelimit-Header wie die echte API."""
+
+    def __init__(self, rpm, tpm):
+        self.rpm, self.tpm = rpm, tpm
+        self.eintraege = deque()
+        self.lock = threading.Lock()
+
+    def pruefen(self, tokens):
+        jetzt = time.time()
+        with self.lock:
+            while self.eintraege and self.eintraege[0][0] < jetzt - 60:
+                self.eintraege.popleft()
+            anfragen = len(self.eintraege)
+            verbraucht = sum(t for _, t in self.eintraege)
+            erlaubt = anfragen < self.rpm and verbraucht + tokens <= self.tpm
+            if erlaubt:
+                self.eintraege.append((jetzt, tokens))
+                anfragen, verbraucht = anfragen + 1, verbraucht + tokens
+            reset = max(0.0, self.eintraege[0][0] + 60 - jetzt) if self.eintraege else 0.0
+        return erlaubt, {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-remaining-requests": str(max(0, self.rpm - anfragen)),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+            "x-ratelimit-limit-tokens": str(self.tpm),
+            "x-ratelimit-remaining-tokens": str(max(0, self.tpm - verbraucht)),
+            "x-ratelimit-reset-tokens": f"{reset:.3f}s",
+        }
+
+# ==========================================
+# 🌐 HTTP-SERVER
+# ==========================================
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-Alive wie bei der echten API – Verbindungspools werden sichtbar
+    einstellungen = None   # argparse-Namespace, wird in starte_server gesetzt
+    aufnahmen = {}
+    aufnahme = None
+    fenster = None
+    statistik = {"anfragen": 0, "verbindungen": 0, "429": 0, "fehler": 0, "replay_fehlt": 0, "ablehnungen": 0,
+                 "gestreamt": 0, "stream_abgebrochen": 0, "haenger": 0}
+    start = time.time()
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        StubHandler.statistik["verbindungen"] += 1  # eine Handler-Instanz je TCP-Verbindung
+
+    def _senden(self, status, daten, header=None):
+        roh = json.dumps(daten, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(roh)))
+        for name, wert in (header or {}).items():
+            self.send_header(name, wert)
+        self.end_headers()
+        self.wfile.write(roh)
+
+    def _streamen(self, body, daten, header=None):
+        # Server-Sent Events; Pause je Stück gemäß --tokens-pro-sekunde (~4 Zeichen pro Token)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")  # Verbindung bleibt nach dem Stream offen
+        for name, wert in (header or {}).items():
+            self.send_header(name, wert)
+        self.end_headers()
+        mit_usage = (body.get("stream_options") or {}).get("include_usage")
+        pause = 4 / self.einstellungen.tokens_pro_sekunde if self.einstellungen.tokens_pro_sekunde else 0
+        try:
+            for stueck in stream_stuecke(daten, stueck_zeichen=16):
+                if not stueck["choices"] and not mit_usage:
+                    continue
+                self._chunk(f"data: {json.dumps(stueck, ensure_ascii=False)}\n\n".encode("utf-8"))
+                if pause and stueck["choices"] and stueck["choices"][0]["delta"]:
+                    time.sleep(pause * 4)  # 16 Zeichen ≈ 4 Tokens
+            self._chunk(b"data: [DONE]\n\n")
+            self._chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            StubHandler.statistik["stream_abgebrochen"] += 1  # Client hat früh abgebrochen
+            self.close_connection = True
+
+    def _chunk(self, daten):
+        self.wfile.write(f"{len(daten):x}\r\n".encode("ascii") + daten + b"\r\n")
+        self.wfile.flush()
+
+    def _antworten(self, body, daten, header=None):
+        if body.get("stream"):
+            StubHandler.statistik["gestreamt"] += 1
+            self._streamen(body, daten, header)
+            return
+        if self.einstellungen.tokens_pro_sekunde:
+            text = daten["choices"][0]["message"].get("content") or ""
+            time.sleep(len(text) / 4 / self.einstellungen.tokens_pro_sekunde)
+        self._senden(200, daten, header)
+
+    def _fehler(self, status, typ, meldung, header=None):
+        self._senden(status, {"error": {"message": meldung, "type": typ, "code": typ}}, header)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/statistik"):
+            self._senden(200, StubHandler.statistik)
+        elif self.path.rstrip("/").endswith("/models"):
+            self._senden(200, {"object": "list", "data": [{"id": "gpt-4o", "object": "model"}]})
+        else:
+            self._fehler(404, "not_found", self.path)
+
+    def do_POST(self):
+        laenge = int(self.headers.get("Content-Length", 0))
+        roh = self.rfile.read(laenge)
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._fehler(404, "not_found", self.path)
+            return
+        body = json.loads(roh or b"{}")
+        StubHandler.statistik["anfragen"] += 1
+        modus = self.einstellungen.modus
+        if modus == "record":
+            self._weiterleiten(roh, body)
+        elif modus == "replay":
+            self._abspielen(body)
+        else:
+            self._synthetisieren(body)
+
+    def _abspielen(self, body):
+        eintrag = self.aufnahmen.get(anfrage_hash(body))
+        if eintrag is None:
+            StubHandler.statistik["replay_fehlt"] += 1
+            if self.einstellungen.fallback_synth:
+                self._synthetisieren(body)
+            else:
+                self._fehler(404, "replay_missing", "Anfrage nicht in der Aufnahme")
+            return
+        if self.einstellungen.latenz:
+            time.sleep(self._latenz())
+        if eintrag["status"] == 200:
+            self._antworten(body, eintrag["antwort"])
+        else:
+            self._senden(eintrag["status"], eintrag["antwort"])
+
+    def _latenz(self):
+        # Lognormal um den Mittelwert – lange Ausreißer wie bei der echten API
+        e = self.einstellungen
+        sigma = e.latenz_streuung
+        return random.lognormvariate(0, sigma) * e.latenz / (2.718281828 ** (sigma * sigma / 2))
+
+    def _synthetisieren(self, body):
+        e = self.einstellungen
+        tokens = prompt_tokens(body) + body.get("max_tokens", 800)
+        in_burst = e.burst_alle > 0 and (time.time() - self.start) % e.burst_alle < e.burst_dauer
+        erlaubt, header = self.fenster.pruefen(tokens)
+        if in_burst or not erlaubt or random.random() < e.quote_429:
+            StubHandler.statistik["429"] += 1
+            header["retry-after"] = f"{max(0.1, e.burst_dauer if in_burst else 1.0):.1f}"
+            self._fehler(429, "rate_limit_exceeded", "Rate limit reached (stub)", header)
+            return
+        time.sleep(self._latenz())
+        if random.random() < e.quote_haenger:
+            StubHandler.statistik["haenger"] += 1
+            time.sleep(e.haenger_dauer)  # Aufruf "hängt" – testet Deadlines und Hedging
+        if random.random() < e.fehlerquote:
+            StubHandler.statistik["fehler"] += 1
+            self._fehler(500, "server_error", "Synthetischer Serverfehler (stub)")
+            return
+        if random.random() < e.quote_ablehnung:
+            StubHandler.statistik["ablehnungen"] += 1
+            self._antworten(body, ablehnung(body), header)
+            return
+        self._antworten(body, completion(body, synthetischer_inhalt(body, e.positionen)), header)
+
+    def _weiterleiten(self, roh, body):
+        if body.get("stream"):
+            # Aufgezeichnet wird immer die fertige Antwort; gestreamt wird sie erst hier im Stub
+            roh = json.dumps({k: v for k, v in body.items() if k not in ("stream", "stream_options")}).encode("utf-8")
+        anfrage = urllib.request.Request(
+            self.einstellungen.ziel.rstrip("/") + "/chat/completions", data=roh, method="POST",
+            headers={"Content-Type": "application/json", "Authorization": self.headers.get("Authorization", "")},
+        )
+        try:
+            with urllib.request.urlopen(anfrage, timeout=600) as antwort:
+                status, daten = antwort.status, json.loads(antwort.read())
+                header = {k: v for k, v in antwort.headers.items() if k.lower().startswith(("x-ratelimit", "retry-after"))}
+        except urllib.error.HTTPError as fehler:
+            status, daten = fehler.code, json.loads(fehler.read() or b"{}")
+            header = {k: v for k, v in fehler.headers.items() if k.lower().startswith(("x-ratelimit", "retry-after"))}
+        if status == 200:
+            self.aufnahme.schreiben(anfrage_hash(body), body, status, daten)
+            self._antworten(body, daten, header)
+        else:
+            self._senden(status, daten, header)
+
+def starte_server(einstellungen):
+    StubHandler.einstellungen = einstellungen
+    StubHandler.fenster = RateLimitFenster(einstellungen.rpm, einstellungen.tpm)
+    if einstellungen.modus == "replay":
+        StubHandler.aufnahmen = lade_aufnahme(einstellungen.aufnahme)
+    if einstellungen.modus == "record":
+        StubHandler.aufnahme = Aufnahme(einstellungen.aufnahme, einstellungen.mit_anfrage)
+    server = ThreadingHTTPServer((einstellungen.host, einstellungen.port), StubHandler)
+    print(f"🧪 GPT-Stub ({einstellungen.modus}) läuft auf http://{einstellungen.host}:{einstellungen.port}/v1")
+    print(f"   → OPENAI_BASE_URL=http://{einstellungen.host}:{einstellungen.port}/v1 python main.py")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"\n📊 Stub-Statistik: {StubHandler.statistik}")
+
+def lies_argumente(argv=None):
+    parser = argparse.ArgumentParser(description="Lokaler OpenAI-kompatibler Stand-in für main.py")
+    parser.add_argument("modus", choices=["synth", "replay", "record"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--aufnahme", default="gpt_aufnahme.jsonl", help="JSONL für replay/record")
+    parser.add_argument("--mit-anfrage", action="store_true", help="record: Request-Body mit aufzeichnen")
+    parser.add_argument("--ziel", default="https://api.openai.com/v1", help="record: echte API")
+    parser.add_argument("--fallback-synth", action="store_true", help="replay: fehlende Anfragen synthetisch beantworten")
+    parser.add_argument("--latenz", type=float, default=0.8, help="mittlere Antwortzeit in Sekunden")
+    parser.add_argument("--latenz-streuung", type=float, default=0.5, help="Sigma der Lognormalverteilung")
+    parser.add_argument("--fehlerquote", type=float, default=0.0, help="Anteil 500er-Antworten")
+    parser.add_argument("--quote-429", type=float, default=0.0, help="Anteil zufälliger 429-Antworten")
+    parser.add_argument("--burst-alle", type=float, default=0.0, help="alle N Sekunden ein 429-Burst (0 = aus)")
+    parser.add_argument("--burst-dauer", type=float, default=2.0, help="Länge eines 429-Bursts in Sekunden")
+    parser.add_argument("--positionen", type=int, default=1, help="synth: Positionen je JSON-Antwort")
+    parser.add_argument("--quote-haenger", type=float, default=0.0, help="Anteil Anfragen, die sehr lange hängen")
+    parser.add_argument("--haenger-dauer", type=float, default=300.0, help="Sekunden, die ein Hänger dauert")
+    parser.add_argument("--quote-ablehnung", type=float, default=0.0, help="Anteil Ablehnungen (refusal)")
+    parser.add_argument("--tokens-pro-sekunde", type=float, default=0.0,
+                        help="simulierte Generierungsgeschwindigkeit (0 = Antwort sofort vollständig)")
+    parser.add_argument("--rpm", type=int, default=500, help="simuliertes Limit Anfragen/Minute")
+    parser.add_argument("--tpm", type=int, default=300000, help="simuliertes Limit Tokens/Minute")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    starte_server(lies_argumente())
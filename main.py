@@ -8,9 +8,25 @@ import shutil          # zum Verschieben von Dateien
 import atexit          # für automatische Sicherung bei Abbruch
 import time            # für Statistik-Ausgaben (z. B. Gesamtdauer)
 import traceback       # ➕ Für vollständige Fehlermeldungen mit Traceback
+import re              # Mustererkennung in extrahierten Texten
+import unicodedata     # Zeichenklassen für die Textlayer-Bewertung
+import json            # Lieferanten-Vorlagen und weitere Zustandsdateien
+import hashlib         # Fingerabdrücke und Inhalts-Hashes
+import zlib            # schnelle Wort-Hashes für den SimHash
+import sqlite3         # GPT-Antwort-Cache
+from collections import Counter, deque  # Mehrheitsentscheid beim Lernen von Vorlagen, Latenzfenster
+import xml.etree.ElementTree as ET  # E-Rechnungen (ZUGFeRD/Factur-X/XRechnung)
+
+# ⚡ Nebenläufigkeit (GPT-Aufrufe parallel, PDF-Arbeit in eigenem Thread)
+import asyncio
+import threading
+import random            # Jitter für den Backoff bei Rate-Limits
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # 📊 Datenverarbeitung
 import pandas as pd    # Tabellenverarbeitung für CSV, XLSX
+import numpy as np     # Merkmalsvektoren und lineares Modell der lokalen Dokumenttyp-Erkennung
 from io import StringIO  # um Text als Dateiobjekt zu behandeln (z. B. für CSV-PARSING)
 
 # 🗂 Pfad- und Zeitsteuerung
@@ -18,8 +34,15 @@ from datetime import datetime  # für Zeitstempel in Dateinamen
 from pathlib import Path       # Plattformunabhängige Pfaddefinitionen
 
 # 📄 PDF-Verarbeitung (Text- und Bildextraktion)
-import fitz            # PyMuPDF – extrahiert Text aus PDFs
-from pdf2image import convert_from_path  # erzeugt Bilder aus PDF-Seiten
+import fitz            # PyMuPDF – extrahiert Text aus PDFs und rendert Seiten im Prozess
+try:
+    from pdf2image import convert_from_bytes  # optionaler Fallback-Renderer (poppler/pdftoppm)
+except ImportError:
+    convert_from_bytes = None
+try:
+    import tiktoken    # exakte Tokenzählung für das Token-Budget (Pflicht, außer mit GPT_TOKEN_SCHAETZUNG)
+except ImportError:
+    tiktoken = None
 
 # 📦 Bildverarbeitung
 from base64 import b64encode  # für GPT-Bilder als base64 (z. B. erste Seite einer PDF)
@@ -28,7 +51,11 @@ from io import BytesIO        # für temporären Bildspeicher (PNG in base64)
 # 🧠 OpenAI API
 import openai                  # GPT-Modelle aufrufen (z. B. für Klassifikation, OCR, Kategorisierung)
 from dotenv import load_dotenv  # .env-Dateien lesen für sichere API-Key-Verwaltung
-from openai import OpenAI  # ✅ neue Client-API für openai>=1.0
+from openai import OpenAI, AsyncOpenAI  # ✅ neue Client-API für openai>=1.0 (sync + async)
+from openai import RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from openai import DefaultHttpxClient, DefaultAsyncHttpxClient  # gemeinsamer Verbindungspool für alle Aufrufe
+from openai import Timeout, DEFAULT_CONNECTION_LIMITS  # Timeout/Limits passend zum HTTP-Client, den das SDK mitbringt
+from importlib.util import find_spec
 
 # 🔐 API-Key aus .env-Datei laden (nicht im Code sichtbar speichern)
 # 🔄 Lade Umgebungsvariablen aus .env-Datei (muss im Hauptverzeichnis liegen)
@@ -48,7 +75,34 @@ if not api_key:
     sys.exit(1)
 
 # 🧠 GPT-Client initialisieren
-client = OpenAI(api_key=api_key)
+# OPENAI_BASE_URL (z. B. http://127.0.0.1:8765/v1 für gpt_stub_server.py) lenkt alle Aufrufe auf einen lokalen Stand-in
+GPT_BASIS_URL = os.getenv("OPENAI_BASE_URL") or None
+
+# 🔌 Verbindungspool: ein Client pro Prozess, Keep-Alive über alle Aufrufe, HTTP/2 wenn das Paket h2 installiert ist
+GPT_HTTP2 = find_spec("h2") is not None
+GPT_VERBINDUNGEN_MAX = 32          # ≥ GPT_PARALLEL_MAX, damit der Planer nie auf den Pool wartet
+GPT_KEEPALIVE_SEKUNDEN = 90        # offene Verbindungen so lange für die nächste Anfrage halten
+GPT_TIMEOUT = Timeout(
+    connect=5.0,                   # TCP + TLS
+    read=120.0,                    # max. Pause zwischen zwei Datenpaketen (auch beim Streaming)
+    write=30.0,                    # Upload großer Seitenbilder
+    pool=30.0,                     # Warten auf eine freie Verbindung
+)
+GPT_VORWAERMEN = 4                 # so viele Verbindungen werden beim Start geöffnet (0 = aus)
+
+def gpt_http_client(asynchron=True):
+    """Gemeinsamer HTTP-Client mit abgestimmtem Verbindungspool (sync für Batch-Dateien, async für Chat-Aufrufe)."""
+    einstellungen = {
+        "http2": GPT_HTTP2,
+        "timeout": GPT_TIMEOUT,
+        # gleiche Klasse wie die SDK-Voreinstellung – kein eigener Import der HTTP-Bibliothek nötig
+        "limits": type(DEFAULT_CONNECTION_LIMITS)(max_connections=GPT_VERBINDUNGEN_MAX,
+                                                  max_keepalive_connections=GPT_VERBINDUNGEN_MAX,
+                                                  keepalive_expiry=GPT_KEEPALIVE_SEKUNDEN),
+    }
+    return DefaultAsyncHttpxClient(**einstellungen) if asynchron else DefaultHttpxClient(**einstellungen)
+
+# Die Clients entstehen erst im Lauf: AsyncOpenAI mit der GptLaufzeit, OpenAI (sync) mit dem OpenAIBatchClient
 
 # 📁 Pfade & Dateinamen (werden beim Start automatisch erstellt)
 basisverzeichnis = Path(__file__).resolve().parent            # Hauptverzeichnis der Skriptdatei
@@ -60,10 +114,13 @@ nicht_rechnung_folder = basisverzeichnis / f"{zeitstempel}_nicht_rechnung"  # z.
 problemordner = basisverzeichnis / f"{zeitstempel}_problemrechnungen"    # unklare/fehlerhafte Fälle
 bereits_verarbeitet_ordner = basisverzeichnis / f"{zeitstempel}_bereits_verarbeitet"  # Duplikate
 output_excel = basisverzeichnis / "artikelpositionen_ki.xlsx" # Haupt-Ausgabedatei
-protokoll_excel = basisverzeichnis / "verarbeitete_dateien.xlsx"  # Logbuch über bereits verarbeitete Dateien
+protokoll_db = basisverzeichnis / "verarbeitete_dateien.sqlite"  # Logbuch über bereits verarbeitete Dateien
+protokoll_excel = basisverzeichnis / "verarbeitete_dateien.xlsx"  # exportierte Ansicht des Logbuchs
+vorlagen_datei = basisverzeichnis / "lieferanten_vorlagen.json"  # gelernte Layout-Vorlagen wiederkehrender Lieferanten
 
 # 🏢 Bekannte Einheiten oder Firmen
 TOCHTERFIRMEN = ["Wähler", "Kuhlmann", "BHK", "Mudcon", "Seier"]  # Für Zuordnungen von Rechnungsempfängern
+LIEFERANTEN = ["Matthäi", "Eurovia", "Bauzentrum", "Remondis", "Kuhlmann", "BHK"]  # Wiederkehrende Lieferanten
 
 # 🛑 Zentrale Fehlerliste für Laufzeitfehler
 VERARBEITUNGSFEHLER = []
@@ -86,16 +143,234 @@ class DualLogger:
 # Konfiguration
 FLUSH_INTERVAL = 20
 BATCH_SIZE = 1000
+ZWISCHEN_PARQUET = find_spec("pyarrow") is not None  # Batch-Zwischenstände als Parquet (pyarrow ist Pflicht, siehe requirements.txt)
+GPT_PARALLEL = 6               # Startwert: so viele GPT-Anfragen gleichzeitig unterwegs
+
+# 🚦 Rate-Limits (Startwerte – werden aus den x-ratelimit-Headern der API nachgeführt)
+GPT_ANFRAGEN_PRO_MINUTE = 500
+GPT_TOKENS_PRO_MINUTE = 30000
+GPT_PARALLEL_MIN = 1           # AIMD: Untergrenze nach 429-Halbierung
+GPT_PARALLEL_MAX = 24          # AIMD: Obergrenze beim schrittweisen Erhöhen
+GPT_MAX_VERSUCHE = 6           # 429/Timeout/5xx werden so oft wiederholt
+GPT_BACKOFF_BASIS = 1.0        # Sekunden, verdoppelt sich pro Versuch (mit Jitter)
+GPT_BACKOFF_MAX = 60.0
+GPT_TOKENS_PRO_BILD = 1100     # Schätzung für eine Seite in hoher Auflösung
+GPT_ANTWORT_TOKENS = 800       # reservierte Antwort-Tokens, bis die echte Nutzung bekannt ist
+
+# ⏱️ Deadlines je Aufgabe (Sekunden pro Versuch inkl. Stream) und Hedging für idempotente Aufrufe
+GPT_DEADLINES = {"klassifikation": 30, "zahl": 30, "ocr": 120, "kategorie": 180, "inhalt": 240, "kombi": 240}
+GPT_HEDGE_AUFGABEN = ("klassifikation", "ocr")  # nach der p95-Latenz geht eine zweite Anfrage los, die erste Antwort gewinnt
+GPT_HEDGE_PERZENTIL = 0.95
+GPT_HEDGE_MIN_PROBEN = 20      # erst ab so vielen gemessenen Antworten je Aufgabe wird gehedgt
+GPT_HEDGE_MAX_ANTEIL = 0.1     # höchstens so viele zusätzliche Anfragen (Anteil aller Anfragen der Aufgabe)
+
+# 🧩 Kombinierte GPT-Abfrage: Dokumenttyp + Kopfdaten + Positionen in einer JSON-Antwort
+GPT_KOMBI_MODUS = True         # False → getrennte Aufrufe (Klassifikation, OCR, Inhalt) wie bisher
+GPT_STRUKTURIERTE_AUSGABE = True  # Inhaltsabfrage per JSON-Schema (typisierte Spalten) statt freiem Klartext
+
+# 🪜 Modell-Routing: günstiges Modell zuerst, großes Modell nur wenn die Antwort die Prüfung nicht besteht
+GPT_MODELLE = {"klein": "gpt-4o-mini", "gross": "gpt-4o"}
+GPT_MODELL_STUFEN = {          # Reihenfolge der Stufen je Aufgabe (nicht aufgeführte Aufgaben: nur "gross")
+    "klassifikation": ["klein", "gross"],
+    "zahl": ["klein", "gross"],
+    "kategorie": ["klein", "gross"],
+    "ocr": ["gross"],
+    "inhalt": ["gross"],
+    "kombi": ["gross"],
+}
+
+# 📡 Streaming für lange Antworten: Positionen kommen einzeln an, Fehler/Ablehnungen brechen sofort ab
+GPT_STREAMING = True
+GPT_STREAM_AUFGABEN = ("inhalt", "kombi")
+STREAM_PRUEFZEICHEN = 24       # nach so vielen Zeichen wird der Antwortanfang geprüft
+
+# 🗂️ Batch-Modus (OpenAI Batch API, z. B. für nächtliche Rückstände): python main.py --batch [--batch-lokal]
+BATCH_ORDNER = basisverzeichnis / "gpt_batch"          # Anfragen, Ergebnisse und Zustandsdatei
+BATCH_ANFRAGEN_DATEI = BATCH_ORDNER / "anfragen.jsonl"
+BATCH_ERGEBNIS_DATEI = BATCH_ORDNER / "ergebnisse.jsonl"
+BATCH_FEHLER_DATEI = BATCH_ORDNER / "fehler.jsonl"
+BATCH_STATUS_DATEI = BATCH_ORDNER / "batch_status.json"
+BATCH_ABFRAGE_INTERVALL = 60   # Sekunden zwischen zwei Statusabfragen
+BATCH_ZEITFENSTER = "24h"
+
+# 💾 GPT-Antwort-Cache: Wiederholungsläufe über dieselben PDFs kosten keine API-Zeit
+GPT_CACHE_AKTIV = True         # Umgehen per Startparameter --ohne-cache
+GPT_CACHE_DATEI = basisverzeichnis / "gpt_cache.sqlite"
+GPT_CACHE_MAX_MB = 500         # darüber werden die am längsten nicht genutzten Antworten gelöscht
+GPT_CACHE_MAX_TAGE = 90        # ältere Antworten werden verworfen
+GPT_CACHE_ZUGRIFFE_GRUPPE = 200  # Zugriffszeiten von Treffern werden gesammelt und gruppenweise geschrieben
+PROMPT_VERSIONEN = {           # hochzählen, wenn sich die Bedeutung einer Antwort ändert (z. B. neuer Parser)
+    "klassifikation": 1, "ocr": 1, "inhalt": 1, "kombi": 1, "zahl": 1, "kategorie": 1,
+}
+
+# ✂️ Token-Budget je Aufruf: statt fester Zeichen-Abschnitte werden Kopf, Positionstabelle und Summen bevorzugt
+GPT_TOKEN_BUDGET = {"klassifikation": 500, "inhalt": 6000, "kombi": 6000}
+GPT_TOKENIZER = "o200k_base"   # Kodierung von gpt-4o (über tiktoken)
+GPT_TOKEN_SCHAETZUNG = False   # True: ohne tiktoken mit geschätzten Tokens weiterarbeiten statt abzubrechen
+TEXT_KOPF_ZEILEN = 25          # so viele Zeilen am Dokumentanfang gelten als Kopfblock
+TEXT_TABELLEN_FENSTER = 4      # ± Zeilen um eine Zeile, in denen Beträge gezählt werden
+TEXT_TABELLEN_MIN_BETRAEGE = 3 # ab so vielen Beträgen im Fenster gehört die Zeile zur Positionstabelle
+
+# 🖼️ Seiten-Rendering für GPT-Bildanfragen
+RENDER_BACKEND = "fitz"        # "fitz" (PyMuPDF im Prozess) oder "pdf2image" (poppler-Subprozess)
+RENDER_DPI = 200               # Auflösung der gerenderten Seite
+RENDER_FARBRAUM = "rgb"        # "rgb" oder "grau"
+RENDER_FORMAT = "png"          # "png", "jpeg" oder "webp" (webp braucht Pillow)
+RENDER_QUALITAET = 85          # nur für jpeg/webp
+
+# 🔍 Textlayer-Bewertung (pro Seite, mit Frühabbruch)
+TEXTLAYER_MIN_SEITENSCORE = 0.55   # ab diesem Score gilt eine Seite als brauchbar
+TEXTLAYER_MIN_ZEICHEN = 100        # so viel guter Text reicht für das Urteil "nutzbar"
+OCR_MAX_ZUSATZSEITEN = 3           # Mischdokumente: max. Seiten, die zusätzlich an GPT-OCR gehen
+
+# 📐 Lokale Tabellenerkennung (Textlayer-PDFs ohne GPT)
+LOKAL_MIN_KONFIDENZ = 0.8          # darunter wird die Inhaltsextraktion weiterhin an GPT gegeben
+VORLAGE_MIN_BESTAETIGUNGEN = 3     # so viele bestätigte Extraktionen, bevor eine Lieferanten-Vorlage greift
+
+# ♻️ Duplikaterkennung über den Dateiinhalt (blake2b), nicht nur über den Dateinamen
+INHALTS_HASH_THREADS = 4           # Dateien werden parallel zum Einlesen der Liste gehasht
+HASH_BLOCKGROESSE = 1 << 20        # Bytes pro Leseschritt
+
+# 📋 Protokoll verarbeiteter Dateien (SQLite, nur anhängen)
+PROTOKOLL_GRUPPE = 25              # so viele Zeilen je Commit – der Rest am Laufende bzw. beim Beenden
+PROTOKOLL_EXCEL_AM_ENDE = True     # verarbeitete_dateien.xlsx nach jedem Lauf neu exportieren (sonst --protokoll-exportieren)
+
+# 👯 Fast-Duplikate (neu exportiert, "Kopie", anderer Scan) – Suche im Verlauf ohne API-Aufruf
+AEHNLICHKEIT_AKTIV = True
+AEHNLICHKEITS_INDEX = basisverzeichnis / "aehnlichkeits_index.json"
+SIMHASH_MAX_ABSTAND = 4            # Bits (von 64), ab denen zwei Texte nicht mehr als ähnlich gelten
+ZAHLEN_MIN_JACCARD = 0.92          # Anteil gemeinsamer Zahlen (Beträge, Daten, Nummern) zur Bestätigung
+ZAHLEN_MAX = 256                   # so viele Zahlen-Hashes je Dokument werden gespeichert (die kleinsten)
+DHASH_MAX_ABSTAND = 4              # Bits (von 64) für den groben Bild-Hash gescannter erster Seiten (Suche)
+DHASH_FEIN_MAX_ABSTAND = 6         # Bits (von 256) für den feinen Bild-Hash (Bestätigung)
+
+# 🔑 Dieselbe Rechnung nach der Extraktion: Lieferant + Rechnungsnummer + Bruttobetrag
+RECHNUNGS_INDEX_AKTIV = True
+RECHNUNGS_INDEX = basisverzeichnis / "rechnungs_index.json"
+RECHNUNGS_INDEX_FORMAT = 1         # bei Änderung der Schlüsselbildung hochzählen → Index wird neu aufgebaut
+RECHTSFORMEN = {"gmbh", "mbh", "co", "kg", "ag", "ohg", "ug", "gbr", "se", "ek", "e", "k", "haftungsbeschränkt", "und"}
+
+# 🏷️ Regelbasierte Vorklassifikation (gewichtete Begriffe im Kopfbereich) – eindeutige Fälle ohne GPT
+REGEL_KLASSIFIKATION = True
+REGEL_KOPF_ZEICHEN = 1500          # so viel Text ab Dokumentanfang gilt als Kopfbereich
+REGEL_MIN_PUNKTE = 6               # Mindestpunktzahl des besten Typs
+REGEL_MIN_ABSTAND = 4              # Vorsprung vor dem zweitbesten Typ
+REGEL_SCHATTENMODUS = False        # True → GPT klassifiziert trotzdem, es wird nur die Übereinstimmung gezählt
+REGEL_VETO_TYPEN = ("gutschrift", "mahnung", "zahlungserinnerung")  # zitieren die Rechnungsnummer → nie sicher "rechnung"
+
+# 🎓 Lokales Dokumenttyp-Modell, trainiert aus früheren Läufen: python main.py --modell-trainieren
+MODELL_KLASSIFIKATION = True       # greift nur, wenn die Modelldatei existiert und die Regel unklar ist
+MODELL_DATEI = basisverzeichnis / "dokumenttyp_modell.npz"
+MODELL_FORMAT = 2                  # hochzählen, wenn sich Merkmale oder Dateiaufbau ändern – alte Modelle werden ignoriert
+MODELL_MIN_WAHRSCHEINLICHKEIT = 0.9  # darunter entscheidet GPT
+MODELL_SCHATTENMODUS = False       # True → GPT klassifiziert trotzdem, es wird nur die Übereinstimmung gezählt
+MODELL_TEXT_ZEICHEN = 2000         # so viel Text ab Dokumentanfang geht in die Merkmale ein
+MODELL_NGRAMME = (3, 5)            # Zeichen-n-Gramme von … bis
+MODELL_MERKMALE = 2 ** 18          # Größe des Hash-Raums
+MODELL_MIN_BEISPIELE = 30          # darunter wird kein Modell gespeichert
+MODELL_EPOCHEN = 40
+MODELL_LERNRATE = 0.05
+MODELL_REGULARISIERUNG = 1e-5
+MODELL_TESTANTEIL = 0.2            # Anteil der Beispiele, an denen das Modell vor dem Speichern geprüft wird
+
+# 🧱 Strukturierte Ausgabe (JSON-Schema): Schemas, Prompts und Parameter der Inhalts- und Kombi-Abfrage
+DOKUMENTTYPEN = ["rechnung", "gutschrift", "mahnung", "zahlungserinnerung", "anschreiben", "email", "behördlich", "sonstiges"]
+
+def _optional(typ, **extra):
+    return {"type": [typ, "null"], **extra}
+
+RECHNUNGS_SCHEMA = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["kopfdaten", "positionen"],
+    "properties": {
+        "kopfdaten": {
+            "type": "object",
+            "additionalProperties": False,
+            "required": ["lieferant", "rechnungsempfaenger", "ust_idnr", "rechnungsnummer", "rechnungsdatum", "gesamtbetrag"],
+            "properties": {
+                "lieferant": _optional("string"),
+                "rechnungsempfaenger": _optional("string", description="Name im Adressfeld, an das das Schreiben adressiert ist"),
+                "ust_idnr": _optional("string"),
+                "rechnungsnummer": _optional("string"),
+                "rechnungsdatum": _optional("string", description="TT.MM.JJJJ"),
+                "gesamtbetrag": _optional("number", description="Brutto-Endbetrag"),
+            },
+        },
+        "positionen": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["artikelbezeichnung", "menge", "einheit", "einzelpreis", "gesamtpreis"],
+                "properties": {
+                    "artikelbezeichnung": {"type": "string"},
+                    "menge": _optional("number"),
+                    "einheit": _optional("string"),
+                    "einzelpreis": _optional("number"),
+                    "gesamtpreis": _optional("number"),
+                },
+            },
+        },
+    },
+}
+KOMBI_SCHEMA = {
+    **RECHNUNGS_SCHEMA,
+    "required": ["dokumenttyp"] + RECHNUNGS_SCHEMA["required"],
+    "properties": {"dokumenttyp": {"type": "string", "enum": DOKUMENTTYPEN}, **RECHNUNGS_SCHEMA["properties"]},
+}
+
+def json_schema_format(name, schema):
+    # Structured Outputs: die API garantiert eine schema-konforme Antwort
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+EXTRAKTIONS_REGELN = (
+    "- Zahlen mit Punkt als Dezimaltrennzeichen, ohne Währungszeichen; unbekannte Werte als null.\n"
+    "- Der Rechnungsempfänger steht im Adressfeld, an das das Schreiben adressiert ist.\n"
+    "- Jede Artikelposition genau einmal; Zwischensummen, MwSt. und Endbeträge sind keine Positionen."
+)
+INHALT_PROMPT_STRUKTURIERT = (
+    "Extrahiere die Kopfdaten und alle Artikelpositionen dieser Rechnung.\n" + EXTRAKTIONS_REGELN
+)
+KOMBI_PROMPT = (
+    "Du erhältst ein Geschäftsdokument (Text oder Bild). Klassifiziere es und extrahiere bei Rechnungen "
+    "die Kopfdaten und alle Artikelpositionen.\n"
+    "- Achte bei der Klassifikation besonders auf Begriffe oben rechts oder in der Kopfzeile "
+    "('Rechnung', 'Gutschrift', 'Mahnung', 'Rechnungsnummer', 'Zahlbetrag', 'USt.').\n"
+    "- Ist es keine Rechnung, gib eine leere Positionsliste zurück.\n" + EXTRAKTIONS_REGELN
+)
+
+KOMBI_PARAMETER = {"temperature": 0, "response_format": json_schema_format("dokument", KOMBI_SCHEMA)}
+INHALT_PARAMETER = (
+    {"temperature": 0, "response_format": json_schema_format("rechnung", RECHNUNGS_SCHEMA)}
+    if GPT_STRUKTURIERTE_AUSGABE else {}
+)
 
 # Statistik
 gesamt_start = time.time()
+anzahl_eingang = 0              # jede abgeschlossene Eingangsdatei, auch früh aussortierte (Basis der Prozentwerte)
 anzahl_text = 0
 anzahl_ocr = 0
+anzahl_lokal = 0
+anzahl_xml = 0
 probleme = 0
 nicht_rechnungen = 0
+seiten_ausgelassen = 0          # Dokumente mit Seiten ohne Text über der OCR-Grenze
 dauer_text = 0.0
 dauer_ocr = 0.0
 alle_dfs = []
+BATCH_ANTWORTEN = {}           # Anfrage-Schlüssel → Antworttext (nur im Batch-Modus gefüllt)
+BATCH_STATISTIK = Counter()
+TEXTAUSWAHL_STATISTIK = Counter()  # gekürzte Texte und Tokens vor/nach der Auswahl
+ROUTING_STATISTIK = Counter()      # (Stufe, Kennzahl) → Antworten, gültig, eskaliert, Live-Aufrufe, Sekunden
+STREAM_STATISTIK = Counter()       # gestreamte Antworten, Abbrüche, Zeit bis zur ersten Position
+REGEL_STATISTIK = Counter()        # regelbasiert entschieden/unklar, Vergleiche mit GPT
+REGEL_ABWEICHUNGEN = Counter()     # (Regel, GPT) → Anzahl
+MODELL_STATISTIK = Counter()       # Modell entschieden/unsicher, Vergleiche mit GPT
+MODELL_ABWEICHUNGEN = Counter()    # (Modell, GPT) → Anzahl
+UMBENANNTE_DUPLIKATE = []          # (neuer Dateiname, bereits verarbeitet als)
+DUPLIKAT_STATISTIK = Counter()     # Inhalt/Name bekannt, Name bekannt aber Inhalt neu
+RECHNUNGS_DUPLIKATE = []           # (Dateiname, Rechnung schon erfasst aus)
 
 # atexit-Backup
 def speichere_backup():
@@ -115,6 +390,8 @@ print("💾 Backup-Funktion registriert")
 logdatei = output_excel.parent / f"{zeitstempel}_verarbeitung_log.txt"
 sys.stdout = DualLogger(logdatei)
 print(f"💾 Logging aktiv: {logdatei.name}")
+if not ZWISCHEN_PARQUET:
+    print("⚠️ pyarrow fehlt – Batch-Zwischenstände werden langsam als .xlsx geschrieben (`pip install -r requirements.txt`)")
 
 # Abbrüche verhindern -Robuste Verarbeitung
 def sicher_ausführen(funktion, name, *args, **kwargs):
@@ -132,10 +409,31 @@ def move_with_folder(src_path, target_folder, target_filename):
     target_folder.mkdir(parents=True, exist_ok=True)
     shutil.move(src_path, target_folder / target_filename)
   
+# 📦 Batch-Zwischenstände: Parquet (spaltenweise, ohne openpyxl) – Excel bleibt die Gesamtausgabe für Menschen
+def finde_batchdateien(ordner):
+    return sorted(pfad for pfad in Path(ordner).glob("artikelpositionen_ki_batch_*") if pfad.suffix in (".parquet", ".xlsx"))
+
+def schreibe_batchdatei(df, ordner, name):
+    if ZWISCHEN_PARQUET:
+        pfad = ordner / f"artikelpositionen_ki_batch_{name}.parquet"
+        try:
+            df.to_parquet(pfad, index=False)
+            return pfad
+        except Exception as e:
+            # z. B. Spalte mit gemischten Typen, die Arrow nicht abbilden kann
+            pfad.unlink(missing_ok=True)
+            print(f"⚠️ Zwischenstand nicht als Parquet speicherbar ({e}) – verwende Excel")
+    pfad = ordner / f"artikelpositionen_ki_batch_{name}.xlsx"
+    df.to_excel(pfad, index=False)
+    return pfad
+
+def lese_batchdatei(pfad):
+    return pd.read_parquet(pfad) if pfad.suffix == ".parquet" else pd.read_excel(pfad)
+
 def zeige_next_steps_übersicht(batch_ordner):
     print("\n\n📋 NÄCHSTE SCHRITTE (vor dem nächsten Lauf):\n")
     print("1️⃣  🔁 Verschiebe oder lösche die verarbeiteten Batch-Dateien:")
-    for f in Path(batch_ordner).glob("artikelpositionen_ki_batch_*.xlsx"):
+    for f in finde_batchdateien(batch_ordner):
         print(f"    - {f.name}")
     print("    📎 Sonst werden sie beim nächsten Lauf erneut verarbeitet!\n")
 
@@ -161,14 +459,9 @@ def zeige_next_steps_übersicht(batch_ordner):
         print("      2. Prüfe die verschobenen Dateien im Ordner `fehlerhafte_batches`.")
         print("      3. Starte das Skript erneut, wenn alles geprüft wurde.\n")
 
-def speichere_verarbeitete_datei(dateiname):
+def speichere_verarbeitete_datei(dateiname, inhalts_hash=None):
     try:
-        df = pd.DataFrame([[dateiname, datetime.now().strftime("%Y-%m-%d %H:%M")]],
-                          columns=["Dateiname", "Verarbeitet am"])
-        if protokoll_excel.exists():
-            bestehend = pd.read_excel(protokoll_excel)
-            df = pd.concat([bestehend, df], ignore_index=True)
-        df.to_excel(protokoll_excel, index=False)
+        PROTOKOLL.anhaengen(dateiname, inhalts_hash)
     except Exception as e:
         fehlermeldung = f"Fehler beim Speichern in Protokolldatei ({dateiname}): {e}"
         print(fehlermeldung)
@@ -178,50 +471,1897 @@ def speichere_verarbeitete_datei(dateiname):
 # 📑 VORVERARBEITUNG & PDF-EXTRAKTION
 # ==========================================
 
-def extrahiere_text_aus_pdf(pfad):
+class PdfAnalyse:
+    """Einmal geöffnete PDF, die von allen Verarbeitungsstufen gemeinsam genutzt wird.
+
+    Die Datei wird genau einmal eingelesen und aus dem Speicher geöffnet (kein Datei-Handle,
+    Verschieben bleibt möglich). Seitentexte, Textlayer-Urteil und gerenderte Seitenbilder
+    werden erst bei Bedarf erzeugt und danach zwischengespeichert.
+    """
+
+    def __init__(self, pfad):
+        self.pfad = Path(pfad)
+        self.dateiname = self.pfad.name
+        self._daten = None
+        self._doc = None
+        self._seitentexte = {}
+        self._seitenwoerter = {}
+        self._seitenbloecke = {}
+        self.tabellenlayout = None  # 📐 zuletzt erkannte Spaltenpositionen (für Lieferanten-Vorlagen)
+        self._seitenscores = {}
+        self._textlayer = None
+        self.ocr_texte = {}  # 🔠 GPT-OCR-Ersatztexte für Seiten ohne brauchbaren Textlayer
+        self.bilder = {}  # 🖼️ gerenderte Seitenbilder (base64), Schlüssel: (Seite, DPI, Farbraum, Format)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.schliessen()
+        return False
+
+    @property
+    def daten(self):
+        if self._daten is None:
+            self._daten = self.pfad.read_bytes()
+        return self._daten
+
+    @property
+    def doc(self):
+        if self._doc is None:
+            self._doc = fitz.open(stream=self.daten, filetype="pdf")
+        return self._doc
+
+    @property
+    def ist_xml(self):
+        return self.pfad.suffix.lower() == ".xml"
+
+    @property
+    def dateigroesse(self):
+        return len(self._daten) if self._daten is not None else self.pfad.stat().st_size
+
+    @property
+    def seitenanzahl(self):
+        return self.doc.page_count
+
+    def seitentext(self, nummer):
+        if nummer not in self._seitentexte:
+            self._seitentexte[nummer] = self.doc[nummer].get_text()
+        return self._seitentexte[nummer]
+
+    def seitenwoerter(self, nummer):
+        # (x0, y0, x1, y1, wort, block, zeile, wortnr) – Grundlage der lokalen Tabellenerkennung
+        if nummer not in self._seitenwoerter:
+            self._seitenwoerter[nummer] = self.doc[nummer].get_text("words")
+        return self._seitenwoerter[nummer]
+
+    def seitenbloecke(self, nummer):
+        if nummer not in self._seitenbloecke:
+            self._seitenbloecke[nummer] = self.doc[nummer].get_text("blocks")
+        return self._seitenbloecke[nummer]
+
+    @property
+    def seitentexte(self):
+        return [self.seitentext(i) for i in range(self.seitenanzahl)]
+
+    @property
+    def text(self):
+        return "\n".join(self.seitentexte).strip()
+
+    def seitenscore(self, nummer):
+        if nummer not in self._seitenscores:
+            self._seitenscores[nummer] = bewerte_textseite(self.seitentext(nummer))
+        return self._seitenscores[nummer]
+
+    def seite_ist_gut(self, nummer):
+        return self.seitenscore(nummer) >= TEXTLAYER_MIN_SEITENSCORE
+
+    def seite_ist_leer(self, nummer):
+        # Weder Schrift noch Bild noch Vektorgrafik – z. B. leere Rückseiten, die nicht an GPT-OCR sollen
+        seite = self.doc[nummer]
+        return not (seite.get_fonts() or seite.get_images() or seite.get_drawings())
+
+    def ocr_kandidaten(self, hoechstens):
+        # Seiten ohne brauchbaren Textlayer: gescannt, mit kaputter Schriftkodierung oder als Vektorpfade
+        # gesetzt – gerendert taugen alle für GPT-OCR. Gesucht wird nur, bis genug Kandidaten gefunden sind
+        kandidaten = []
+        for nummer in range(self.seitenanzahl):
+            if len(kandidaten) >= hoechstens:
+                break
+            if not self.seite_ist_gut(nummer) and not self.seite_ist_leer(nummer):
+                kandidaten.append(nummer)
+        return kandidaten
+
+    def seiten_ohne_text(self, ausser=()):
+        # Schlechte, nicht leere Seiten, die weder im Text noch unter `ausser` (z. B. per OCR ergänzt) vorkommen
+        return [nummer for nummer in range(self.seitenanzahl)
+                if nummer not in ausser and not self.seite_ist_gut(nummer) and not self.seite_ist_leer(nummer)]
+
+    @property
+    def nutzbarer_text(self):
+        teile = []
+        for i in range(self.seitenanzahl):
+            if i in self.ocr_texte:
+                teile.append(self.ocr_texte[i])
+            elif self.seite_ist_gut(i):
+                teile.append(self.seitentext(i))
+        return "\n".join(teile).strip()
+
+    @property
+    def hat_nutzbaren_text(self):
+        if self._textlayer is None:
+            self._textlayer = pdf_hat_nutzbaren_text(self)
+        return self._textlayer
+
+    def schliessen(self):
+        if self._doc is not None:
+            self._doc.close()
+            self._doc = None
+
+def extrahiere_text_aus_pdf(analyse):
     try:
-        doc = fitz.open(pfad)
-        return "\n".join([page.get_text() for page in doc]).strip()
+        return analyse.nutzbarer_text
     except Exception as e:
-        fehlermeldung = f"PDF-Text konnte nicht extrahiert werden ({pfad}): {e}"
+        fehlermeldung = f"PDF-Text konnte nicht extrahiert werden ({analyse.pfad}): {e}"
         print(fehlermeldung)
         VERARBEITUNGSFEHLER.append(fehlermeldung)
         return ""
 
-def konvertiere_erste_seite_zu_base64(pfad):
-    try:
-        image = convert_from_path(pfad, first_page=1, last_page=1)[0]
-        buffer = BytesIO()
+BILD_MIME_TYPEN = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+def bild_data_url(b64, format=None):
+    return f"data:{BILD_MIME_TYPEN[format or RENDER_FORMAT]};base64,{b64}"
+
+def rendere_seite_fitz(analyse, seite, dpi, farbraum, format):
+    farbe = fitz.csGRAY if farbraum == "grau" else fitz.csRGB
+    pix = analyse.doc[seite].get_pixmap(dpi=dpi, colorspace=farbe, alpha=False)
+    if format == "png":
+        return pix.tobytes("png")
+    if format == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=RENDER_QUALITAET)
+    # WebP kann MuPDF nicht selbst kodieren → einmalige Kodierung über Pillow
+    return pix.pil_tobytes(format="WEBP", quality=RENDER_QUALITAET)
+
+def rendere_seite_pdf2image(analyse, seite, dpi, farbraum, format):
+    if convert_from_bytes is None:
+        raise RuntimeError("pdf2image ist nicht installiert")
+    image = convert_from_bytes(analyse.daten, dpi=dpi, first_page=seite + 1, last_page=seite + 1,
+                               grayscale=(farbraum == "grau"))[0]
+    buffer = BytesIO()
+    if format == "png":
         image.save(buffer, format="PNG")
-        return b64encode(buffer.getvalue()).decode("utf-8")
+    else:
+        image.save(buffer, format=format.upper(), quality=RENDER_QUALITAET)
+    return buffer.getvalue()
+
+def rendere_seite_base64(analyse, seite=0, dpi=None, farbraum=None, format=None):
+    dpi = dpi or RENDER_DPI
+    farbraum = farbraum or RENDER_FARBRAUM
+    format = format or RENDER_FORMAT
+    schluessel = (seite, dpi, farbraum, format)
+    if schluessel in analyse.bilder:
+        return analyse.bilder[schluessel]
+
+    renderer = [rendere_seite_fitz, rendere_seite_pdf2image]
+    if RENDER_BACKEND == "pdf2image":
+        renderer.reverse()
+    letzter_fehler = None
+    for render in renderer:
+        try:
+            daten = render(analyse, seite, dpi, farbraum, format)
+            break
+        except Exception as e:
+            print(f"⚠️ Rendering mit {render.__name__} fehlgeschlagen ({analyse.dateiname}): {e}")
+            letzter_fehler = e
+    else:
+        raise letzter_fehler
+
+    analyse.bilder[schluessel] = b64encode(daten).decode("utf-8")
+    return analyse.bilder[schluessel]
+
+def konvertiere_erste_seite_zu_base64(analyse):
+    try:
+        return rendere_seite_base64(analyse, seite=0)
     except Exception as e:
-        VERARBEITUNGSFEHLER.append(f"Base64-Bild von erster PDF-Seite fehlgeschlagen ({pfad}): {e}")
+        VERARBEITUNGSFEHLER.append(f"Base64-Bild von erster PDF-Seite fehlgeschlagen ({analyse.pfad}): {e}")
         return None
         
-def pdf_hat_nutzbaren_text(pdf_path, min_verwertbar=80):
+# Häufige Wörter aus Rechnungen und Geschäftsbriefen – Grundlage für die Wortquote je Seite
+HAEUFIGE_WOERTER = {
+    "der", "die", "das", "und", "oder", "mit", "von", "für", "fuer", "auf", "aus", "bei", "bis", "zum", "zur",
+    "ein", "eine", "einer", "ist", "sind", "wir", "sie", "ihr", "ihre", "ihnen", "uns", "nicht", "auch", "als",
+    "nach", "per", "pro", "inkl", "zzgl", "gmbh", "co", "kg", "ag", "str", "straße", "strasse", "tel", "fax",
+    "rechnung", "rechnungsnummer", "rechnungsdatum", "gutschrift", "mahnung", "erinnerung", "lieferschein",
+    "lieferung", "lieferdatum", "leistung", "leistungszeitraum", "auftrag", "auftragsnummer", "bestellung",
+    "kunde", "kunden", "kundennummer", "datum", "nummer", "seite", "position", "pos", "artikel", "menge",
+    "einheit", "preis", "einzelpreis", "gesamtpreis", "gesamt", "betrag", "summe", "zwischensumme", "netto",
+    "brutto", "mwst", "ust", "steuer", "umsatzsteuer", "rabatt", "skonto", "zahlbar", "zahlung", "tage",
+    "tonne", "tonnen", "stück", "stk", "meter", "liter", "pauschal", "pauschale", "stunde", "stunden",
+    "bank", "iban", "bic", "konto", "geschäftsführer", "amtsgericht", "hrb", "email", "mail", "www",
+    "bitte", "vielen", "dank", "freundlichen", "grüßen", "sehr", "geehrte", "geehrter", "damen", "herren",
+    "baustelle", "transport", "fracht", "entsorgung", "miete", "material", "sand", "kies", "beton", "asphalt",
+}
+
+def ist_aussprechbar(wort):
+    # Kaputte Font-Kodierungen erzeugen Zeichenketten ohne Vokale, mit langen Konsonantenketten
+    # oder wildem Groß-/Kleinwechsel (z. B. "VL<?LHH", "Uhfkqxqj")
+    if not re.search(r"[aeiouyäöüAEIOUYÄÖÜ]", wort):
+        return False
+    if re.search(r"[^aeiouyäöüAEIOUYÄÖÜ]{5,}", wort):
+        return False
+    return wort.islower() or wort.isupper() or (wort[0].isupper() and wort[1:].islower())
+
+def bewerte_textseite(text):
+    """Qualitätsscore 0–1 für den Textlayer einer Seite (Zeichenklassen + Wortquote)."""
+    zeichen = [c for c in text if not c.isspace()]
+    if len(zeichen) < 20:
+        return 0.0
+
+    buchstaben = sum(c.isalpha() for c in zeichen)
+    ziffern = sum(c.isdigit() for c in zeichen)
+    satzzeichen = sum(c in ".,:;-–/()%€&+*'\"#@" for c in zeichen)
+    kaputt = sum(c == "\ufffd" or unicodedata.category(c) in ("Cc", "Co", "Cs", "Cn") for c in zeichen)
+    zeichen_score = (buchstaben + ziffern + 0.5 * satzzeichen) / len(zeichen) - 3 * kaputt / len(zeichen)
+
+    woerter = re.findall(r"[A-Za-zÄÖÜäöüß]{2,}", text)
+    if not woerter:
+        return 0.0
+    im_woerterbuch = sum(w.lower() in HAEUFIGE_WOERTER for w in woerter)
+    aussprechbar = sum(w.lower() not in HAEUFIGE_WOERTER and ist_aussprechbar(w) for w in woerter)
+    wort_score = min(1.0, (im_woerterbuch * 2 + aussprechbar * 0.7) / len(woerter))
+
+    return round(max(0.0, 0.4 * zeichen_score + 0.6 * wort_score), 3)
+
+def pdf_hat_nutzbaren_text(analyse):
+    # Seitenweise bewerten und abbrechen, sobald das Urteil feststeht. Seiten ohne eingebettete Schrift haben
+    # keinen Textlayer (Scans, Vektorpfade) und kosten nur einen Blick in die Ressourcen. "Nein" steht erst
+    # fest, wenn keine der restlichen Seiten mehr Text liefern kann – sonst würde ein Mischdokument mit
+    # gescannten ersten Seiten als reiner Scan behandelt und nur seine erste Seite gelesen
     try:
-        doc = fitz.open(pdf_path)
-        text = "".join([page.get_text() for page in doc])
-        return len(text.strip()) >= 50 and not text.startswith("VL<?LHH")
+        gute_zeichen = 0
+        for nummer in range(analyse.seitenanzahl):
+            if not analyse.doc[nummer].get_fonts():
+                continue
+            if analyse.seite_ist_gut(nummer):
+                gute_zeichen += len(analyse.seitentext(nummer).strip())
+                if gute_zeichen >= TEXTLAYER_MIN_ZEICHEN:
+                    return True
+        return False
     except Exception as e:
-        fehlermeldung = f"Fehler beim PDF-Vorfilter für {pdf_path}: {e}"
+        fehlermeldung = f"Fehler beim PDF-Vorfilter für {analyse.pfad}: {e}"
         print(fehlermeldung)
         VERARBEITUNGSFEHLER.append(fehlermeldung)
         return False
 
+# ==========================================
+# 📐 LOKALE TABELLENERKENNUNG (WORTKOORDINATEN)
+# ==========================================
+
+# Kopfzeilen-Begriffe je Spaltenrolle (klein geschrieben, ohne Satzzeichen)
+SPALTEN_SCHLUESSELWOERTER = {
+    "pos": {"pos", "position", "nr", "lfd"},
+    "bezeichnung": {"bezeichnung", "artikelbezeichnung", "artikel", "beschreibung", "leistung", "text", "material"},
+    "menge": {"menge", "anzahl", "anz", "stückzahl"},
+    "einheit": {"einheit", "me", "eh", "einh", "mengeneinheit"},
+    "einzelpreis": {"einzelpreis", "epreis", "ep", "stückpreis", "preis", "preiseinh", "einzel"},
+    "gesamtpreis": {"gesamtpreis", "gpreis", "gp", "gesamt", "betrag", "gesamtbetrag", "wert", "summe", "netto"},
+}
+KERNSPALTEN = ("menge", "einheit", "einzelpreis", "gesamtpreis")
+TABELLENENDE_BEGRIFFE = re.compile(
+    r"^(zwischen|end)?summe|^netto|^gesamtbetrag|^rechnungsbetrag|^übertrag|^mwst|^ust|^umsatzsteuer|^zahlbar",
+    re.IGNORECASE,
+)
+DEUTSCHE_ZAHL = re.compile(r"^-?[\d.]+(,\d+)?-?$|^-?\d+(\.\d+)?-?$")
+
+def parse_deutsche_zahl(wert):
+    # "1.234,56" → 1234.56, "12,50-" → -12.5, "4.500" → 4500.0
+    if wert is None:
+        return None
+    text = str(wert).replace("€", "").replace("EUR", "").replace(" ", "").strip()
+    if not text or not DEUTSCHE_ZAHL.match(text):
+        return None
+    negativ = text.startswith("-") or text.endswith("-")
+    text = text.strip("-")
+    if "," in text:
+        text = text.replace(".", "").replace(",", ".")
+    elif re.fullmatch(r"\d{1,3}(\.\d{3})+", text):
+        text = text.replace(".", "")
+    try:
+        zahl = float(text)
+    except ValueError:
+        return None
+    return -zahl if negativ else zahl
+
+def _normiere_kopfwort(wort):
+    return re.sub(r"[^a-zäöüß]", "", wort.lower())
+
+def gruppiere_woerter_zu_zeilen(woerter):
+    # Wörter mit ähnlicher vertikaler Mitte bilden eine Zeile
+    if not woerter:
+        return []
+    hoehen = sorted(w[3] - w[1] for w in woerter)
+    toleranz = max(1.0, hoehen[len(hoehen) // 2] * 0.5)
+    zeilen = []
+    for wort in sorted(woerter, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        mitte = (wort[1] + wort[3]) / 2
+        if zeilen and abs(zeilen[-1]["mitte"] - mitte) <= toleranz:
+            zeilen[-1]["woerter"].append(wort)
+        else:
+            zeilen.append({"mitte": mitte, "woerter": [wort]})
+    for zeile in zeilen:
+        zeile["woerter"].sort(key=lambda w: w[0])
+    return [zeile["woerter"] for zeile in zeilen]
+
+def erkenne_kopfzeile(zeile):
+    # Liefert {Rolle: x-Mitte} wenn mindestens drei Kernspalten erkannt werden
+    spalten = {}
+    for wort in zeile:
+        norm = _normiere_kopfwort(wort[4])
+        for rolle, begriffe in SPALTEN_SCHLUESSELWOERTER.items():
+            if norm in begriffe and rolle not in spalten:
+                spalten[rolle] = (wort[0] + wort[2]) / 2
+                break
+    if sum(rolle in spalten for rolle in KERNSPALTEN) < 3:
+        return None
+    return spalten
+
+def ordne_zeile_spalten_zu(zeile, spalten):
+    # Grenzen liegen mittig zwischen den Kopfwort-Mitten; Wörter ohne Zahlenspalte → Bezeichnung
+    reihenfolge = sorted(spalten.items(), key=lambda eintrag: eintrag[1])
+    grenzen = [(reihenfolge[i][1] + reihenfolge[i + 1][1]) / 2 for i in range(len(reihenfolge) - 1)]
+    zellen = {rolle: [] for rolle in spalten}
+    for wort in zeile:
+        mitte = (wort[0] + wort[2]) / 2
+        index = sum(mitte > grenze for grenze in grenzen)
+        zellen[reihenfolge[index][0]].append(wort[4])
+    return {rolle: " ".join(teile) for rolle, teile in zellen.items()}
+
+def extrahiere_positionen_lokal(analyse, spalten_vorgabe=None, kopf_y=None):
+    """Rekonstruiert Artikelpositionen aus Wortkoordinaten. Gibt (DataFrame | None, Konfidenz) zurück.
+
+    Mit `spalten_vorgabe`/`kopf_y` (aus einer Lieferanten-Vorlage) wird auch ohne erkannte Kopfzeile
+    ab dieser Höhe der ersten Seite gelesen.
+    """
+    positionen = []
+    spalten = spalten_vorgabe
+    tabelle_beendet = False
+    summenwerte = []
+    for nummer in range(analyse.seitenanzahl):
+        if not analyse.seite_ist_gut(nummer):
+            continue
+        # Folgeseiten ohne wiederholten Kopf übernehmen die zuletzt erkannten Spalten
+        in_tabelle = spalten is not None and not tabelle_beendet
+        for zeile in gruppiere_woerter_zu_zeilen(analyse.seitenwoerter(nummer)):
+            kopf = erkenne_kopfzeile(zeile)
+            if kopf:
+                spalten, in_tabelle, tabelle_beendet = kopf, True, False
+                if analyse.tabellenlayout is None:
+                    analyse.tabellenlayout = {"spalten": kopf, "kopf_y": zeile[0][3], "seite": nummer}
+                continue
+            if nummer == 0 and kopf_y is not None and zeile[0][1] <= kopf_y:
+                continue
+            if not in_tabelle:
+                continue
+            zeilentext = " ".join(w[4] for w in zeile).strip()
+            zellen = ordne_zeile_spalten_zu(zeile, spalten)
+            zeilenzahlen = [z for z in (parse_deutsche_zahl(w[4]) for w in zeile) if z is not None]
+            # Summenzeilen tragen einen Betrag – reine Unterköpfe wie "netto netto" beenden nichts.
+            # Das Summenwort darf auch erst rechts neben einem Fließtext stehen ("Wir bitten … Netto EUR 8,12").
+            summenzeile = any(
+                TABELLENENDE_BEGRIFFE.match(teil)
+                for teil in [zeilentext] + [text for rolle, text in zellen.items() if rolle not in ("pos", "bezeichnung")]
+            )
+            if summenzeile and zeilenzahlen:
+                summenwerte += zeilenzahlen
+                in_tabelle = False
+                # Übertrag/Zwischensumme: Tabelle geht auf der nächsten Seite weiter
+                tabelle_beendet = not re.match(r"übertrag|zwischensumme", zeilentext, re.IGNORECASE)
+                continue
+
+            gesamt = parse_deutsche_zahl(zellen.get("gesamtpreis"))
+            bezeichnung = " ".join(
+                [zellen.get("bezeichnung", "")] +
+                [teil for teil in zellen.get("pos", "").split() if parse_deutsche_zahl(teil) is None]
+            ).strip()
+            if gesamt is None:
+                # Zeile ohne Betrag: Fortsetzung der vorherigen Artikelbezeichnung (Zahlen im Text sind erlaubt)
+                zahlenspalten = ("menge", "einzelpreis", "gesamtpreis")
+                if positionen and bezeichnung and not any(zellen.get(rolle, "").strip() for rolle in zahlenspalten):
+                    positionen[-1]["Artikelbezeichnung"] = f"{positionen[-1]['Artikelbezeichnung']} {bezeichnung}".strip()
+                continue
+
+            # "20 t" in der Mengenspalte: Zahl → Menge, Rest → Einheit (falls keine eigene Spalte).
+            # Bei mehreren Zahlen (z. B. eine unbekannte Kostenstellen-Spalte links daneben) zählt die letzte.
+            menge_teile = zellen.get("menge", "").split()
+            zahl_indizes = [i for i, teil in enumerate(menge_teile) if parse_deutsche_zahl(teil) is not None]
+            menge = parse_deutsche_zahl(menge_teile[zahl_indizes[-1]]) if zahl_indizes else None
+            rest = menge_teile[zahl_indizes[-1] + 1:] if zahl_indizes else menge_teile
+            einheit = zellen.get("einheit", "").strip() or " ".join(rest) or None
+            positionen.append({
+                "Artikelbezeichnung": bezeichnung,
+                "Menge": menge,
+                "Einheit": einheit,
+                "Einzelpreis": parse_deutsche_zahl(zellen.get("einzelpreis")),
+                "Gesamtpreis": gesamt,
+            })
+
+    if not positionen or not spalten:
+        return None, 0.0
+
+    # 🎯 Konfidenz: erkannte Kernspalten + rechnerisch stimmige Zeilen (+ Summenabgleich)
+    kopf_anteil = sum(rolle in spalten for rolle in KERNSPALTEN) / len(KERNSPALTEN)
+    stimmig = 0
+    for pos in positionen:
+        menge, preis, gesamt = pos["Menge"], pos["Einzelpreis"], pos["Gesamtpreis"]
+        if pos["Artikelbezeichnung"] and menge is not None and preis is not None \
+                and abs(menge * preis - gesamt) <= max(0.02, abs(gesamt) * 0.01):
+            stimmig += 1
+    konfidenz = 0.3 * kopf_anteil + 0.7 * stimmig / len(positionen)
+    summe = sum(pos["Gesamtpreis"] for pos in positionen)
+    if any(abs(summe - wert) <= 0.02 for wert in summenwerte):
+        konfidenz = min(1.0, konfidenz + 0.1)
+
+    df = pd.DataFrame(positionen)
+    df["Dateiname"] = analyse.dateiname
+    return df, round(konfidenz, 3)
+
+# ==========================================
+# 🏷️ KOPFDATEN & LIEFERANTEN-VORLAGEN
+# ==========================================
+
+USTID_MUSTER = re.compile(r"\bDE ?\d{3} ?\d{3} ?\d{3}\b")
+KOPFDATEN_MUSTER = {
+    "Rechnungsnummer": re.compile(
+        r"(?:Rechnungs[- ]?(?:nummer|nr\.?)|Rechnung(?:\s+Nr\.?)?|Beleg[- ]?(?:nummer|Nr\.?))\s*:?\s*"
+        r"((?=[A-Z\-/]*\d)[A-Z0-9][A-Z0-9\-/]{2,})",
+        re.IGNORECASE),
+    "Rechnungsdatum": re.compile(r"(?:Rechnungsdatum|Datum)\s*:?\s*(\d{1,2}\.\d{1,2}\.\d{2,4})", re.IGNORECASE),
+    "Gesamtbetrag": re.compile(
+        r"(?:Gesamtbetrag|Rechnungsbetrag|Endbetrag|Zahlbetrag|Bruttobetrag)\s*:?\s*(?:EUR|€)?\s*(-?[\d.]+,\d{2})",
+        re.IGNORECASE),
+}
+
+def erkenne_lieferant(text):
+    lower = text.lower()
+    for lieferant in LIEFERANTEN:
+        if lieferant.lower() in lower:
+            return lieferant
+    return None
+
+def extrahiere_kopfdaten_lokal(analyse):
+    # Generische Kopfdaten per Regex – Rohwerte, so wie sie im Dokument stehen
+    text = analyse.nutzbarer_text
+    kopfdaten = {"Lieferant": erkenne_lieferant(analyse.seitentext(0))}
+    ust = USTID_MUSTER.search(text)
+    kopfdaten["USt_IdNr"] = ust.group(0).replace(" ", "") if ust else None
+    for feld, muster in KOPFDATEN_MUSTER.items():
+        treffer = muster.search(text)
+        kopfdaten[feld] = treffer.group(1) if treffer else None
+    return kopfdaten
+
+def ergaenze_kopfdaten(df, kopfdaten):
+    for feld in ["Lieferant", "Rechnungsnummer", "Rechnungsdatum"]:
+        df[feld] = kopfdaten.get(feld)
+    df["Gesamtbetrag"] = parse_deutsche_zahl(kopfdaten.get("Gesamtbetrag"))
+    return df
+
+def layout_fingerabdruck(analyse):
+    # Lieferant, USt-IdNr. und grob gerasterte Positionen der Textblöcke im Kopfbereich der ersten Seite
+    seite = analyse.doc[0]
+    breite, hoehe = seite.rect.width, seite.rect.height
+    raster = sorted({
+        (round(b[0] / breite * 20), round(b[1] / hoehe * 20))
+        for b in analyse.seitenbloecke(0) if b[1] < hoehe * 0.25
+    })
+    ust = USTID_MUSTER.search(analyse.seitentext(0))
+    return {
+        "lieferant": erkenne_lieferant(analyse.seitentext(0)),
+        "ust_id": ust.group(0).replace(" ", "") if ust else None,
+        "layout": hashlib.sha1(repr(raster).encode("utf-8")).hexdigest()[:16],
+    }
+
+def _fundstelle(analyse, wert):
+    # Sucht den Rohwert in den Wörtern der ersten/letzten Seite → (Seite, bbox, Label davor auf derselben Zeile)
+    for nummer in dict.fromkeys([0, analyse.seitenanzahl - 1]):
+        woerter = analyse.seitenwoerter(nummer)
+        for i, wort in enumerate(woerter):
+            if wort[4].strip(":") != wert:
+                continue
+            label = [w[4] for w in woerter[max(0, i - 3):i] if w[5:7] == wort[5:7]]
+            return {"seite": nummer, "bbox": list(wort[:4]), "label": " ".join(label)}
+    return None
+
+class VorlagenRegister:
+    """Gelernte Extraktionsregeln pro Lieferant mit Index über USt-IdNr. und Layout-Hash.
+    Gelerntes wird nicht je Dokument geschrieben, sondern mit indizes_speichern() gesichert."""
+
+    def __init__(self, pfad):
+        self.pfad = Path(pfad)
+        self.vorlagen = {}
+        self.index_ust = {}
+        self.index_layout = {}
+        self.geaendert = False
+        if self.pfad.exists():
+            try:
+                self.vorlagen = json.loads(self.pfad.read_text(encoding="utf-8"))
+            except Exception as e:
+                fehlermeldung = f"Lieferanten-Vorlagen konnten nicht geladen werden ({self.pfad.name}): {e}"
+                print(fehlermeldung)
+                VERARBEITUNGSFEHLER.append(fehlermeldung)
+        for name, vorlage in self.vorlagen.items():
+            self._indexieren(name, vorlage)
+
+    def _indexieren(self, name, vorlage):
+        if vorlage.get("ust_id"):
+            self.index_ust[vorlage["ust_id"]] = name
+        for layout in vorlage.get("layouts", []):
+            self.index_layout[layout] = name
+
+    def finde(self, fingerabdruck):
+        name = self.index_ust.get(fingerabdruck["ust_id"]) or self.index_layout.get(fingerabdruck["layout"])
+        vorlage = self.vorlagen.get(name) if name else None
+        # Gleiches Layout, aber andere USt-IdNr. → anderer Lieferant
+        if vorlage and fingerabdruck["ust_id"] and vorlage.get("ust_id") not in (None, fingerabdruck["ust_id"]):
+            return None
+        return vorlage
+
+    def lerne(self, analyse, bestaetigte_felder):
+        """Nimmt eine bestätigte Extraktion (Feld → Rohwert wie im Dokument) als Beobachtung auf."""
+        fingerabdruck = layout_fingerabdruck(analyse)
+        name = fingerabdruck["ust_id"] or fingerabdruck["lieferant"]
+        if not name or not analyse.tabellenlayout:
+            return False
+        vorlage = self.finde(fingerabdruck) or self.vorlagen.setdefault(name, {
+            "name": name, "lieferant": fingerabdruck["lieferant"], "ust_id": fingerabdruck["ust_id"],
+            "layouts": [], "beobachtungen": {}, "felder": {}, "bestaetigungen": 0,
+        })
+        if fingerabdruck["layout"] not in vorlage["layouts"]:
+            vorlage["layouts"].append(fingerabdruck["layout"])
+
+        for feld, wert in bestaetigte_felder.items():
+            fundstelle = _fundstelle(analyse, str(wert)) if wert else None
+            if fundstelle and fundstelle["label"]:
+                vorlage["beobachtungen"].setdefault(feld, []).append(fundstelle)
+        vorlage["tabelle"] = {
+            "spalten": analyse.tabellenlayout["spalten"],
+            "kopf_y": analyse.tabellenlayout["kopf_y"] if analyse.tabellenlayout["seite"] == 0 else None,
+        }
+        vorlage["bestaetigungen"] += 1
+
+        # 🧮 Regel je Feld: häufigstes Label + Vereinigung der beobachteten Wert-Rechtecke
+        for feld, fundstellen in vorlage["beobachtungen"].items():
+            label, anzahl = Counter(f["label"] for f in fundstellen).most_common(1)[0]
+            passend = [f for f in fundstellen if f["label"] == label]
+            vorlage["felder"][feld] = {
+                "regex": re.escape(label) + r"\s*:?\s*(\S+)",
+                "seite": passend[-1]["seite"],
+                "bbox": [min(f["bbox"][0] for f in passend), min(f["bbox"][1] for f in passend),
+                         max(f["bbox"][2] for f in passend), max(f["bbox"][3] for f in passend)],
+                "sicher": anzahl >= VORLAGE_MIN_BESTAETIGUNGEN,
+            }
+        vorlage["aktiv"] = vorlage["bestaetigungen"] >= VORLAGE_MIN_BESTAETIGUNGEN
+        self._indexieren(vorlage["name"], vorlage)
+        self.geaendert = True
+        return True
+
+    def wende_an(self, analyse):
+        """Extrahiert Kopfdaten und Positionen lokal mit einer aktiven Vorlage. None, wenn keine passt."""
+        fingerabdruck = layout_fingerabdruck(analyse)
+        vorlage = self.finde(fingerabdruck)
+        if not vorlage or not vorlage.get("aktiv"):
+            return None
+
+        kopfdaten = {"Lieferant": vorlage["lieferant"] or vorlage["name"]}
+        for feld, regel in vorlage["felder"].items():
+            seite = min(regel["seite"], analyse.seitenanzahl - 1)
+            treffer = re.search(regel["regex"], analyse.seitentext(seite))
+            if treffer:
+                kopfdaten[feld] = treffer.group(1)
+                continue
+            x0, y0, x1, y1 = regel["bbox"]
+            im_bereich = [w[4] for w in analyse.seitenwoerter(seite)
+                          if w[0] >= x0 - 5 and w[1] >= y0 - 5 and w[2] <= x1 + 5 and w[3] <= y1 + 5]
+            kopfdaten[feld] = " ".join(im_bereich) or None
+        if not kopfdaten.get("Rechnungsnummer"):
+            return None
+
+        tabelle = vorlage["tabelle"]
+        df, konfidenz = extrahiere_positionen_lokal(analyse, spalten_vorgabe=tabelle["spalten"], kopf_y=tabelle["kopf_y"])
+        if df is None or konfidenz < LOKAL_MIN_KONFIDENZ:
+            return None
+        return ergaenze_kopfdaten(df, kopfdaten)
+
+    def speichern(self):
+        if not self.geaendert:
+            return
+        try:
+            temp = self.pfad.with_suffix(".tmp")
+            temp.write_text(json.dumps(self.vorlagen, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(temp, self.pfad)
+            self.geaendert = False
+        except Exception as e:
+            fehlermeldung = f"Lieferanten-Vorlagen konnten nicht gespeichert werden ({self.pfad.name}): {e}"
+            print(fehlermeldung)
+            VERARBEITUNGSFEHLER.append(fehlermeldung)
+
+VORLAGEN = None  # wird beim ersten Zugriff geladen
+
+def lieferanten_vorlagen():
+    global VORLAGEN
+    if VORLAGEN is None:
+        VORLAGEN = VorlagenRegister(vorlagen_datei)
+    return VORLAGEN
+
+# ==========================================
+# 🧾 E-RECHNUNGEN (ZUGFeRD / FACTUR-X / XRECHNUNG)
+# ==========================================
+
+# UN/ECE Rec 20 Einheiten-Codes → Einheiten wie im Mapping
+EINHEITEN_CODES = {
+    "C62": "Stück", "H87": "Stück", "XPP": "Stück", "TNE": "Tonne", "KGM": "Kilogramm", "MTR": "Meter",
+    "MTK": "Quadratmeter", "MTQ": "Kubikmeter", "LTR": "Liter", "HUR": "Stunde", "DAY": "Tag",
+    "KMT": "Kilometer", "LS": "Pauschale", "SET": "Satz",
+}
+E_RECHNUNG_DATEINAMEN = ("factur-x.xml", "zugferd-invoice.xml", "xrechnung.xml", "zugferd_invoice.xml")
+
+def _xml_name(element):
+    return element.tag.rsplit("}", 1)[-1]
+
+def _xml_kind(element, *pfad):
+    # Namespace-unabhängige Navigation über lokale Elementnamen
+    for name in pfad:
+        if element is None:
+            return None
+        element = next((kind for kind in element if _xml_name(kind) == name), None)
+    return element
+
+def _xml_kinder(element, name):
+    return [kind for kind in element if _xml_name(kind) == name] if element is not None else []
+
+def _xml_text(element, *pfad):
+    ziel = _xml_kind(element, *pfad)
+    return ziel.text.strip() if ziel is not None and ziel.text else None
+
+def _xml_zahl(element, *pfad):
+    wert = _xml_text(element, *pfad)
+    try:
+        return float(wert) if wert is not None else None
+    except ValueError:
+        return None
+
+def _xml_datum(wert):
+    # CII: 20250419 (Format 102), UBL: 2025-04-19 → 19.04.2025
+    if not wert:
+        return None
+    ziffern = wert.replace("-", "")
+    if len(ziffern) == 8 and ziffern.isdigit():
+        return f"{ziffern[6:8]}.{ziffern[4:6]}.{ziffern[0:4]}"
+    return wert
+
+def _parse_cii(wurzel):
+    dokument = _xml_kind(wurzel, "ExchangedDocument")
+    transaktion = _xml_kind(wurzel, "SupplyChainTradeTransaction")
+    vereinbarung = _xml_kind(transaktion, "ApplicableHeaderTradeAgreement")
+    verkaeufer = _xml_kind(vereinbarung, "SellerTradeParty")
+    steuer_ids = [_xml_text(reg, "ID") for reg in _xml_kinder(verkaeufer, "SpecifiedTaxRegistration")]
+    kopf = {
+        "Lieferant": _xml_text(verkaeufer, "Name"),
+        "USt_IdNr": next((i for i in steuer_ids if i and i[:2].isalpha()), None),
+        "Rechnungsempfänger": _xml_text(vereinbarung, "BuyerTradeParty", "Name"),
+        "Rechnungsnummer": _xml_text(dokument, "ID"),
+        "Rechnungsdatum": _xml_datum(_xml_text(dokument, "IssueDateTime", "DateTimeString")),
+        "Gesamtbetrag": _xml_zahl(transaktion, "ApplicableHeaderTradeSettlement",
+                                  "SpecifiedTradeSettlementHeaderMonetarySummation", "GrandTotalAmount"),
+        "Typcode": _xml_text(dokument, "TypeCode"),
+    }
+    positionen = []
+    for zeile in _xml_kinder(transaktion, "IncludedSupplyChainTradeLineItem"):
+        menge = _xml_kind(zeile, "SpecifiedLineTradeDelivery", "BilledQuantity")
+        positionen.append({
+            "Artikelbezeichnung": _xml_text(zeile, "SpecifiedTradeProduct", "Name"),
+            "Menge": _xml_zahl(zeile, "SpecifiedLineTradeDelivery", "BilledQuantity"),
+            "Einheit": menge.get("unitCode") if menge is not None else None,
+            "Einzelpreis": _xml_zahl(zeile, "SpecifiedLineTradeAgreement", "NetPriceProductTradePrice", "ChargeAmount"),
+            "Gesamtpreis": _xml_zahl(zeile, "SpecifiedLineTradeSettlement",
+                                     "SpecifiedTradeSettlementLineMonetarySummation", "LineTotalAmount"),
+        })
+    return kopf, positionen
+
+def _parse_ubl(wurzel):
+    gutschrift = _xml_name(wurzel) == "CreditNote"
+    lieferant = _xml_kind(wurzel, "AccountingSupplierParty", "Party")
+    empfaenger = _xml_kind(wurzel, "AccountingCustomerParty", "Party")
+    kopf = {
+        "Lieferant": _xml_text(lieferant, "PartyLegalEntity", "RegistrationName") or _xml_text(lieferant, "PartyName", "Name"),
+        "USt_IdNr": _xml_text(lieferant, "PartyTaxScheme", "CompanyID"),
+        "Rechnungsempfänger": _xml_text(empfaenger, "PartyLegalEntity", "RegistrationName") or _xml_text(empfaenger, "PartyName", "Name"),
+        "Rechnungsnummer": _xml_text(wurzel, "ID"),
+        "Rechnungsdatum": _xml_datum(_xml_text(wurzel, "IssueDate")),
+        "Gesamtbetrag": _xml_zahl(wurzel, "LegalMonetaryTotal", "TaxInclusiveAmount"),
+        "Typcode": "381" if gutschrift else _xml_text(wurzel, "InvoiceTypeCode"),
+    }
+    positionen = []
+    for zeile in _xml_kinder(wurzel, "CreditNoteLine" if gutschrift else "InvoiceLine"):
+        menge = _xml_kind(zeile, "CreditedQuantity" if gutschrift else "InvoicedQuantity")
+        positionen.append({
+            "Artikelbezeichnung": _xml_text(zeile, "Item", "Name") or _xml_text(zeile, "Item", "Description"),
+            "Menge": _xml_zahl(zeile, "CreditedQuantity" if gutschrift else "InvoicedQuantity"),
+            "Einheit": menge.get("unitCode") if menge is not None else None,
+            "Einzelpreis": _xml_zahl(zeile, "Price", "PriceAmount"),
+            "Gesamtpreis": _xml_zahl(zeile, "LineExtensionAmount"),
+        })
+    return kopf, positionen
+
+def parse_e_rechnung(xml_daten, dateiname):
+    """CII (ZUGFeRD/Factur-X/XRechnung) oder UBL → (Dokumenttyp, DataFrame). None, wenn kein bekanntes Format."""
+    wurzel = ET.fromstring(xml_daten)
+    if _xml_name(wurzel) == "CrossIndustryInvoice":
+        kopf, positionen = _parse_cii(wurzel)
+    elif _xml_name(wurzel) in ("Invoice", "CreditNote"):
+        kopf, positionen = _parse_ubl(wurzel)
+    else:
+        return None
+    if not positionen:
+        return None
+
+    dokumenttyp = "gutschrift" if kopf.pop("Typcode") in ("381", "261") else "rechnung"
+    df = pd.DataFrame(positionen)
+    df["Einheit"] = df["Einheit"].map(lambda code: EINHEITEN_CODES.get(code, code))
+    for feld, wert in kopf.items():
+        df[feld] = wert
+    df["Dateiname"] = dateiname
+    return dokumenttyp, df
+
+def finde_eingebettete_xml(analyse):
+    # Bekannte ZUGFeRD/Factur-X-Anhangsnamen zuerst, danach beliebige XML-Anhänge
+    anhaenge = []
+    for name in analyse.doc.embfile_names():
+        dateiname = (analyse.doc.embfile_info(name).get("filename") or name).lower()
+        if dateiname.endswith(".xml"):
+            anhaenge.append((dateiname not in E_RECHNUNG_DATEINAMEN, name))
+    for _, name in sorted(anhaenge):
+        yield analyse.doc.embfile_get(name)
+
+def lese_e_rechnung(analyse):
+    # Kaputtes XML oder unerwartete Werte brechen nichts ab: PDFs laufen durch die normale Pipeline,
+    # reine XML-Dateien landen als unlesbar im Problemordner
+    quellen = [analyse.daten] if analyse.ist_xml else finde_eingebettete_xml(analyse)
+    for xml_daten in quellen:
+        try:
+            ergebnis = parse_e_rechnung(xml_daten, analyse.dateiname)
+        except (ET.ParseError, ValueError, TypeError, AttributeError) as e:
+            VERARBEITUNGSFEHLER.append(f"E-Rechnung nicht lesbar ({analyse.dateiname}): {e}")
+            continue
+        if ergebnis:
+            return ergebnis
+    return None
+
+# ==========================================
+# 🏷️ REGELBASIERTE VORKLASSIFIKATION
+# ==========================================
+
+# (Dokumenttyp, Begriffe, Gewicht) – jede Regel zählt pro Dokument höchstens einmal.
+# Begriffe sind kleingeschriebene Wörter oder Wortfolgen; "#" steht für ein Wort mit Ziffern (Belegnummer),
+# "*endung" trifft Komposita (Gebührenbescheid). Allgemeine Wörter, die auch in Rechnungsköpfen stehen
+# (Bestellung, Lieferschein, Gemeinde), zählen nur schwach.
+KLASSIFIKATIONS_REGELN = [
+    ("gutschrift", ("gutschrift", "*gutschrift", "gutschriftsnummer", "rechnungskorrektur", "korrekturrechnung",
+                    "stornorechnung", "storno"), 8),
+    ("gutschrift", ("erstattung",), 2),
+    ("mahnung", ("mahnung", "*mahnung", "letzte erinnerung", "mahngebühr", "mahngebühren"), 8),
+    ("zahlungserinnerung", ("zahlungserinnerung", "erinnerung"), 8),
+    ("zahlungserinnerung", ("offene posten", "offenen posten", "überfällig", "überfällige"), 5),
+    ("rechnung", ("rechnungsnummer", "rechnungsnr", "rechnungs nr", "rechnung nr", "rechnung #", "rechnung no",
+                  "invoice no", "invoice number", "invoice #"), 7),
+    ("rechnung", ("abschlagsrechnung", "schlussrechnung", "teilrechnung", "sammelrechnung", "endrechnung"), 6),
+    ("rechnung", ("rechnung", "invoice"), 4),
+    ("rechnung", ("rechnungsdatum", "belegdatum", "belegnummer", "kundennummer", "kundennr"), 1),
+    ("rechnung", ("leistungszeitraum", "leistungsdatum", "leistungsmonat", "lieferdatum"), 1),
+    ("rechnung", ("zahlbar bis", "zahlbar innerhalb", "zahlbar sofort", "zahlungsziel", "zahlungsbedingungen",
+                  "skonto"), 1),
+    ("rechnung", ("nettobetrag", "bruttobetrag", "zahlbetrag", "endbetrag", "gesamtbetrag", "rechnungsbetrag",
+                  "rechnungssumme", "nettosumme", "endsumme", "einzelpreis", "gesamtpreis"), 1),
+    ("behördlich", ("*bescheid", "rechtsbehelfsbelehrung", "anordnung", "straßenverkehrsordnung", "stvo"), 5),
+    ("behördlich", ("gemeinde", "zweckverband", "landratsamt", "stadtverwaltung", "bürgermeister",
+                    "bürgermeisterin", "behörde", "hauptzollamt", "bundesagentur", "aktenzeichen"), 3),
+    ("anschreiben", ("sehr geehrte", "sehr geehrter", "mit freundlichen grüßen", "freundliche grüße"), 2),
+    ("sonstiges", ("angebot", "auftragsbestätigung", "kostenvoranschlag", "aufmaß", "aufmaßblatt",
+                   "allgemeine geschäftsbedingungen", "agb", "preisliste", "kontoauszug"), 6),
+    ("sonstiges", ("lieferschein", "bestellung"), 2),
+]
+# E-Mail-Ausdrucke erkennt man an mehreren Kopfzeilen (Von:, An:, Betreff:, Gesendet:)
+EMAIL_KOPF_MUSTER = re.compile(r"^\s*(von|from|an|to|cc|betreff|subject|gesendet|sent)\s*:", re.IGNORECASE | re.MULTILINE)
+EMAIL_MIN_KOPFZEILEN = 3
+EMAIL_GEWICHT = 6
+WORT_MUSTER = re.compile(r"\w+")
+
+def _baue_regelindex():
+    # Ein Wörterbuch für alle Begriffe: je Wort ein Nachschlagen statt eines Musterdurchlaufs pro Regel
+    begriffe, endungen, phrasen_anfaenge = {}, [], set()
+    for nummer, (_, liste, _) in enumerate(KLASSIFIKATIONS_REGELN):
+        for begriff in liste:
+            if begriff.startswith("*"):
+                endungen.append((begriff[1:], nummer))
+            else:
+                begriffe[begriff] = nummer
+                if " " in begriff:
+                    phrasen_anfaenge.add(begriff.split()[0])
+    laengste = max(len(begriff.split()) for begriff in begriffe)
+    return begriffe, tuple(endungen), phrasen_anfaenge, laengste
+
+REGEL_BEGRIFFE, REGEL_ENDUNGEN, REGEL_PHRASEN_ANFAENGE, REGEL_MAX_WORTE = _baue_regelindex()
+REGEL_ENDUNGEN_TUPEL = tuple(endung for endung, _ in REGEL_ENDUNGEN)
+
+def kopf_woerter(text):
+    # Kleinschreibung, Ziffernwörter → "#", gesperrt gesetzte Überschriften ("R E C H N U N G") zusammenziehen
+    woerter, buchstaben = [], []
+    for wort in WORT_MUSTER.findall(text.lower()):
+        if len(wort) == 1 and wort.isalpha():
+            buchstaben.append(wort)
+            continue
+        if buchstaben:
+            woerter.extend(["".join(buchstaben)] if len(buchstaben) >= 3 else buchstaben)
+            buchstaben = []
+        woerter.append(wort if wort.isalpha() else "#")
+    if buchstaben:
+        woerter.extend(["".join(buchstaben)] if len(buchstaben) >= 3 else buchstaben)
+    return woerter
+
+def klassifiziere_regelbasiert(text):
+    """Kopfbereich → (Dokumenttyp | None, Punkte je Typ). None, wenn der Fall nicht eindeutig ist."""
+    kopf = text[:REGEL_KOPF_ZEICHEN]
+    woerter = kopf_woerter(kopf)
+    treffer = set()
+    for i, wort in enumerate(woerter):
+        nummer = REGEL_BEGRIFFE.get(wort)
+        if nummer is not None:
+            treffer.add(nummer)
+        if wort in REGEL_PHRASEN_ANFAENGE:
+            for laenge in range(2, REGEL_MAX_WORTE + 1):
+                nummer = REGEL_BEGRIFFE.get(" ".join(woerter[i:i + laenge]))
+                if nummer is not None:
+                    treffer.add(nummer)
+        if wort.endswith(REGEL_ENDUNGEN_TUPEL):
+            treffer.update(nummer for endung, nummer in REGEL_ENDUNGEN if wort.endswith(endung))
+    punkte = Counter()
+    for nummer in treffer:
+        typ, _, gewicht = KLASSIFIKATIONS_REGELN[nummer]
+        punkte[typ] += gewicht
+    if len({m.group(1).lower() for m in EMAIL_KOPF_MUSTER.finditer(kopf)}) >= EMAIL_MIN_KOPFZEILEN:
+        punkte["email"] += EMAIL_GEWICHT
+    rangliste = punkte.most_common(2) + [(None, 0)] * 2
+    (bester, vorne), (_, zweiter) = rangliste[0], rangliste[1]
+    # Eindeutig nur mit genug Punkten, klarem Abstand und ohne zweiten Typ, der für sich allein reichen würde
+    # Gutschriften und Mahnungen nennen die Rechnung, auf die sie sich beziehen → dann entscheidet GPT
+    if bester == "rechnung" and any(punkte[typ] for typ in REGEL_VETO_TYPEN):
+        return None, punkte
+    if vorne >= REGEL_MIN_PUNKTE and vorne - zweiter >= REGEL_MIN_ABSTAND and zweiter < REGEL_MIN_PUNKTE:
+        return bester, punkte
+    return None, punkte
+
+def vergleiche_klassifikation(dok, lokal_typ, quelle="Regel", statistik=REGEL_STATISTIK, abweichungen=REGEL_ABWEICHUNGEN):
+    # Laufen lokale Stufe und GPT beide, wird die Übereinstimmung gezählt – Abweichungen stehen im Dokument-Log
+    if lokal_typ is None or not dok.klassifikation:
+        return
+    statistik["verglichen"] += 1
+    if lokal_typ == dok.klassifikation:
+        statistik["uebereinstimmung"] += 1
+    else:
+        abweichungen[(lokal_typ, dok.klassifikation)] += 1
+        dok.log(f"🏷️ {quelle} sagt '{lokal_typ}', GPT sagt '{dok.klassifikation}' – GPT gilt")
+
+# ==========================================
+# 🎓 LOKALES DOKUMENTTYP-MODELL (AUS FRÜHEREN LÄUFEN GELERNT)
+# ==========================================
+# Merkmale: gehashte Zeichen-n-Gramme des Dokumentanfangs (Ziffern → 0), TF-IDF, L2-normiert.
+# Modell: multinomiale logistische Regression in NumPy. Alles steckt in einer .npz-Datei mit Formatnummer.
+# Gewichte gibt es nur für Merkmale, die im Training vorkamen (sortiert in `merkmal_indizes`); die letzte
+# Zeile von idf/gewichte steht für alle übrigen (Gewicht 0) – bei 2^18 Hash-Plätzen sonst fast nur Nullen.
+
+NGRAMM_FAKTOR = np.uint64(1000003)
+ZIFFERN_ZU_NULL = str.maketrans("123456789", "000000000")
+
+def text_merkmale(text):
+    """Text → (Merkmalsindizes, Termgewichte 1 + log tf), vektorisiert über alle n-Gramme."""
+    text = " ".join(text[:MODELL_TEXT_ZEICHEN].lower().translate(ZIFFERN_ZU_NULL).split())
+    zeichen = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    hashes = []
+    for n in range(MODELL_NGRAMME[0], MODELL_NGRAMME[1] + 1):
+        anzahl = len(zeichen) - n + 1
+        if anzahl <= 0:
+            continue
+        h = np.full(anzahl, n, dtype=np.uint64)
+        for k in range(n):
+            h = h * NGRAMM_FAKTOR + zeichen[k:k + anzahl]
+        hashes.append(h)
+    if not hashes:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    h = np.concatenate(hashes)
+    h ^= h >> np.uint64(29)
+    indizes, haeufigkeit = np.unique(h % np.uint64(MODELL_MERKMALE), return_counts=True)
+    return indizes.astype(np.int64), (1.0 + np.log(haeufigkeit)).astype(np.float32)
+
+class DokumenttypModell:
+    """Gelerntes lineares Modell: Text → (Dokumenttyp, Wahrscheinlichkeit)."""
+
+    def __init__(self, klassen, merkmal_indizes, idf, gewichte, bias, info):
+        self.klassen = list(klassen)
+        self.merkmal_indizes = merkmal_indizes
+        self.idf = idf
+        self.gewichte = gewichte
+        self.bias = bias
+        self.info = info
+
+    def vorhersagen(self, text):
+        indizes, tf = text_merkmale(text)
+        if not len(indizes):
+            return None, 0.0
+        zeilen = self.zeilen(indizes)
+        werte = tf * self.idf[zeilen]
+        werte /= np.linalg.norm(werte) or 1.0
+        logits = werte @ self.gewichte[zeilen] + self.bias
+        logits = np.exp(logits - logits.max())
+        wahrscheinlichkeiten = logits / logits.sum()
+        bester = int(wahrscheinlichkeiten.argmax())
+        return self.klassen[bester], float(wahrscheinlichkeiten[bester])
+
+    def zeilen(self, indizes):
+        """Hash-Indizes → Zeilen in idf/gewichte; im Training nie gesehene Merkmale → letzte Zeile."""
+        bekannt = len(self.merkmal_indizes)
+        zeilen = np.searchsorted(self.merkmal_indizes, indizes)
+        if bekannt:
+            gefunden = self.merkmal_indizes[np.minimum(zeilen, bekannt - 1)] == indizes
+            return np.where(gefunden, zeilen, bekannt)
+        return np.full(len(indizes), bekannt)
+
+    def speichern(self, pfad):
+        # Erst in eine Nachbardatei, dann ersetzen – ein abgebrochenes Training hinterlässt kein halbes Modell
+        temp = pfad.with_suffix(".tmp")
+        with open(temp, "wb") as f:
+            np.savez_compressed(
+                f, format=np.int64(MODELL_FORMAT), klassen=np.array(self.klassen),
+                merkmal_indizes=self.merkmal_indizes, idf=self.idf,
+                gewichte=self.gewichte, bias=self.bias, ngramme=np.array(MODELL_NGRAMME),
+                merkmale=np.int64(MODELL_MERKMALE), text_zeichen=np.int64(MODELL_TEXT_ZEICHEN),
+                info=np.array(json.dumps(self.info, ensure_ascii=False)),
+            )
+        os.replace(temp, pfad)
+
+    @classmethod
+    def laden(cls, pfad):
+        if not pfad.exists():
+            return None
+        try:
+            with np.load(pfad, allow_pickle=False) as daten:
+                passend = (int(daten["format"]) == MODELL_FORMAT and int(daten["merkmale"]) == MODELL_MERKMALE
+                           and tuple(daten["ngramme"]) == MODELL_NGRAMME
+                           and int(daten["text_zeichen"]) == MODELL_TEXT_ZEICHEN)
+                if not passend:
+                    print(f"⚠️ {pfad.name} passt nicht zu den aktuellen Modell-Einstellungen – bitte neu trainieren (--modell-trainieren)")
+                    return None
+                return cls(daten["klassen"].tolist(), daten["merkmal_indizes"], daten["idf"], daten["gewichte"], daten["bias"],
+                           json.loads(str(daten["info"])))
+        except Exception as e:
+            fehlermeldung = f"Dokumenttyp-Modell konnte nicht geladen werden ({pfad.name}): {e}"
+            print(fehlermeldung)
+            VERARBEITUNGSFEHLER.append(fehlermeldung)
+            return None
+
+MODELL = None  # wird beim ersten Zugriff geladen; False = keine (passende) Modelldatei
+
+def dokumenttyp_modell():
+    global MODELL
+    if MODELL is None:
+        MODELL = DokumenttypModell.laden(MODELL_DATEI) or False
+    return MODELL or None
+
+def sammle_trainingsbeispiele():
+    """Beschriftete Dokumente aus früheren Läufen: (Pfad, Dokumenttyp).
+
+    - `*_nicht_rechnung/{typ}_{dateiname}` → Typ aus dem Präfix
+    - `*_verarbeitet/{dateiname}` → Dokumententyp aus den Gesamtausgaben, sonst "rechnung"
+    Nur Dateien, die im Protokoll (verarbeitete_dateien.sqlite) als abgeschlossen stehen, zählen.
+    """
+    protokoll = set(lade_verarbeitete_liste())
+    gesamt_typen = {}
+    for datei in sorted(basisverzeichnis.glob("artikelpositionen_ki_GESAMT_*.xlsx")):
+        try:
+            df = pd.read_excel(datei, usecols=["Dateiname", "Dokumententyp"]).dropna()
+            gesamt_typen.update(zip(df["Dateiname"], df["Dokumententyp"]))
+        except Exception as e:
+            print(f"⚠️ {datei.name} ohne Dokumententyp übersprungen: {e}")
+
+    beispiele = {}
+    for ordner in sorted(basisverzeichnis.glob("*_nicht_rechnung")):
+        for pfad in ordner.glob("*.pdf"):
+            typ, _, dateiname = pfad.name.partition("_")
+            if typ in DOKUMENTTYPEN and typ != "rechnung" and dateiname in protokoll:
+                beispiele[dateiname] = (pfad, typ)
+    for ordner in sorted(basisverzeichnis.glob("*_verarbeitet")):
+        for pfad in ordner.glob("*.pdf"):
+            typ = str(gesamt_typen.get(pfad.name, "rechnung"))
+            if pfad.name in protokoll and typ in DOKUMENTTYPEN:
+                beispiele[pfad.name] = (pfad, typ)
+    return list(beispiele.values())
+
+def trainiere_softmax(texte_merkmale, ziele, anzahl_klassen, epochen):
+    """Mini-Batch-Adam auf L2-normierten TF-IDF-Vektoren. Gibt (merkmal_indizes, idf, gewichte, bias) zurück.
+
+    Gerechnet wird nur über die Merkmale, die in den Beispielen vorkommen, plus einer leeren Zeile für alle übrigen.
+    """
+    anzahl = len(texte_merkmale)
+    laengen = np.array([len(i) for i, _ in texte_merkmale])
+    merkmal_indizes, spalten = np.unique(np.concatenate([i for i, _ in texte_merkmale]), return_inverse=True)
+    breite = len(merkmal_indizes) + 1
+    tf = np.concatenate([w for _, w in texte_merkmale])
+    dokumentfrequenz = np.bincount(spalten, minlength=breite)
+    idf = (np.log((1 + anzahl) / (1 + dokumentfrequenz)) + 1).astype(np.float32)
+    werte = tf * idf[spalten]
+    anfaenge = np.concatenate([[0], np.cumsum(laengen)])
+    zeilen = np.repeat(np.arange(anzahl), laengen)
+    werte /= np.sqrt(np.bincount(zeilen, weights=werte ** 2, minlength=anzahl))[zeilen].astype(np.float32)
+
+    # Seltene Typen zählen so viel wie häufige (sonst lernt das Modell nur "rechnung")
+    klassenanteil = np.bincount(ziele, minlength=anzahl_klassen) / anzahl
+    beispielgewicht = (1.0 / (anzahl_klassen * np.maximum(klassenanteil, 1e-9)))[ziele]
+
+    gewichte = np.zeros((breite, anzahl_klassen), dtype=np.float32)
+    bias = np.zeros(anzahl_klassen, dtype=np.float32)
+    m_w, v_w = np.zeros_like(gewichte), np.zeros_like(gewichte)
+    m_b, v_b = np.zeros_like(bias), np.zeros_like(bias)
+    zufall = np.random.default_rng(0)
+    schritt = 0
+    for _ in range(epochen):
+        for block in np.array_split(zufall.permutation(anzahl), max(1, anzahl // 64)):
+            block = np.sort(block)
+            # Einträge des Blocks zusammensuchen (Dokumente liegen zusammenhängend in spalten/werte)
+            eintraege = np.concatenate([np.arange(anfaenge[d], anfaenge[d + 1]) for d in block])
+            block_zeilen = np.repeat(np.arange(len(block)), laengen[block])
+            s, w = spalten[eintraege], werte[eintraege]
+            logits = np.stack([np.bincount(block_zeilen, weights=w * gewichte[s, k], minlength=len(block))
+                               for k in range(anzahl_klassen)], axis=1) + bias
+            logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+            fehler = logits / logits.sum(axis=1, keepdims=True)
+            fehler[np.arange(len(block)), ziele[block]] -= 1.0
+            fehler *= (beispielgewicht[block] / len(block))[:, None]
+            grad_w = np.stack([np.bincount(s, weights=w * fehler[block_zeilen, k], minlength=breite)
+                               for k in range(anzahl_klassen)], axis=1).astype(np.float32)
+            grad_w += MODELL_REGULARISIERUNG * gewichte
+            grad_b = fehler.sum(axis=0).astype(np.float32)
+            schritt += 1
+            for param, grad, m, v in ((gewichte, grad_w, m_w, v_w), (bias, grad_b, m_b, v_b)):
+                m *= 0.9
+                m += 0.1 * grad
+                v *= 0.999
+                v += 0.001 * grad * grad
+                param -= MODELL_LERNRATE * (m / (1 - 0.9 ** schritt)) / (np.sqrt(v / (1 - 0.999 ** schritt)) + 1e-8)
+    return merkmal_indizes, idf, gewichte, bias
+
+def trainiere_dokumenttyp_modell():
+    """--modell-trainieren: Beispiele einsammeln, an einem Testanteil prüfen, auf allen Daten trainieren, speichern."""
+    beispiele = sammle_trainingsbeispiele()
+    print(f"🎓 {len(beispiele)} beschriftete Dokumente gefunden – lese Textlayer …")
+    texte, typen = [], []
+    for pfad, typ in beispiele:
+        analyse = PdfAnalyse(pfad)
+        try:
+            text = extrahiere_text_aus_pdf(analyse) if analyse.hat_nutzbaren_text else ""
+        finally:
+            analyse.schliessen()
+        if text:
+            texte.append(text)
+            typen.append(typ)
+    if len(texte) < MODELL_MIN_BEISPIELE:
+        print(f"⚠️ Nur {len(texte)} Dokumente mit Textlayer (mindestens {MODELL_MIN_BEISPIELE}) – kein Modell gespeichert.")
+        return None
+    klassen = sorted(set(typen))
+    ziele = np.array([klassen.index(typ) for typ in typen])
+    merkmale = [text_merkmale(text) for text in texte]
+    print(f"🎓 Verteilung: {', '.join(f'{k} {n}' for k, n in Counter(typen).most_common())}")
+
+    # 🧪 Prüfung an zurückgehaltenen Dokumenten (IDF nur aus den Trainingsdokumenten)
+    reihenfolge = np.random.default_rng(1).permutation(len(texte))
+    test = reihenfolge[:int(len(texte) * MODELL_TESTANTEIL)]
+    training = reihenfolge[len(test):]
+    info = {"beispiele": len(texte), "verteilung": dict(Counter(typen)), "trainiert_am": datetime.now().isoformat(timespec="seconds")}
+    if len(test):
+        pruefmodell = DokumenttypModell(klassen, *trainiere_softmax(
+            [merkmale[i] for i in training], ziele[training], len(klassen), MODELL_EPOCHEN), {})
+        vorhersagen = [pruefmodell.vorhersagen(texte[i]) for i in test]
+        richtig = [typ == typen[i] for (typ, _), i in zip(vorhersagen, test)]
+        sicher = [p >= MODELL_MIN_WAHRSCHEINLICHKEIT for _, p in vorhersagen]
+        sicher_richtig = sum(r for r, s in zip(richtig, sicher) if s)
+        info.update(test_genauigkeit=sum(richtig) / len(test), test_abdeckung=sum(sicher) / len(test),
+                    test_genauigkeit_sicher=sicher_richtig / max(1, sum(sicher)))
+        print(f"🧪 Test an {len(test)} Dokumenten: {info['test_genauigkeit']:.1%} richtig; "
+              f"ab p ≥ {MODELL_MIN_WAHRSCHEINLICHKEIT} entscheidet das Modell {info['test_abdeckung']:.0%} "
+              f"der Dokumente mit {info['test_genauigkeit_sicher']:.1%} Treffern")
+
+    modell = DokumenttypModell(klassen, *trainiere_softmax(merkmale, ziele, len(klassen), MODELL_EPOCHEN), info)
+    modell.speichern(MODELL_DATEI)
+    print(f"💾 Modell gespeichert: {MODELL_DATEI.name} (Format {MODELL_FORMAT}, {len(klassen)} Typen)")
+    return modell
+
+# ==========================================
+# ⚡ GPT-LAUFZEIT (ASYNCIO, BEGRENZTE PARALLELITÄT)
+# ==========================================
+
+class GptLaufzeit:
+    """Eigener Event-Loop-Thread, auf dem alle GPT-Aufrufe (AsyncOpenAI) laufen.
+
+    Die Dokument-Pipeline läuft ebenfalls auf diesem Loop; synchroner Code (z. B. die
+    Nachbearbeitung in merge_and_enrich) reicht Koroutinen über `ausfuehren` herein.
+    Angelegt wird sie erst beim ersten GPT-Aufruf eines Laufs (`gpt_laufzeit`), `beenden` räumt am Laufende auf.
+    """
+
+    def __init__(self, parallel):
+        self.parallel = parallel
+        self.loop = asyncio.new_event_loop()
+        self._planer = None
+        self._client = None
+        self.thread = threading.Thread(target=self.loop.run_forever, name="gpt-loop", daemon=True)
+        self.thread.start()
+
+    @property
+    def planer(self):
+        # erst im Loop-Thread anlegen, damit Bedingungen/Locks an diesen Loop gebunden sind
+        if self._planer is None:
+            self._planer = AnfragePlaner(self.parallel)
+        return self._planer
+
+    @property
+    def client(self):
+        # Verbindungspool gehört zu diesem Loop; Wiederholungen übernimmt der Anfrageplaner
+        if self._client is None:
+            self._client = AsyncOpenAI(api_key=api_key, base_url=GPT_BASIS_URL, timeout=GPT_TIMEOUT,
+                                       http_client=gpt_http_client(), max_retries=0)
+        return self._client
+
+    def beenden(self):
+        """Offene Verbindungen schließen und den Loop-Thread anhalten."""
+        if self._client is not None:
+            self.ausfuehren(self._client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def starten(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def ausfuehren(self, coro):
+        return self.starten(coro).result()
+
+def parse_reset_dauer(wert):
+    # "1s", "6m0s", "120ms", "1h2m3.5s" → Sekunden (Format der x-ratelimit-reset-* Header)
+    if not wert:
+        return None
+    sekunden = 0.0
+    for zahl, einheit in re.findall(r"([\d.]+)(ms|h|m|s)", wert):
+        sekunden += float(zahl) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[einheit]
+    return sekunden
+
+class TokenEimer:
+    """Token-Bucket pro Minute: füllt sich kontinuierlich auf, `entnehmen` wartet bei Bedarf."""
+
+    def __init__(self, pro_minute):
+        self.kapazitaet = float(pro_minute)
+        self.bestand = float(pro_minute)
+        self.stand = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _auffuellen(self):
+        jetzt = time.monotonic()
+        self.bestand = min(self.kapazitaet, self.bestand + (jetzt - self.stand) * self.kapazitaet / 60)
+        self.stand = jetzt
+
+    async def entnehmen(self, menge):
+        menge = min(menge, self.kapazitaet)  # Einzelanfrage größer als das Limit: nicht ewig warten
+        async with self.lock:  # FIFO – große Anfragen werden nicht von kleinen ausgehungert
+            while True:
+                self._auffuellen()
+                if self.bestand >= menge:
+                    self.bestand -= menge
+                    return
+                await asyncio.sleep((menge - self.bestand) * 60 / self.kapazitaet)
+
+    def zurueckbuchen(self, menge):
+        # Differenz zwischen Schätzung und echter Nutzung (negativ = nachbelasten)
+        self._auffuellen()
+        self.bestand = min(self.kapazitaet, self.bestand + menge)
+
+    def abgleichen(self, limit, verbleibend):
+        # Header der API sind die Wahrheit: Kapazität übernehmen, Bestand nie höher als gemeldet
+        self._auffuellen()
+        if limit:
+            self.kapazitaet = float(limit)
+        if verbleibend is not None:
+            self.bestand = min(self.bestand, float(verbleibend))
+
+class AnfragePlaner:
+    """Zentrale Steuerung aller GPT-Anfragen.
+
+    - Token-Buckets für Anfragen/Minute und Tokens/Minute, nachgeführt aus den x-ratelimit-Headern
+    - adaptive Parallelität (AIMD): +1 nach einer Runde fehlerfreier Antworten, halbiert bei 429
+    - exponentieller Backoff mit Jitter; bei 429 pausieren alle Anfragen gemeinsam
+    - Deadline je Versuch (GPT_DEADLINES); überschrittene Versuche werden abgebrochen und wiederholt
+    - Hedging für idempotente Aufgaben: nach der p95-Latenz eine zweite Anfrage, die schnellere gewinnt
+    """
+
+    def __init__(self, parallel):
+        self.limit = parallel
+        self.aktiv = 0
+        self.bedingung = asyncio.Condition()
+        self.anfragen = TokenEimer(GPT_ANFRAGEN_PRO_MINUTE)
+        self.tokens = TokenEimer(GPT_TOKENS_PRO_MINUTE)
+        self.pause_bis = 0.0
+        self.erfolge_in_folge = 0
+        self.statistik = Counter()
+        self.stufen = Counter()    # (Aufgabe, Kennzahl) → Timeouts, Hedges, gewonnene Hedges, Anfragen
+        self.latenzen = {}         # Aufgabe → letzte Antwortzeiten (Sekunden) für die Hedge-Schwelle
+
+    async def _platz_belegen(self):
+        async with self.bedingung:
+            await self.bedingung.wait_for(lambda: self.aktiv < self.limit)
+            self.aktiv += 1
+
+    async def _platz_freigeben(self):
+        async with self.bedingung:
+            self.aktiv -= 1
+            self.bedingung.notify_all()
+
+    async def _limit_setzen(self, neu):
+        async with self.bedingung:
+            self.limit = max(GPT_PARALLEL_MIN, min(GPT_PARALLEL_MAX, neu))
+            self.bedingung.notify_all()
+
+    @staticmethod
+    async def _versuch(kwargs, stream_leser):
+        # Ein HTTP-Aufruf inkl. Stream – als Ganzes unter der Deadline, damit auch hängende Streams abbrechen
+        roh = await gpt_laufzeit().client.chat.completions.with_raw_response.create(**kwargs)
+        if stream_leser is None:
+            return roh, roh.parse()
+        return roh, await stream_leser.lesen(roh.parse())
+
+    def perzentil(self, aufgabe):
+        latenzen = sorted(self.latenzen.get(aufgabe, ()))
+        return latenzen[int(GPT_HEDGE_PERZENTIL * (len(latenzen) - 1))] if latenzen else None
+
+    def hedge_schwelle(self, aufgabe):
+        if aufgabe not in GPT_HEDGE_AUFGABEN or len(self.latenzen.get(aufgabe, ())) < GPT_HEDGE_MIN_PROBEN:
+            return None
+        if self.stufen[(aufgabe, "hedges")] >= GPT_HEDGE_MAX_ANTEIL * self.stufen[(aufgabe, "anfragen")]:
+            return None  # Budget für Zusatzanfragen aufgebraucht
+        if self.pause_bis > time.monotonic():
+            return None  # bei 429-Pause keine zusätzliche Last erzeugen
+        return self.perzentil(aufgabe)
+
+    async def ausfuehren_abgesichert(self, aufgabe, kwargs, geschaetzte_tokens, stream_leser=None):
+        """Wie `ausfuehren`, bei idempotenten Aufgaben mit Hedge: die zuerst erfolgreiche Antwort gewinnt.
+
+        Die Hedge-Uhr startet erst, wenn die erste Anfrage wirklich gesendet wurde – Wartezeit in der
+        Warteschlange des Planers löst keinen Hedge aus. Wird der Aufrufer selbst abgebrochen (z. B. durch
+        eine äußere Deadline), werden alle noch laufenden Versuche mit abgebrochen.
+        """
+        if stream_leser is not None or aufgabe not in GPT_HEDGE_AUFGABEN:
+            return await self.ausfuehren(aufgabe, kwargs, geschaetzte_tokens, stream_leser)
+        gesendet = asyncio.Event()
+        erste = asyncio.create_task(self.ausfuehren(aufgabe, kwargs, geschaetzte_tokens, gesendet=gesendet))
+        start_abwarten = asyncio.create_task(gesendet.wait())
+        offen, fehler = {erste}, None
+        try:
+            await asyncio.wait({erste, start_abwarten}, return_when=asyncio.FIRST_COMPLETED)
+            schwelle = None if erste.done() else self.hedge_schwelle(aufgabe)
+            if schwelle is None:
+                return await erste
+            fertig, _ = await asyncio.wait({erste}, timeout=schwelle)
+            if fertig:
+                return erste.result()
+            self.stufen[(aufgabe, "hedges")] += 1
+            zweite = asyncio.create_task(self.ausfuehren(aufgabe, kwargs, geschaetzte_tokens))
+            offen = {erste, zweite}
+            while offen:
+                fertig, offen = await asyncio.wait(offen, return_when=asyncio.FIRST_COMPLETED)
+                for kandidat in fertig:
+                    if kandidat.exception() is None:
+                        if kandidat is zweite:
+                            self.stufen[(aufgabe, "hedge_gewonnen")] += 1
+                        return kandidat.result()
+                    fehler = kandidat.exception()
+            raise fehler
+        finally:
+            start_abwarten.cancel()
+            for rest in offen:
+                rest.cancel()  # Verlierer abbrechen – der Platz wird im finally von `ausfuehren` frei
+
+    def _header_uebernehmen(self, headers):
+        def zahl(name):
+            wert = headers.get(name)
+            try:
+                return float(wert) if wert is not None else None
+            except ValueError:
+                return None
+        self.anfragen.abgleichen(zahl("x-ratelimit-limit-requests"), zahl("x-ratelimit-remaining-requests"))
+        self.tokens.abgleichen(zahl("x-ratelimit-limit-tokens"), zahl("x-ratelimit-remaining-tokens"))
+
+    def _wartezeit(self, versuch, fehler):
+        # Retry-After / Reset-Header der API haben Vorrang, sonst Verdopplung mit vollem Jitter
+        headers = getattr(getattr(fehler, "response", None), "headers", None) or {}
+        vorgabe = headers.get("retry-after")
+        try:
+            vorgabe = float(vorgabe) if vorgabe is not None else None
+        except ValueError:
+            vorgabe = None
+        if vorgabe is None:
+            vorgabe = max(filter(None, [
+                parse_reset_dauer(headers.get("x-ratelimit-reset-requests")) if isinstance(fehler, RateLimitError) else None,
+                parse_reset_dauer(headers.get("x-ratelimit-reset-tokens")) if isinstance(fehler, RateLimitError) else None,
+            ]), default=None)
+        obergrenze = min(GPT_BACKOFF_MAX, GPT_BACKOFF_BASIS * 2 ** versuch)
+        return (vorgabe or 0) + random.uniform(0, obergrenze)
+
+    async def ausfuehren(self, aufgabe, kwargs, geschaetzte_tokens, stream_leser=None, gesendet=None):
+        # Mit stream_leser wird gestreamt; der Platz bleibt belegt, bis der Leser den Stream verbraucht hat.
+        # `gesendet` (asyncio.Event) wird gesetzt, sobald die Anfrage tatsächlich rausgeht (nach Bucket und Platz)
+        for versuch in range(GPT_MAX_VERSUCHE):
+            warten = self.pause_bis - time.monotonic()
+            if warten > 0:
+                await asyncio.sleep(warten)
+            await self.anfragen.entnehmen(1)
+            await self.tokens.entnehmen(geschaetzte_tokens)
+            await self._platz_belegen()
+            if gesendet is not None:
+                gesendet.set()
+            fehler = None
+            start = time.monotonic()
+            try:
+                roh, response = await asyncio.wait_for(self._versuch(kwargs, stream_leser), GPT_DEADLINES.get(aufgabe))
+            except asyncio.TimeoutError as e:
+                self.stufen[(aufgabe, "timeouts")] += 1
+                fehler = e
+            except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) as e:
+                fehler = e
+            finally:
+                await self._platz_freigeben()  # Platz nicht während des Backoffs blockieren
+
+            if fehler is not None:
+                if isinstance(fehler, RateLimitError) and getattr(fehler, "code", None) == "insufficient_quota":
+                    raise fehler  # Kontingent aufgebraucht – Warten hilft nicht
+                self.statistik["429" if isinstance(fehler, RateLimitError) else "wiederholbar"] += 1
+                wartezeit = self._wartezeit(versuch, fehler)
+                if isinstance(fehler, RateLimitError):
+                    # Multiplicative Decrease + gemeinsame Pause, damit nicht alle sofort wieder anklopfen
+                    self.erfolge_in_folge = 0
+                    self.pause_bis = max(self.pause_bis, time.monotonic() + wartezeit)
+                    await self._limit_setzen(self.limit // 2)
+                if versuch == GPT_MAX_VERSUCHE - 1:
+                    raise fehler
+                self.statistik["wiederholungen"] += 1
+                grund = (f"Deadline {GPT_DEADLINES.get(aufgabe)}s überschritten" if isinstance(fehler, asyncio.TimeoutError)
+                         else type(fehler).__name__)
+                print(f"🚦 GPT {aufgabe}: {grund}, neuer Versuch in {wartezeit:.1f}s (Parallelität {self.limit})")
+                await asyncio.sleep(wartezeit)
+                continue
+
+            self._header_uebernehmen(roh.headers)
+            self.latenzen.setdefault(aufgabe, deque(maxlen=200)).append(time.monotonic() - start)
+            self.stufen[(aufgabe, "anfragen")] += 1
+            if response.usage is not None:
+                self.tokens.zurueckbuchen(geschaetzte_tokens - response.usage.total_tokens)
+                self.statistik["tokens"] += response.usage.total_tokens
+            self.statistik["anfragen"] += 1
+            # Additive Increase: nach einer vollen Runde fehlerfreier Antworten einen Platz mehr
+            self.erfolge_in_folge += 1
+            if self.erfolge_in_folge >= self.limit:
+                self.erfolge_in_folge = 0
+                await self._limit_setzen(self.limit + 1)
+            return response
+
+def schaetze_tokens(messages):
+    # Vorab-Schätzung für den Token-Bucket, wird nach der Antwort mit der echten Nutzung korrigiert
+    tokens, bilder = 0, 0
+    for nachricht in messages:
+        inhalt = nachricht["content"]
+        teile = inhalt if isinstance(inhalt, list) else [{"type": "text", "text": inhalt}]
+        for teil in teile:
+            if teil.get("type") == "image_url":
+                bilder += 1
+            else:
+                tokens += zaehle_tokens(teil.get("text", ""))
+    return tokens + bilder * GPT_TOKENS_PRO_BILD + GPT_ANTWORT_TOKENS
+
+GPT = None           # wird beim ersten GPT-Aufruf eines Laufs gestartet, laufzeit_beenden() hält sie wieder an
+PDF_EXECUTOR = None  # PyMuPDF nur aus einem Thread – ebenfalls erst bei Bedarf
+
+def gpt_laufzeit():
+    global GPT
+    if GPT is None:
+        GPT = GptLaufzeit(GPT_PARALLEL)
+    return GPT
+
+def pdf_executor():
+    global PDF_EXECUTOR
+    if PDF_EXECUTOR is None:
+        PDF_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf")
+    return PDF_EXECUTOR
+
+def laufzeit_beenden():
+    """Laufende (auch nach einem Abbruch): GPT-Loop samt Verbindungen, PDF- und Hash-Threads anhalten."""
+    global GPT, PDF_EXECUTOR, HASH_EXECUTOR
+    if GPT is not None:
+        GPT.beenden()
+    for executor in (PDF_EXECUTOR, HASH_EXECUTOR):
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    GPT = PDF_EXECUTOR = HASH_EXECUTOR = None
+
+async def pdf_arbeit(funktion, *args, **kwargs):
+    # Lokale PDF-Arbeit läuft im PDF-Thread, der Event-Loop bleibt frei für Netzwerk-Wartezeiten
+    return await asyncio.get_running_loop().run_in_executor(pdf_executor(), partial(funktion, *args, **kwargs))
+
+async def verbindungen_vorwaermen(anzahl):
+    """Öffnet `anzahl` Verbindungen (TCP + TLS) per GET /models, während der Eingangsordner noch gelesen wird.
+
+    Die Verbindungen bleiben im Pool des Laufzeit-Clients und werden von den ersten GPT-Anfragen übernommen.
+    """
+    start = time.perf_counter()
+    client = gpt_laufzeit().client
+    ergebnisse = await asyncio.gather(*(client.models.list() for _ in range(anzahl)), return_exceptions=True)
+    fehler = [e for e in ergebnisse if isinstance(e, Exception)]
+    if fehler:
+        VERARBEITUNGSFEHLER.append(f"Vorwärmen der GPT-Verbindungen: {len(fehler)}/{anzahl} fehlgeschlagen ({fehler[0]})")
+    return anzahl - len(fehler), time.perf_counter() - start
+
+def anfrage_parameter(messages, temperature=0.3, model=None, response_format=None):
+    # Vollständiger Request-Body – identisch für Live-Aufruf und Batch-Datei
+    kwargs = {"model": model or GPT_MODELLE["gross"], "messages": messages, "temperature": temperature}
+    if response_format:
+        kwargs["response_format"] = response_format
+    return kwargs
+
+def anfrage_schluessel(kwargs):
+    return hashlib.sha256(json.dumps(kwargs, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+class GptCache:
+    """Inhaltsadressierter SQLite-Cache für GPT-Antworten.
+
+    Schlüssel: Modell, Aufgabe + Prompt-Version, Temperatur, Antwortformat und ein Hash über die
+    kompletten Nachrichten (Prompt, Text bzw. Bild). Läuft nur im GPT-Loop-Thread. Treffer sind reine
+    Lesezugriffe – ihre Zugriffszeit wird gesammelt und gruppenweise geschrieben. Alter und Größe werden
+    beim Öffnen, beim Überschreiten der Größengrenze im Lauf und am Laufende (`abschliessen`) geprüft.
+    """
+
+    def __init__(self, pfad):
+        self.pfad = pfad
+        self._db = None
+        self.groesse = 0            # Bytes aller Antworten (Stand nach dem letzten Aufräumen + Neuzugänge)
+        self.zugriffe = {}          # Schlüssel → Zeitpunkt des letzten Treffers, noch nicht geschrieben
+        self.statistik = Counter()
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.pfad, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS antworten (schluessel TEXT PRIMARY KEY, aufgabe TEXT, modell TEXT, "
+                "antwort TEXT, groesse INTEGER, erstellt REAL, zuletzt REAL)"
+            )
+            self.aufraeumen()
+        return self._db
+
+    @staticmethod
+    def schluessel(aufgabe, kwargs):
+        return hashlib.sha256(json.dumps({
+            "modell": kwargs["model"],
+            "aufgabe": aufgabe,
+            "version": PROMPT_VERSIONEN.get(aufgabe, 1),
+            "temperatur": kwargs["temperature"],
+            "format": kwargs.get("response_format"),
+            "nutzdaten": anfrage_schluessel({"messages": kwargs["messages"]}),
+        }, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def lesen(self, schluessel):
+        zeile = self.db.execute("SELECT antwort FROM antworten WHERE schluessel = ?", (schluessel,)).fetchone()
+        if zeile is None:
+            self.statistik["fehlschlaege"] += 1
+            return None
+        self.zugriffe[schluessel] = time.time()
+        if len(self.zugriffe) >= GPT_CACHE_ZUGRIFFE_GRUPPE:
+            self.zugriffe_schreiben()
+        self.statistik["treffer"] += 1
+        return zeile[0]
+
+    def zugriffe_schreiben(self):
+        if not self.zugriffe or self._db is None:
+            return
+        with self._db:
+            self._db.executemany("UPDATE antworten SET zuletzt = ? WHERE schluessel = ?",
+                                 [(zeit, schluessel) for schluessel, zeit in self.zugriffe.items()])
+        self.zugriffe.clear()
+
+    def schreiben(self, schluessel, aufgabe, modell, antwort):
+        jetzt = time.time()
+        groesse = len(antwort.encode("utf-8"))
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO antworten VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (schluessel, aufgabe, modell, antwort, groesse, jetzt, jetzt),
+            )
+        self.groesse += groesse
+        if self.groesse > GPT_CACHE_MAX_MB * 1024 * 1024:
+            self.aufraeumen()  # im Lauf nur, wenn die Grenze wirklich überschritten ist
+
+    def aufraeumen(self):
+        # Alter zuerst, danach die am längsten nicht genutzten Einträge bis unter die Größengrenze
+        self.zugriffe_schreiben()
+        with self._db:
+            geloescht = self._db.execute(
+                "DELETE FROM antworten WHERE erstellt < ?", (time.time() - GPT_CACHE_MAX_TAGE * 86400,)
+            ).rowcount
+            groesse = self._db.execute("SELECT COALESCE(SUM(groesse), 0) FROM antworten").fetchone()[0]
+            grenze = GPT_CACHE_MAX_MB * 1024 * 1024
+            if groesse > grenze:
+                for schluessel, eintrag in self._db.execute(
+                        "SELECT schluessel, groesse FROM antworten ORDER BY zuletzt").fetchall():
+                    if groesse <= grenze:
+                        break
+                    self._db.execute("DELETE FROM antworten WHERE schluessel = ?", (schluessel,))
+                    groesse -= eintrag
+                    geloescht += 1
+        self.groesse = groesse
+        self.statistik["verdraengt"] += geloescht
+
+    def abschliessen(self):
+        # Laufende: gesammelte Zugriffszeiten schreiben und nach Alter/Größe aufräumen
+        if self._db is not None:
+            self.aufraeumen()
+
+GPT_CACHE = GptCache(GPT_CACHE_DATEI)
+
+def modell_stufen(aufgabe):
+    return [(stufe, GPT_MODELLE[stufe]) for stufe in GPT_MODELL_STUFEN.get(aufgabe, ["gross"])]
+
+def normiere_dokumenttyp(antwort):
+    # Modelle antworten gern mit "Rechnung." oder "**rechnung**" statt des nackten Begriffs
+    return antwort.strip().strip("*.\"' ").lower()
+
+def _ist_zahl(antwort):
+    try:
+        float(antwort)
+        return True
+    except ValueError:
+        return False
+
+def _ist_dokumenttyp(antwort):
+    return normiere_dokumenttyp(antwort) in DOKUMENTTYPEN
+
+def _ist_json_objekt(antwort):
+    return _lade_json_objekt(antwort) is not None
+
+def _ist_kategorie_csv(antwort):
+    return any(zeile.count(";") >= 2 for zeile in antwort.splitlines())
+
+def _ist_inhalt(antwort):
+    return _ist_json_objekt(antwort) if GPT_STRUKTURIERTE_AUSGABE else len(antwort) >= 50
+
+# Prüfung je Aufgabe: besteht die Antwort nicht, geht dieselbe Anfrage an die nächste Modell-Stufe
+ANTWORT_PRUEFUNGEN = {
+    "klassifikation": _ist_dokumenttyp,
+    "zahl": _ist_zahl,
+    "kategorie": _ist_kategorie_csv,
+    "ocr": lambda antwort: bool(antwort.strip()),
+    "inhalt": _ist_inhalt,
+    "kombi": _ist_json_objekt,
+}
+
+ABLEHNUNGS_MUSTER = re.compile(r"^(fehler|es tut mir leid|leider kann|ich kann (hier )?nicht|i'?m sorry|i can'?t|sorry)",
+                               re.IGNORECASE)
+
+class StreamZeilenParser:
+    """Zerlegt eine gestreamte Antwort in fertige Zeilen, sobald sie vollständig angekommen sind.
+
+    JSON-Modus: jedes abgeschlossene Objekt im Array "positionen" (per raw_decode ab der letzten Stelle).
+    Textmodus: jede abgeschlossene Zeile.
+    """
+
+    DECODER = json.JSONDecoder()
+
+    def __init__(self, json_modus):
+        self.json_modus = json_modus
+        self.puffer = ""
+        self.stelle = None  # JSON: Index hinter "[" bzw. hinter dem letzten gelesenen Objekt
+
+    def fuettern(self, stueck):
+        self.puffer += stueck
+        if not self.json_modus:
+            *fertig, self.puffer = self.puffer.split("\n")
+            return [zeile for zeile in fertig if zeile.strip()]
+        if self.stelle is None:
+            treffer = re.search(r'"positionen"\s*:\s*\[', self.puffer)
+            if treffer is None:
+                return []
+            self.stelle = treffer.end()
+        elif "}" not in stueck:
+            return []  # kein Objekt kann fertig geworden sein
+        neu = []
+        while True:
+            while self.stelle < len(self.puffer) and self.puffer[self.stelle] in " \t\r\n,":
+                self.stelle += 1
+            if self.stelle >= len(self.puffer) or self.puffer[self.stelle] == "]":
+                return neu
+            try:
+                objekt, self.stelle = self.DECODER.raw_decode(self.puffer, self.stelle)
+            except json.JSONDecodeError:
+                return neu  # Objekt noch unvollständig
+            neu.append(objekt)
+
+class StreamLeser:
+    """Verbraucht einen Chat-Completion-Stream und baut daraus die fertige Antwort.
+
+    - meldet jede fertige Position sofort an `bei_zeile`
+    - bricht ab, sobald der Antwortanfang einen Fehler oder eine Ablehnung zeigt
+    - kombinierte Abfrage: steht der Dokumenttyp fest und ist keine Rechnung, wird der Rest nicht abgewartet
+    """
+
+    def __init__(self, aufgabe, json_modus, bei_zeile=None):
+        self.aufgabe = aufgabe
+        self.json_modus = json_modus
+        self.bei_zeile = bei_zeile
+        self._zuruecksetzen()
+
+    def _zuruecksetzen(self):
+        self.parser = StreamZeilenParser(self.json_modus)
+        self.teile, self.abbruch, self.ersetzt, self.usage = [], None, None, None
+
+    @property
+    def antwort(self):
+        return self.ersetzt or "".join(self.teile)
+
+    def _anfang_pruefen(self, text):
+        # → (entschieden, Abbruchgrund | None)
+        anfang = text.lstrip()
+        if self.json_modus:
+            return (True, None if anfang.startswith("{") else "kein_json") if anfang else (False, None)
+        if len(anfang) < STREAM_PRUEFZEICHEN and "\n" not in anfang:
+            return False, None
+        return True, "fehler" if ABLEHNUNGS_MUSTER.match(anfang) else None
+
+    def _dokumenttyp_pruefen(self, text):
+        # → (noch offen, Abbruchgrund | None)
+        treffer = re.search(r'"dokumenttyp"\s*:\s*"([^"]*)"', text)
+        if treffer is None:
+            return '"kopfdaten"' not in text, None
+        if treffer.group(1) == "rechnung":
+            return False, None
+        self.ersetzt = json.dumps({"dokumenttyp": treffer.group(1), "kopfdaten": {}, "positionen": []})
+        return False, "nicht_rechnung"
+
+    async def lesen(self, stream):
+        self._zuruecksetzen()  # bei einem Wiederholungsversuch des Planers beginnt alles von vorn
+        start = time.perf_counter()
+        anfang_offen, typ_offen, zeilen = True, self.aufgabe == "kombi", 0
+        async for chunk in stream:
+            if chunk.usage is not None:
+                self.usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if getattr(delta, "refusal", None):
+                self.abbruch = "ablehnung"
+                break
+            if not delta.content:
+                continue
+            self.teile.append(delta.content)
+            if anfang_offen or typ_offen:
+                text = "".join(self.teile)
+                if anfang_offen:
+                    entschieden, self.abbruch = self._anfang_pruefen(text)
+                    anfang_offen = not entschieden
+                if typ_offen and not self.abbruch:
+                    typ_offen, self.abbruch = self._dokumenttyp_pruefen(text)
+                if self.abbruch:
+                    break
+            for zeile in self.parser.fuettern(delta.content):
+                zeilen += 1
+                if zeilen == 1:
+                    STREAM_STATISTIK["erste_zeile_sekunden"] += time.perf_counter() - start
+                    STREAM_STATISTIK["mit_zeilen"] += 1
+                if self.bei_zeile:
+                    self.bei_zeile(zeile)
+        if self.abbruch:
+            await stream.close()  # Verbindung schließen → keine weiteren Ausgabe-Tokens
+            STREAM_STATISTIK[f"abbruch_{self.abbruch}"] += 1
+        STREAM_STATISTIK["gestreamt"] += 1
+        STREAM_STATISTIK["zeilen"] += zeilen
+        STREAM_STATISTIK["gesamt_sekunden"] += time.perf_counter() - start
+        return self
+
+async def _gpt_einzelanfrage(aufgabe, stufe, kwargs, bei_zeile=None):
+    if BATCH_ANTWORTEN:
+        # 🗂️ Batch-Modus: vorab per Batch-API beantwortete Anfragen nicht erneut live senden
+        antwort = BATCH_ANTWORTEN.get(anfrage_schluessel(kwargs))
+        if antwort is not None:
+            BATCH_STATISTIK["genutzt"] += 1
+            return antwort
+        BATCH_STATISTIK["live"] += 1
+    if GPT_CACHE_AKTIV:
+        cache_schluessel = GptCache.schluessel(aufgabe, kwargs)
+        antwort = GPT_CACHE.lesen(cache_schluessel)
+        if antwort is not None:
+            return antwort
+    start = time.perf_counter()
+    leser = None
+    if GPT_STREAMING and aufgabe in GPT_STREAM_AUFGABEN:
+        leser = StreamLeser(aufgabe, bool(kwargs.get("response_format")), bei_zeile)
+        kwargs = {**kwargs, "stream": True, "stream_options": {"include_usage": True}}
+    response = await gpt_laufzeit().planer.ausfuehren_abgesichert(aufgabe, kwargs, schaetze_tokens(kwargs["messages"]), leser)
+    ROUTING_STATISTIK[(stufe, "live")] += 1
+    ROUTING_STATISTIK[(stufe, "sekunden")] += time.perf_counter() - start
+    # Ablehnungen kommen ohne content
+    antwort = (leser.antwort if leser is not None else response.choices[0].message.content or "").strip()
+    if leser is not None and leser.abbruch and not leser.ersetzt:
+        return antwort  # abgebrochene Antwort nicht cachen
+    if GPT_CACHE_AKTIV and antwort:
+        GPT_CACHE.schreiben(cache_schluessel, aufgabe, kwargs["model"], antwort)
+    return antwort
+
+async def gpt_anfrage(aufgabe, messages, temperature=0.3, model=None, response_format=None, bei_zeile=None):
+    """Zentraler GPT-Aufruf – alle Hilfsfunktionen gehen hier durch (Rate-Limits, Backoff, Parallelität).
+
+    Ohne festes Modell wird über GPT_MODELL_STUFEN geroutet: Die Anfrage geht zuerst an die günstige
+    Stufe und nur dann an die nächste, wenn die Antwort die Prüfung der Aufgabe nicht besteht.
+    Die Antwort der letzten Stufe wird in jedem Fall zurückgegeben. `bei_zeile` erhält bei gestreamten
+    Aufgaben jede fertige Position, sobald sie angekommen ist.
+    """
+    stufen = [("fest", model)] if model else modell_stufen(aufgabe)
+    pruefung = ANTWORT_PRUEFUNGEN.get(aufgabe)
+    for nummer, (stufe, modell) in enumerate(stufen, 1):
+        kwargs = anfrage_parameter(messages, temperature, modell, response_format)
+        antwort = await _gpt_einzelanfrage(aufgabe, stufe, kwargs, bei_zeile)
+        ROUTING_STATISTIK[(stufe, "antworten")] += 1
+        if pruefung is None or pruefung(antwort):
+            ROUTING_STATISTIK[(stufe, "gueltig")] += 1
+            return antwort
+        if nummer < len(stufen):
+            ROUTING_STATISTIK[(stufe, "eskaliert")] += 1
+    return antwort
+
+# ==========================================
+# ✂️ TOKEN-BUDGET (TEXTAUSWAHL FÜR GPT)
+# ==========================================
+
+_TOKENIZER = None
+WORTSTUECKE = re.compile(r"\w+|[^\w\s]")
+
+def tokenizer():
+    # tiktoken lädt die Kodierung beim ersten Aufruf (ggf. aus dem Netz) – danach bleibt sie im Speicher.
+    # Ohne exakte Zählung stimmen Budgets und Token-Buckets nicht: Abbruch, außer die Schätzung ist gewollt
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        kodierung, grund = None, "tiktoken ist nicht installiert"
+        if tiktoken is not None:
+            try:
+                kodierung = tiktoken.get_encoding(GPT_TOKENIZER)
+            except Exception as e:
+                grund = f"Tokenizer '{GPT_TOKENIZER}' nicht verfügbar: {e}"
+        if kodierung is None:
+            if not GPT_TOKEN_SCHAETZUNG:
+                raise RuntimeError(f"{grund} – bitte `pip install -r requirements.txt` ausführen "
+                                   "oder GPT_TOKEN_SCHAETZUNG = True setzen, um mit geschätzten Tokens zu arbeiten")
+            print(f"⚠️ {grund} – das Token-Budget arbeitet mit einer Schätzung (GPT_TOKEN_SCHAETZUNG)")
+            VERARBEITUNGSFEHLER.append(f"Token-Zählung geschätzt: {grund}")
+        _TOKENIZER = kodierung or False
+    return _TOKENIZER
+
+def pruefe_tokenizer():
+    # ✂️ Vor dem ersten Dokument prüfen – nicht erst mitten im Lauf an der ersten GPT-Anfrage scheitern
+    try:
+        tokenizer()
+    except RuntimeError as e:
+        print(f"❌ Kritischer Fehler: {e}")
+        sys.exit(1)
+
+def zaehle_tokens(text):
+    if not text:
+        return 0
+    kodierung = tokenizer()
+    if kodierung:
+        return len(kodierung.encode(text, disallowed_special=()))
+    # Schätzung ohne tiktoken (nur mit GPT_TOKEN_SCHAETZUNG): jedes Wort/Satzzeichen mind. ein Token,
+    # lange Wörter zerfallen in mehrere – großzügig, weil deutsche Komposita und Zahlen teuer sind
+    return sum(1 + len(stueck) // 4 for stueck in WORTSTUECKE.findall(text))
+
+# Segmentarten und ihr Gewicht je Aufgabe (höher = wird zuerst ins Budget gepackt)
+TEXTSEGMENT_PRIORITAET = {
+    "klassifikation": {"kopf": 3, "summen": 2, "tabelle": 1, "text": 1, "ballast": 0},
+    "inhalt": {"kopf": 3, "tabelle": 3, "summen": 3, "text": 1, "ballast": 0},
+}
+BALLAST_MUSTER = re.compile(
+    r"\b(iban|bic|swift|bankverbindung|kontonummer|blz|amtsgericht|registergericht|hr[ab]\d*|geschäftsführ\w*|"
+    r"gerichtsstand|agb|allgemeinen? geschäftsbedingungen|eigentumsvorbehalt|datenschutz\w*|"
+    r"tel|telefon|telefax|fax|e-mail|seite \d+ von \d+)\b|www\.|^\d+/\d+$",
+    re.IGNORECASE,
+)
+SUMMEN_MUSTER = re.compile(
+    r"summe|netto|brutto|gesamt|total|zu zahlen|rechnungsbetrag|zahlbetrag|endbetrag|übertrag|mwst|\bust\b|"
+    r"umsatzsteuer|zahlbar|skonto|abschlag",
+    re.IGNORECASE,
+)
+BETRAG_MUSTER = re.compile(r"-?\d[\d.]*,\d{2}\b|-?\d+\.\d{2}\b")
+
+def segmentiere_text(zeilen):
+    """Ordnet jeder Zeile eine Segmentart zu: kopf, tabelle, summen, ballast oder text."""
+    betraege = [bool(BETRAG_MUSTER.search(zeile)) for zeile in zeilen]
+    arten, gesehen = [], set()
+    for i, zeile in enumerate(zeilen):
+        fenster = sum(betraege[max(0, i - TEXT_TABELLEN_FENSTER):i + TEXT_TABELLEN_FENSTER + 1])
+        # Summenbegriff und Betrag stehen je nach PDF in derselben oder in der folgenden Zeile
+        summe_hier = SUMMEN_MUSTER.search(zeile) and (betraege[i] or betraege[i + 1:i + 2] == [True])
+        summe_davor = betraege[i] and i > 0 and arten[i - 1] == "summen"
+        if BALLAST_MUSTER.search(zeile):
+            art = "ballast"
+        elif summe_hier or summe_davor:
+            art = "summen"
+        elif i < TEXT_KOPF_ZEILEN:
+            art = "kopf"
+        elif fenster >= TEXT_TABELLEN_MIN_BETRAEGE:
+            art = "tabelle"
+        else:
+            art = "text"
+        # Briefkopf/Fußzeile wiederholt sich auf jeder Seite – Positionen und Beträge dürfen sich wiederholen
+        if art != "tabelle" and not betraege[i]:
+            if zeile in gesehen:
+                art = "ballast"
+            gesehen.add(zeile)
+        arten.append(art)
+    return arten
+
+def waehle_text(text, aufgabe):
+    """Packt die für die Aufgabe wichtigsten Textzeilen in das Token-Budget (Reihenfolge bleibt erhalten)."""
+    budget = GPT_TOKEN_BUDGET[aufgabe]
+    gesamt = zaehle_tokens(text)
+    if gesamt <= budget:
+        return text
+
+    zeilen = [zeile.strip() for zeile in text.splitlines() if zeile.strip()]
+    arten = segmentiere_text(zeilen)
+    gewichte = TEXTSEGMENT_PRIORITAET.get(aufgabe, TEXTSEGMENT_PRIORITAET["inhalt"])
+    reihenfolge = sorted(range(len(zeilen)), key=lambda i: (-gewichte[arten[i]], i))
+
+    gewaehlt, verbraucht = set(), 0
+    for i in reihenfolge:
+        kosten = zaehle_tokens(zeilen[i]) + 1  # + Zeilenumbruch
+        if verbraucht + kosten > budget:
+            continue  # eine lange Zeile sperrt nicht die kürzeren dahinter
+        gewaehlt.add(i)
+        verbraucht += kosten
+
+    teile, letzte = [], -1
+    for i in sorted(gewaehlt):
+        if i != letzte + 1:
+            teile.append("[…]")  # ausgelassene Zeilen kenntlich machen
+        teile.append(zeilen[i])
+        letzte = i
+    if letzte != len(zeilen) - 1:
+        teile.append("[…]")
+
+    TEXTAUSWAHL_STATISTIK["gekuerzt"] += 1
+    TEXTAUSWAHL_STATISTIK["tokens_vorher"] += gesamt
+    TEXTAUSWAHL_STATISTIK["tokens_nachher"] += verbraucht
+    return "\n".join(teile)
+
 # ==========================================
 # 🧠 GPT-FUNKTIONEN (OCR, KLASSIFIKATION, INHALT)
 # ==========================================
 
-def gpt_klassifikation(text_path=None, image_b64=None):
+def baue_klassifikations_anfrage(text=None, image_b64=None):
     if image_b64:
         prompt = (
-            "Du erhältst ein Bild eines Geschäftsdokuments (z. B. Rechnung, Gutschrift, Anschreiben, Mahnung).\n"
+            "Du erhältst ein Bild eines Geschäftsdokuments (z. B. Rechnung, Gutschrift, Anschreiben, Mahnung).\n"
             "Bitte klassifiziere das Dokument eindeutig anhand typischer Begriffe oder Layoutstruktur.\n\n"
             "Typen zur Auswahl:\n"
-            "- rechnung (z. B. 'Rechnung', 'Rechnungsnummer', 'Zahlbetrag', 'USt.')\n"
-            "- gutschrift (z. B. 'Gutschrift', 'Rechnungskorrektur', 'Erstattung')\n"
-            "- mahnung (z. B. 'Mahnung', 'letzte Erinnerung')\n"
+            "- rechnung (z. B. 'Rechnung', 'Rechnungsnummer', 'Zahlbetrag', 'USt.')\n"
+            "- gutschrift (z. B. 'Gutschrift', 'Rechnungskorrektur', 'Erstattung')\n"
+            "- mahnung (z. B. 'Mahnung', 'letzte Erinnerung')\n"
             "- zahlungserinnerung\n"
             "- anschreiben\n"
             "- email\n"
@@ -234,49 +2374,42 @@ def gpt_klassifikation(text_path=None, image_b64=None):
             "role": "user",
             "content": [
                 {"type": "text", "text": prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}
+                {"type": "image_url", "image_url": {"url": bild_data_url(image_b64)}}
             ]
         }]
-    elif text_path:
-        try:
-            doc = fitz.open(text_path)
-            extracted_text = "\n".join([page.get_text() for page in doc])
-        except Exception as e:
-            fehlermeldung = f"❌ Fehler beim Öffnen/Lesen von PDF ({text_path}): {e}"
-            print(fehlermeldung)
-            VERARBEITUNGSFEHLER.append(fehlermeldung)
-            return "unlesbar"
-
+    elif text:
         prompt = (
             "Analysiere den folgenden extrahierten Text eines Geschäftsdokuments und gib **genau einen** der folgenden Dokumenttypen zurück:\n\n"
-            "- rechnung (z. B. mit 'Rechnung', 'Rechnungsnummer', 'USt.', 'Zahlbetrag')\n"
-            "- gutschrift (z. B. mit 'Gutschrift', 'Rechnungskorrektur', 'Erstattung')\n"
+            "- rechnung (z. B. mit 'Rechnung', 'Rechnungsnummer', 'USt.', 'Zahlbetrag')\n"
+            "- gutschrift (z. B. mit 'Gutschrift', 'Rechnungskorrektur', 'Erstattung')\n"
             "- mahnung\n- zahlungserinnerung\n- anschreiben\n- email\n- behördlich\n- sonstiges\n\n"
             "Wenn der Text mehrere Begriffe enthält, wähle den eindeutigsten und plausibelsten Typ.\n"
             "Antwort nur mit dem Begriff.\n\n"
-            f"{extracted_text[:3000]}"
+            f"{waehle_text(text, 'klassifikation')}"
         )
         messages = [{"role": "user", "content": prompt}]
     else:
-        fehlermeldung = "gpt_klassifikation: Kein text_path oder image_b64 übergeben."
+        return None
+    return messages
+
+async def gpt_klassifikation(text=None, image_b64=None):
+    messages = baue_klassifikations_anfrage(text=text, image_b64=image_b64)
+    if messages is None:
+        fehlermeldung = "gpt_klassifikation: Kein Text oder image_b64 übergeben."
         print(fehlermeldung)
         VERARBEITUNGSFEHLER.append(fehlermeldung)
         return "fehler"
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        return response.choices[0].message.content.strip().lower()
+        antwort = await gpt_anfrage("klassifikation", messages)
+        return normiere_dokumenttyp(antwort)
     except Exception as e:
         fehlermeldung = f"Fehler bei Klassifikation durch GPT: {e}"
         print(fehlermeldung)
         VERARBEITUNGSFEHLER.append(fehlermeldung)
         return "unbekannt"
 
-def korrigiere_zahl_mit_gpt(wert):
+async def korrigiere_zahl_mit_gpt(wert):
     prompt = f"""
     Korrigiere folgende fehlerhafte Zahl so, dass sie maschinenlesbar als float verwendet werden kann:
     Gib nur die Zahl im Format 1234.56 zurück (kein Eurozeichen, kein Text).
@@ -284,47 +2417,67 @@ def korrigiere_zahl_mit_gpt(wert):
     Wert: {wert}
     """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        result = response.choices[0].message.content.strip()
+        result = await gpt_anfrage("zahl", [{"role": "user", "content": prompt}])
         return float(result)
     except Exception as e:
         VERARBEITUNGSFEHLER.append(f"GPT-Zahlenkorrektur fehlgeschlagen für '{wert}': {e}")
         return None
 
-def gpt_abfrage_ocr_text(b64_image):
+async def korrigiere_zahlen_mit_gpt(werte):
+    return await asyncio.gather(*(korrigiere_zahl_mit_gpt(wert) for wert in werte))
+
+def baue_ocr_anfrage(b64_image):
     prompt = (
         "Analysiere das folgende Bild einer Rechnung.\n"
         "Auch wenn die Darstellung undeutlich ist, versuche so viel strukturierten Text wie möglich zu extrahieren.\n"
         "Ignoriere Layout-Fehler, Trennzeichen oder Formatierung – gib nur den vermutlichen reinen Rechnungstext wieder."
     )
 
-    messages = [{
+    return [{
         "role": "user",
         "content": [
             {"type": "text", "text": prompt},
-            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_image}"}}
+            {"type": "image_url", "image_url": {"url": bild_data_url(b64_image)}}
         ]
     }]
 
+async def gpt_abfrage_ocr_text(b64_image):
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        return response.choices[0].message.content.strip()
+        return await gpt_anfrage("ocr", baue_ocr_anfrage(b64_image))
     except Exception as e:
         fehlermeldung = f"Fehler bei GPT-OCR: {e}"
         print(fehlermeldung)
         VERARBEITUNGSFEHLER.append(fehlermeldung)
         return ""
 
-def gpt_abfrage_inhalt(text=None, b64_image=None):
-    prompt = (
+def rendere_schlechte_seiten(analyse):
+    # Mischdokumente: Seiten ohne brauchbaren Textlayer gehen später an GPT-OCR (höchstens OCR_MAX_ZUSATZSEITEN)
+    bilder = {}
+    for nummer in analyse.ocr_kandidaten(OCR_MAX_ZUSATZSEITEN):
+        try:
+            bilder[nummer] = rendere_seite_base64(analyse, seite=nummer)
+        except Exception as e:
+            VERARBEITUNGSFEHLER.append(f"Seite {nummer + 1} konnte nicht gerendert werden ({analyse.pfad}): {e}")
+    return bilder
+
+def melde_ausgelassene_seiten(dok):
+    # Seiten über der OCR-Grenze (oder nicht renderbar) fehlen im Rechnungstext – nicht stillschweigend verlieren
+    fehlend = sicher_ausführen(dok.analyse.seiten_ohne_text, "Seitenprüfung", dok.seitenbilder) or []
+    if fehlend:
+        seiten = ", ".join(str(nummer + 1) for nummer in fehlend)
+        dok.log(f"⚠️ {len(fehlend)} Seite(n) ohne Textlayer nicht per OCR ergänzt (Grenze {OCR_MAX_ZUSATZSEITEN}): {seiten}")
+        VERARBEITUNGSFEHLER.append(f"Seiten ohne Text ausgelassen ({dok.dateiname}): {seiten}")
+        dok.zaehler.add("seiten_ausgelassen")
+
+async def ergaenze_schlechte_seiten_per_ocr(analyse, seitenbilder):
+    texte = await asyncio.gather(*(gpt_abfrage_ocr_text(b64) for b64 in seitenbilder.values()))
+    for nummer, ocr_text in zip(seitenbilder, texte):
+        if ocr_text.strip():
+            analyse.ocr_texte[nummer] = ocr_text
+    return f"🔠 Mischdokument: {len(analyse.ocr_texte)}/{len(seitenbilder)} Seite(n) ohne Textlayer per GPT-OCR ergänzt"
+
+def baue_inhalts_anfrage(text=None, b64_image=None):
+    prompt = INHALT_PROMPT_STRUKTURIERT if GPT_STRUKTURIERTE_AUSGABE else (
         "Extrahiere so viele Informationen wie möglich aus dieser Rechnung.\n"
         "Gib alle Artikelpositionen und Metadaten wie Lieferant, Empfänger, Rechnungsnummer, Datum etc. im freien Klartext aus.\n"
         "Es ist nicht notwendig, eine Tabelle oder CSV zu erstellen.\n"
@@ -335,23 +2488,98 @@ def gpt_abfrage_inhalt(text=None, b64_image=None):
     messages = [{"role": "user", "content": [{"type": "text", "text": prompt}]}]
 
     if b64_image:
-        messages[0]["content"].append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_image}"}})
+        messages[0]["content"].append({"type": "image_url", "image_url": {"url": bild_data_url(b64_image)}})
     elif text:
-        messages[0]["content"].append({"type": "text", "text": text[:4000]})
+        messages[0]["content"].append({"type": "text", "text": waehle_text(text, "inhalt")})
+    return messages
 
+async def gpt_abfrage_inhalt(text=None, b64_image=None, bei_zeile=None):
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        return response.choices[0].message.content.strip()
+        return await gpt_anfrage("inhalt", baue_inhalts_anfrage(text=text, b64_image=b64_image),
+                                 bei_zeile=bei_zeile, **INHALT_PARAMETER)
     except Exception as e:
         fehlermeldung = f"Fehler bei GPT-Inhaltsextraktion: {e}"
         print(fehlermeldung)
         VERARBEITUNGSFEHLER.append(fehlermeldung)
         return ""
 
+# ==========================================
+# 🧱 STRUKTURIERTE AUSGABE: PRÜFUNG DER ANTWORT
+# ==========================================
+
+def _json_zahl(wert):
+    return float(wert) if isinstance(wert, (int, float)) and not isinstance(wert, bool) else None
+
+def _json_text(wert):
+    return (wert.strip() or None) if isinstance(wert, str) else None
+
+def validiere_rechnungsdaten(daten, dateiname):
+    """Schema-konformes Dict → DataFrame mit typisierten Spalten (ohne Textheuristik). None, wenn keine Positionen."""
+    kopf = daten.get("kopfdaten") if isinstance(daten.get("kopfdaten"), dict) else {}
+    positionen = daten.get("positionen") if isinstance(daten.get("positionen"), list) else []
+    zeilen = [
+        {
+            "Artikelbezeichnung": _json_text(pos.get("artikelbezeichnung")) or "",
+            "Menge": _json_zahl(pos.get("menge")),
+            "Einheit": _json_text(pos.get("einheit")),
+            "Einzelpreis": _json_zahl(pos.get("einzelpreis")),
+            "Gesamtpreis": _json_zahl(pos.get("gesamtpreis")),
+        }
+        for pos in positionen if isinstance(pos, dict)
+    ]
+    if not zeilen:
+        return None
+    df = pd.DataFrame(zeilen).astype({"Menge": "float64", "Einzelpreis": "float64", "Gesamtpreis": "float64"})
+    df["Lieferant"] = _json_text(kopf.get("lieferant"))
+    df["USt_IdNr"] = _json_text(kopf.get("ust_idnr"))
+    df["Rechnungsempfänger"] = _json_text(kopf.get("rechnungsempfaenger"))
+    df["Rechnungsnummer"] = _json_text(kopf.get("rechnungsnummer"))
+    df["Rechnungsdatum"] = _json_text(kopf.get("rechnungsdatum"))
+    df["Gesamtbetrag"] = _json_zahl(kopf.get("gesamtbetrag"))
+    df["Dateiname"] = dateiname
+    return df
+
+def _lade_json_objekt(antwort):
+    try:
+        daten = json.loads(antwort)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    return daten if isinstance(daten, dict) else None
+
+def lese_strukturierte_antwort(antwort, dateiname):
+    """JSON der Inhaltsabfrage → DataFrame | None."""
+    daten = _lade_json_objekt(antwort)
+    return validiere_rechnungsdaten(daten, dateiname) if daten is not None else None
+
+def baue_kombi_anfrage(text=None, b64_image=None):
+    # Nachrichten für die kombinierte Abfrage – auch vom Batch-Modus wiederverwendet
+    inhalt = [{"type": "text", "text": KOMBI_PROMPT}]
+    if b64_image:
+        inhalt.append({"type": "image_url", "image_url": {"url": bild_data_url(b64_image)}})
+    elif text:
+        inhalt.append({"type": "text", "text": waehle_text(text, "kombi")})
+    return [{"role": "user", "content": inhalt}]
+
+def lese_kombi_antwort(antwort, dateiname):
+    """JSON der kombinierten Abfrage → (Dokumenttyp, DataFrame | None). None bei unlesbarer Antwort."""
+    daten = _lade_json_objekt(antwort)
+    if daten is None:
+        return None
+    dokumenttyp = daten.get("dokumenttyp")
+    dokumenttyp = dokumenttyp if dokumenttyp in DOKUMENTTYPEN else "sonstiges"
+    return dokumenttyp, validiere_rechnungsdaten(daten, dateiname)
+
+async def gpt_kombi_abfrage(text=None, b64_image=None, bei_zeile=None):
+    # Ein Aufruf statt Klassifikation + OCR + Inhalt – Text bzw. Bild wird nur einmal hochgeladen
+    try:
+        return await gpt_anfrage("kombi", baue_kombi_anfrage(text=text, b64_image=b64_image),
+                                 bei_zeile=bei_zeile, **KOMBI_PARAMETER)
+    except Exception as e:
+        fehlermeldung = f"Fehler bei kombinierter GPT-Abfrage: {e}"
+        print(fehlermeldung)
+        VERARBEITUNGSFEHLER.append(fehlermeldung)
+        return ""
+
 def kategorisiere_artikel_global(df):
     print("🧠 Starte globale Artikel-Kategorisierung mit GPT und Log-Wiederverwendung …")
 
@@ -402,14 +2630,7 @@ def kategorisiere_artikel_global(df):
             "\n".join(gpt_df["Artikelbezeichnung"])
         )
         try:
-           # ✅ NEU – Kompatibel mit openai>=1.0.0 (Client-Instanz verwenden)
-            client = OpenAI()
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.3
-            )
-            antwort = response['choices'][0]['message']['content'].strip()
+            antwort = gpt_laufzeit().ausfuehren(gpt_anfrage("kategorie", [{"role": "user", "content": prompt}]))
             lines = [line for line in antwort.splitlines() if ";" in line]
             cat_gpt = pd.read_csv(StringIO("\n".join(lines)), sep=";", engine="python", on_bad_lines="skip")
             cat_gpt["Herkunft"] = "gpt"
@@ -523,24 +2744,33 @@ def plausibilitaet_pruefen(df):
 
 def bereinige_zahlen(df):
     print("🧠 Formatiere und korrigiere Zahlen …")
+
+    def als_zahl(wert):
+        if isinstance(wert, str) and wert.count('.') > 1:
+            raise ValueError()
+        return float(wert)
+
     for spalte in ["Menge", "Einzelpreis", "Gesamtpreis"]:
         if spalte in df.columns:
             df[f"{spalte}_roh"] = df[spalte]
+            if pd.api.types.is_numeric_dtype(df[spalte]):
+                continue  # bereits typisiert (strukturierte Ausgabe, lokale Extraktion, E-Rechnung)
             df[spalte] = df[spalte].astype(str) \
                                    .str.replace("€", "", regex=False) \
                                    .str.replace(",", ".", regex=False) \
                                    .str.replace(" ", "", regex=False) \
                                    .str.strip()
 
-            def umwandeln_oder_gpt(wert):
+            # Nicht lesbare Werte einmalig sammeln und parallel per GPT korrigieren
+            unklar = []
+            for wert in df[spalte].unique():
                 try:
-                    if isinstance(wert, str) and wert.count('.') > 1:
-                        raise ValueError()
-                    return float(wert)
+                    als_zahl(wert)
                 except:
-                    return korrigiere_zahl_mit_gpt(wert)
+                    unklar.append(wert)
+            korrekturen = dict(zip(unklar, gpt_laufzeit().ausfuehren(korrigiere_zahlen_mit_gpt(unklar)))) if unklar else {}
 
-            df[spalte] = df[spalte].apply(umwandeln_oder_gpt)
+            df[spalte] = df[spalte].map(lambda wert: korrekturen[wert] if wert in korrekturen else als_zahl(wert))
     return df
  
 
@@ -614,30 +2844,479 @@ def erkenne_zugehoerigkeit(text):
             return firma
     return "unbekannt"
 
+# ==========================================
+# 👯 FAST-DUPLIKATE (SIMHASH / DHASH)
+# ==========================================
+# Text-PDFs: SimHash über Wort-Dreiergruppen, bestätigt über die gemeinsamen Zahlen – Rechnungen derselben
+# Vorlage unterscheiden sich fast nur dort (Nummer, Datum, Beträge). Scans: grober dHash der ersten Seite
+# für die Suche, feiner dHash zur Bestätigung.
+# Gesucht wird über Bänder: weichen höchstens k Bits ab, stimmt eines von k+1 Bändern exakt überein.
+
+MISCH_1 = np.uint64(0xff51afd7ed558ccd)
+MISCH_2 = np.uint64(0xc4ceb9fe1a85ec53)
+SHINGLE_FAKTOR = np.uint64(0x100000001B3)
+BIT_STELLEN = np.arange(64, dtype=np.uint64)
+ZAHL_MUSTER = re.compile(r"\d[\d.,/-]*\d|\d")
+
+def _bits_zu_int(bits):
+    return int("".join("1" if bit else "0" for bit in bits[::-1]), 2)
+
+def simhash(text):
+    woerter = WORT_MUSTER.findall(text.lower())
+    if len(woerter) < 3:
+        return None
+    w = np.array([zlib.crc32(wort.encode()) for wort in woerter], dtype=np.uint64)
+    h = (w[:-2] * SHINGLE_FAKTOR + w[1:-1]) * SHINGLE_FAKTOR + w[2:]
+    # 64-Bit-Finalizer (MurmurHash3): ähnliche Dreiergruppen landen auf unabhängigen Bits
+    h ^= h >> np.uint64(33)
+    h *= MISCH_1
+    h ^= h >> np.uint64(33)
+    h *= MISCH_2
+    h ^= h >> np.uint64(33)
+    stimmen = ((h[:, None] >> BIT_STELLEN) & np.uint64(1)).sum(axis=0)
+    return _bits_zu_int(stimmen * 2 > len(h))
+
+def zahlen_signatur(text):
+    # Die kleinsten Hashes der vorkommenden Zahlen – bei gekürzten Listen bleibt der Vergleich so konsistent
+    return sorted({zlib.crc32(zahl.encode()) for zahl in ZAHL_MUSTER.findall(text)})[:ZAHLEN_MAX]
+
+def _dhash(bild, raster):
+    # Auf raster × (raster+1) Kacheln mitteln, Helligkeitsgefälle je Zeile als Bits
+    zeilen = np.linspace(0, bild.shape[0], raster + 1).astype(int)
+    spalten = np.linspace(0, bild.shape[1], raster + 2).astype(int)
+    kacheln = np.add.reduceat(np.add.reduceat(bild, zeilen[:-1], axis=0), spalten[:-1], axis=1)
+    kacheln /= np.outer(np.diff(zeilen), np.diff(spalten))
+    return _bits_zu_int((kacheln[:, 1:] > kacheln[:, :-1]).ravel())
+
+def bild_dhash(analyse):
+    """Erste Seite → (grober dHash 64 Bit für die Suche, feiner dHash 256 Bit zur Bestätigung)."""
+    seite = analyse.doc[0]
+    zoom = min(1.0, 400 / max(seite.rect.width, seite.rect.height))
+    pix = seite.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    bild = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width].astype(np.float32)
+    return _dhash(bild, 8), _dhash(bild, 16)
+
+class AehnlichkeitsIndex:
+    """Signaturen verarbeiteter Dokumente mit Bandsuche. In der Datei stehen nur die Einträge,
+    die Bänder entstehen beim Laden. Einträge dieses Laufs werden erst gespeichert, wenn das
+    Dokument archiviert oder als Nicht-Rechnung abgelegt wurde (mit indizes_speichern())."""
+
+    MAX_ABSTAND = {"text": SIMHASH_MAX_ABSTAND, "bild": DHASH_MAX_ABSTAND}
+
+    def __init__(self, pfad):
+        self.pfad = pfad
+        self.eintraege = []        # {"datei", "art", "hash", "zahlen"}
+        self.baender = {}          # (Art, Band, Bandwert) → Eintragsnummern
+        self.offen = {}            # Dateiname → Eintragsnummer, noch nicht bestätigt
+        self.geaendert = False
+        if pfad.exists():
+            try:
+                for eintrag in json.loads(pfad.read_text(encoding="utf-8")):
+                    self._aufnehmen(eintrag)
+            except Exception as e:
+                fehlermeldung = f"Ähnlichkeits-Index konnte nicht geladen werden ({pfad.name}): {e}"
+                print(fehlermeldung)
+                VERARBEITUNGSFEHLER.append(fehlermeldung)
+
+    def _baender(self, art, wert):
+        anzahl = self.MAX_ABSTAND[art] + 1
+        breite = -(-64 // anzahl)
+        return [(art, nummer, (wert >> (nummer * breite)) & ((1 << breite) - 1)) for nummer in range(anzahl)]
+
+    def _aufnehmen(self, eintrag):
+        nummer = len(self.eintraege)
+        self.eintraege.append(eintrag)
+        for schluessel in self._baender(eintrag["art"], eintrag["hash"]):
+            self.baender.setdefault(schluessel, []).append(nummer)
+        return nummer
+
+    def suchen(self, art, wert, zahlen=None, fein=None, dateiname=None, inhalts_hash=None):
+        """Ähnlichstes bekanntes Dokument → (Dateiname, Bitabstand) oder None. Mit `zahlen` (Text) bzw.
+        `fein` (Bild) zählt ein Kandidat nur, wenn auch diese zweite Signatur übereinstimmt.
+
+        Nur bestätigte Einträge zählen, und nie das Dokument selbst (gleicher Name oder Inhalts-Hash) –
+        sonst findet der Hauptlauf nach `--batch` den Eintrag aus der Batch-Vorbereitung."""
+        kandidaten = {nummer for schluessel in self._baender(art, wert) for nummer in self.baender.get(schluessel, ())}
+        offen = set(self.offen.values())
+        bester = None
+        for nummer in kandidaten:
+            eintrag = self.eintraege[nummer]
+            if nummer in offen or eintrag is None or eintrag["datei"] == dateiname \
+                    or (inhalts_hash and eintrag.get("inhalts_hash") == inhalts_hash):
+                continue
+            abstand = bin(eintrag["hash"] ^ wert).count("1")
+            if abstand > self.MAX_ABSTAND[art]:
+                continue
+            if zahlen is not None:
+                gemeinsam, alle = set(zahlen), set(eintrag["zahlen"])
+                if not alle or len(gemeinsam & alle) / len(gemeinsam | alle) < ZAHLEN_MIN_JACCARD:
+                    continue
+            if fein is not None and bin(eintrag["fein"] ^ fein).count("1") > DHASH_FEIN_MAX_ABSTAND:
+                continue
+            if bester is None or abstand < bester[1]:
+                bester = (eintrag["datei"], abstand)
+        return bester
+
+    def eintragen(self, dateiname, art, wert, inhalts_hash=None, **zweite_signatur):
+        # Ein noch offener Eintrag derselben Datei (Batch-Vorbereitung) wird ersetzt, nicht verdoppelt
+        alt = self.offen.pop(dateiname, None)
+        if alt is not None:
+            self.eintraege[alt] = None
+        self.offen[dateiname] = self._aufnehmen({"datei": dateiname, "art": art, "hash": wert,
+                                                 "inhalts_hash": inhalts_hash, **zweite_signatur})
+
+    def bestaetigen(self, dateiname):
+        if self.offen.pop(dateiname, None) is not None:
+            self.geaendert = True
+
+    def speichern(self):
+        if not self.geaendert:
+            return
+        offen = set(self.offen.values())
+        try:
+            temp = self.pfad.with_suffix(".tmp")
+            temp.write_text(json.dumps([e for i, e in enumerate(self.eintraege) if e is not None and i not in offen]),
+                            encoding="utf-8")
+            os.replace(temp, self.pfad)
+            self.geaendert = False
+        except Exception as e:
+            fehlermeldung = f"Ähnlichkeits-Index konnte nicht gespeichert werden ({self.pfad.name}): {e}"
+            print(fehlermeldung)
+            VERARBEITUNGSFEHLER.append(fehlermeldung)
+
+AEHNLICHKEIT = None  # wird beim ersten Zugriff geladen
+
+def aehnlichkeits_index():
+    global AEHNLICHKEIT
+    if AEHNLICHKEIT is None:
+        AEHNLICHKEIT = AehnlichkeitsIndex(AEHNLICHKEITS_INDEX)
+    return AEHNLICHKEIT
+
+# ==========================================
+# 🔑 RECHNUNGS-INDEX (LIEFERANT + NUMMER + BETRAG)
+# ==========================================
+# Fängt Duplikate, die weder Datei noch Layout teilen (z. B. Rechnung per Mail und später als Scan):
+# nach der Extraktion zählt nur noch, was drinsteht.
+
+RECHNUNGS_SPALTEN = ["Lieferant", "Rechnungsnummer", "Gesamtbetrag", "Dateiname"]
+
+def _fehlt(wert):
+    return wert is None or (isinstance(wert, float) and np.isnan(wert)) or not str(wert).strip()
+
+def rechnungs_schluessel(lieferant, nummer, betrag):
+    """(Lieferant, Rechnungsnummer, Bruttobetrag) → Hash oder None, wenn ein Teil fehlt. Schreibweisen werden
+    angeglichen: Rechtsform, Groß-/Kleinschreibung, Satz- und Leerzeichen, führende Nullen der Nummer."""
+    if _fehlt(lieferant) or _fehlt(nummer) or _fehlt(betrag):
+        return None
+    lieferant = "".join(wort for wort in WORT_MUSTER.findall(str(lieferant).casefold()) if wort not in RECHTSFORMEN)
+    nummer = "".join(WORT_MUSTER.findall(str(nummer).casefold())).lstrip("0")
+    betrag = parse_deutsche_zahl(betrag) if isinstance(betrag, str) else float(betrag)
+    if not lieferant or not nummer or betrag is None:
+        return None
+    return hashlib.blake2b(f"{lieferant}|{nummer}|{betrag:.2f}".encode(), digest_size=12).hexdigest()
+
+class RechnungsIndex:
+    """Schlüssel aller erfassten Rechnungen → Dateiname, als Wörterbuch (Nachschlagen in O(1)).
+    Gesamtausgaben werden nur einmal eingelesen; welche schon drinstecken, steht mit Größe und
+    Änderungszeit in der Datei. Neue oder geänderte Ausgaben werden beim Laden nachgetragen."""
+
+    def __init__(self, pfad, laden=True):
+        self.pfad = pfad
+        self.schluessel = {}       # Schlüssel → Dateiname
+        self.ausgaben = {}         # Name der Gesamtausgabe → [Größe, Änderungszeit in ns]
+        self.geaendert = False
+        if laden and pfad.exists():
+            try:
+                daten = json.loads(pfad.read_text(encoding="utf-8"))
+                if daten.get("format") == RECHNUNGS_INDEX_FORMAT:
+                    self.schluessel, self.ausgaben = daten["schluessel"], daten["ausgaben"]
+                else:
+                    print(f"🔑 {pfad.name} hat ein anderes Format – wird aus den Gesamtausgaben neu aufgebaut")
+            except Exception as e:
+                fehlermeldung = f"Rechnungs-Index konnte nicht geladen werden ({pfad.name}): {e}"
+                print(fehlermeldung)
+                VERARBEITUNGSFEHLER.append(fehlermeldung)
+
+    def suchen(self, schluessel):
+        return self.schluessel.get(schluessel)
+
+    def eintragen(self, schluessel, dateiname):
+        self.schluessel.setdefault(schluessel, dateiname)
+        self.geaendert = True
+
+    def ausgabe_erfassen(self, pfad, df):
+        # Eine Zeile je Rechnung genügt – Positionen wiederholen die Kopfdaten
+        neu = 0
+        if set(RECHNUNGS_SPALTEN).issubset(df.columns):
+            for lieferant, nummer, betrag, dateiname in df[RECHNUNGS_SPALTEN].drop_duplicates().itertuples(index=False):
+                schluessel = rechnungs_schluessel(lieferant, nummer, betrag)
+                if schluessel and schluessel not in self.schluessel:
+                    self.schluessel[schluessel] = dateiname
+                    neu += 1
+        stand = pfad.stat()
+        self.ausgaben[pfad.name] = [stand.st_size, stand.st_mtime_ns]
+        self.geaendert = True
+        return neu
+
+    def nachtragen(self, ordner):
+        dateien = neu = 0
+        for datei in sorted(ordner.glob("artikelpositionen_ki_GESAMT_*.xlsx")):
+            stand = datei.stat()
+            if self.ausgaben.get(datei.name) == [stand.st_size, stand.st_mtime_ns]:
+                continue
+            try:
+                df = pd.read_excel(datei, usecols=lambda spalte: spalte in RECHNUNGS_SPALTEN,
+                                   dtype={"Rechnungsnummer": str})  # sonst wird aus "0815" 815.0
+            except Exception as e:
+                fehlermeldung = f"Gesamtausgabe für den Rechnungs-Index nicht lesbar ({datei.name}): {e}"
+                print(fehlermeldung)
+                VERARBEITUNGSFEHLER.append(fehlermeldung)
+                continue
+            neu += self.ausgabe_erfassen(datei, df)
+            dateien += 1
+        if dateien:
+            print(f"🔑 Rechnungs-Index: {neu} Rechnungen aus {dateien} Gesamtausgabe(n) nachgetragen "
+                  f"({len(self.schluessel)} insgesamt)")
+
+    def speichern(self):
+        if not self.geaendert:
+            return
+        try:
+            temp = self.pfad.with_suffix(".tmp")
+            temp.write_text(json.dumps({"format": RECHNUNGS_INDEX_FORMAT, "ausgaben": self.ausgaben,
+                                        "schluessel": self.schluessel}, ensure_ascii=False), encoding="utf-8")
+            os.replace(temp, self.pfad)
+            self.geaendert = False
+        except Exception as e:
+            fehlermeldung = f"Rechnungs-Index konnte nicht gespeichert werden ({self.pfad.name}): {e}"
+            print(fehlermeldung)
+            VERARBEITUNGSFEHLER.append(fehlermeldung)
+
+RECHNUNGEN = None  # wird beim ersten Zugriff geladen und um neue Gesamtausgaben ergänzt
+
+def rechnungs_index():
+    global RECHNUNGEN
+    if RECHNUNGEN is None:
+        RECHNUNGEN = RechnungsIndex(RECHNUNGS_INDEX)
+        RECHNUNGEN.nachtragen(output_excel.parent)
+    return RECHNUNGEN
+
+def baue_rechnungs_index_neu():
+    # 🔑 `--rechnungsindex-aufbauen`: alle Gesamtausgaben von vorn einlesen
+    global RECHNUNGEN
+    start = time.time()
+    RECHNUNGEN = RechnungsIndex(RECHNUNGS_INDEX, laden=False)
+    RECHNUNGEN.nachtragen(output_excel.parent)
+    RECHNUNGEN.speichern()
+    print(f"🔑 Rechnungs-Index mit {len(RECHNUNGEN.schluessel)} Rechnungen gespeichert: {RECHNUNGS_INDEX.name} "
+          f"({time.time() - start:.1f}s)")
+
+def pruefe_rechnungsschluessel(dok):
+    # 🔑 Dieselbe Rechnung schon in einer Gesamtausgabe (oder früher in diesem Lauf) → nicht noch einmal ausgeben
+    kopf = dok.df.iloc[0]
+    schluessel = rechnungs_schluessel(kopf.get("Lieferant"), kopf.get("Rechnungsnummer"), kopf.get("Gesamtbetrag"))
+    if schluessel is None:
+        DUPLIKAT_STATISTIK["ohne_rechnungsschluessel"] += 1
+        return
+    erfasst = rechnungs_index().suchen(schluessel)
+    if erfasst:
+        DUPLIKAT_STATISTIK["rechnung"] += 1
+        RECHNUNGS_DUPLIKATE.append((dok.dateiname, erfasst))
+        dok.log(f"🔑 Rechnung {kopf['Rechnungsnummer']} von {kopf['Lieferant']} über {kopf['Gesamtbetrag']} "
+                f"ist bereits erfasst ('{erfasst}') → nicht erneut in der Ausgabe")
+        dok.beenden(bereits_verarbeitet_ordner, dok.dateiname)
+        return
+    rechnungs_index().eintragen(schluessel, dok.dateiname)
+
 # ==========================================
 # 🧾 HAUPTVERARBEITUNG & ZUSAMMENFÜHRUNG
 # ==========================================
 
-def lade_verarbeitete_liste():
-    if protokoll_excel.exists():
+class Protokoll:
+    """Logbuch verarbeiteter Dateien in SQLite (WAL). Zeilen werden nur angehängt und gruppenweise
+    committet, Abfragen laufen über Indizes auf Dateiname und Inhalts-Hash. Ein bestehendes
+    verarbeitete_dateien.xlsx wird beim ersten Öffnen übernommen – danach ist es nur noch Ansicht."""
+
+    def __init__(self, pfad):
+        self.pfad = pfad
+        self._db = None
+        self._sperre = threading.Lock()  # Vorbereitung (PDF-Thread) und Abschluss laufen in verschiedenen Threads
+        self.offen = 0                   # angehängt, aber noch nicht committet
+
+    @property
+    def db(self):
+        if self._db is None:
+            db = sqlite3.connect(self.pfad, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS verarbeitet (nr INTEGER PRIMARY KEY, dateiname TEXT NOT NULL, "
+                       "verarbeitet_am TEXT, inhalts_hash TEXT)")
+            db.execute("CREATE INDEX IF NOT EXISTS verarbeitet_dateiname ON verarbeitet (dateiname)")
+            db.execute("CREATE INDEX IF NOT EXISTS verarbeitet_inhalts_hash ON verarbeitet (inhalts_hash)")
+            if db.execute("PRAGMA user_version").fetchone()[0] == 0:
+                self._uebernehmen(db)
+            self._db = db
+        return self._db
+
+    def _uebernehmen(self, db):
+        # Einmalig: bisheriges Excel-Protokoll (auch ohne Spalte Inhalts_Hash) übernehmen
+        if protokoll_excel.exists():
+            alt = pd.read_excel(protokoll_excel)
+            leer = [None] * len(alt)
+            zeilen = [
+                (str(name), None if pd.isna(am) else str(am), wert if isinstance(wert, str) else None)
+                for name, am, wert in zip(alt["Dateiname"], alt.get("Verarbeitet am", leer), alt.get("Inhalts_Hash", leer))
+            ]
+            db.executemany("INSERT INTO verarbeitet (dateiname, verarbeitet_am, inhalts_hash) VALUES (?, ?, ?)", zeilen)
+            print(f"📋 {len(zeilen)} Einträge aus {protokoll_excel.name} nach {self.pfad.name} übernommen")
+        db.execute("PRAGMA user_version = 1")
+        db.commit()
+
+    def anhaengen(self, dateiname, inhalts_hash=None):
+        with self._sperre:
+            self.db.execute("INSERT INTO verarbeitet (dateiname, verarbeitet_am, inhalts_hash) VALUES (?, ?, ?)",
+                            (dateiname, datetime.now().strftime("%Y-%m-%d %H:%M"), inhalts_hash))
+            self.offen += 1
+            if self.offen >= PROTOKOLL_GRUPPE:
+                self._db.commit()
+                self.offen = 0
+
+    def festschreiben(self):
+        with self._sperre:
+            if self._db is not None and self.offen:
+                self._db.commit()
+                self.offen = 0
+
+    def datei_mit_hash(self, inhalts_hash):
+        """Dateiname, unter dem dieser Inhalt zuerst verarbeitet wurde – sonst None."""
+        with self._sperre:
+            zeile = self.db.execute("SELECT dateiname FROM verarbeitet WHERE inhalts_hash = ? ORDER BY nr LIMIT 1",
+                                    (inhalts_hash,)).fetchone()
+        return zeile[0] if zeile else None
+
+    def name_bekannt(self, dateiname):
+        """None = nie verarbeitet, sonst ob mindestens eine Zeile mit Inhalts-Hash dabei ist."""
+        with self._sperre:
+            zeile = self.db.execute("SELECT MAX(inhalts_hash IS NOT NULL) FROM verarbeitet WHERE dateiname = ?",
+                                    (dateiname,)).fetchone()
+        return None if zeile[0] is None else bool(zeile[0])
+
+    def dateinamen(self):
+        with self._sperre:
+            return [name for (name,) in self.db.execute("SELECT DISTINCT dateiname FROM verarbeitet")]
+
+    def exportieren(self, ziel=protokoll_excel):
+        # 📤 Excel-Ansicht in der gewohnten Form (Dateiname, Verarbeitet am, Inhalts_Hash)
+        self.festschreiben()
         try:
-            return pd.read_excel(protokoll_excel)["Dateiname"].tolist()
+            with self._sperre:
+                df = pd.read_sql_query('SELECT dateiname AS "Dateiname", verarbeitet_am AS "Verarbeitet am", '
+                                       'inhalts_hash AS "Inhalts_Hash" FROM verarbeitet ORDER BY nr', self.db)
+            temp = ziel.with_name(f"~{ziel.name}")
+            df.to_excel(temp, index=False)
+            os.replace(temp, ziel)
+            print(f"📋 Protokoll exportiert: {ziel.name} ({len(df)} Einträge)")
         except Exception as e:
-            fehlermeldung = f"Fehler beim Laden der Liste verarbeiteter Dateien: {e}"
+            fehlermeldung = f"Protokoll konnte nicht nach {ziel.name} exportiert werden: {e}"
             print(fehlermeldung)
             VERARBEITUNGSFEHLER.append(fehlermeldung)
-            return []
-    return []
+
+PROTOKOLL = Protokoll(protokoll_db)
+atexit.register(PROTOKOLL.festschreiben)  # offene Gruppe auch bei Abbruch sichern
+
+def lade_verarbeitete_liste():
+    try:
+        return PROTOKOLL.dateinamen()
+    except Exception as e:
+        fehlermeldung = f"Fehler beim Laden der Liste verarbeiteter Dateien: {e}"
+        print(fehlermeldung)
+        VERARBEITUNGSFEHLER.append(fehlermeldung)
+        return []
+
+HASH_EXECUTOR = None  # erst beim Einlesen des Eingangsordners
+
+def hash_executor():
+    global HASH_EXECUTOR
+    if HASH_EXECUTOR is None:
+        HASH_EXECUTOR = ThreadPoolExecutor(max_workers=INHALTS_HASH_THREADS, thread_name_prefix="hash")
+    return HASH_EXECUTOR
+
+def inhalts_hash(pfad):
+    # Blockweise lesen – hashlib gibt dabei den GIL frei, mehrere Dateien werden echt parallel gehasht
+    h = hashlib.blake2b(digest_size=20)
+    with open(pfad, "rb") as f:
+        while block := f.read(HASH_BLOCKGROESSE):
+            h.update(block)
+    return h.hexdigest()
+
+class BekannteDateien:
+    """Bereits verarbeitete Dateien nach Inhalt (Hash) und – für alte Protokollzeilen ohne Hash – nach Name.
+    Frühere Läufe werden im Protokoll nachgeschlagen, Dateien dieses Laufs im Speicher gemerkt."""
+
+    def __init__(self, protokoll=None, laufend=None):
+        self.protokoll = protokoll
+        self.hashes = {}           # Inhalts-Hash → Dateiname, unter dem der Inhalt in diesem Lauf verarbeitet wurde
+        self.namen = {}            # Dateiname → mit Inhalts-Hash gemerkt (dieser Lauf)
+        self._laufend = laufend or {}  # Pfad → Future des Hintergrund-Hashings
+
+    def _name_mit_hash(self, dateiname):
+        # None = unbekannt, sonst ob der Name schon einmal mit Inhalts-Hash protokolliert wurde
+        lauf = self.namen.get(dateiname)
+        frueher = self.protokoll.name_bekannt(dateiname) if self.protokoll else None
+        if lauf is None and frueher is None:
+            return None
+        return bool(lauf) or bool(frueher)
+
+    def bekannter_name(self, dateiname):
+        return self._name_mit_hash(dateiname) is not None
+
+    def inhalts_hash(self, pfad):
+        future = self._laufend.pop(pfad, None)
+        try:
+            return future.result() if future else inhalts_hash(pfad)
+        except OSError as e:
+            VERARBEITUNGSFEHLER.append(f"Inhalts-Hash fehlgeschlagen ({pfad.name}): {e}")
+            return None
+
+    def duplikat(self, dateiname, inhalts_hash):
+        """Dateiname, unter dem derselbe Inhalt schon verarbeitet wurde – sonst None."""
+        if inhalts_hash:
+            original = self.hashes.get(inhalts_hash) or (self.protokoll and self.protokoll.datei_mit_hash(inhalts_hash))
+            if original:
+                return original
+        # Gleicher Name mit bekanntem, aber anderem Inhalt (Scanner vergeben 3.pdf immer wieder) → neu
+        mit_hash = self._name_mit_hash(dateiname)
+        if mit_hash is not None and (inhalts_hash is None or not mit_hash):
+            return dateiname
+        return None
+
+    def merken(self, dateiname, inhalts_hash):
+        self.namen[dateiname] = self.namen.get(dateiname, False) or bool(inhalts_hash)
+        if inhalts_hash:
+            self.hashes.setdefault(inhalts_hash, dateiname)
+
+def starte_inhalts_hashes(pfade):
+    return {pfad: hash_executor().submit(inhalts_hash, pfad) for pfad in pfade}
+
+def lade_bekannte_dateien(laufend=None):
+    try:
+        PROTOKOLL.db  # öffnet das Protokoll (beim ersten Mal mit Übernahme aus Excel)
+        return BekannteDateien(PROTOKOLL, laufend)
+    except Exception as e:
+        fehlermeldung = f"Fehler beim Laden der Liste verarbeiteter Dateien: {e}"
+        print(fehlermeldung)
+        VERARBEITUNGSFEHLER.append(fehlermeldung)
+    return BekannteDateien(laufend=laufend)
 
 def merge_and_enrich(ordner):
     global abbrechen
     abbrechen = False
-    batches = list(ordner.glob("artikelpositionen_ki_batch_*.xlsx"))
+    batches = finde_batchdateien(ordner)
     if not batches:
         print("⚠️ Keine Batchdateien zum Zusammenführen gefunden.")
         return
 
-    frames = [pd.read_excel(f) for f in batches]
+    frames = [lese_batchdatei(f) for f in batches]
     merged = pd.concat(frames, ignore_index=True)
 
     # 🧼 Einheitenharmonisierung + Logging   
@@ -659,6 +3338,9 @@ def merge_and_enrich(ordner):
     gesamt_path = ordner / f"artikelpositionen_ki_GESAMT_{datetime.now():%Y%m%d_%H%M}.xlsx"
     merged.to_excel(gesamt_path, index=False)
     print(f"📊 Gesamtausgabe gespeichert: {gesamt_path.name}")
+    if RECHNUNGS_INDEX_AKTIV:
+        # 🔑 Enthält auch nachgeholte Batchdateien früherer Läufe → Schlüssel direkt aus dem DataFrame
+        rechnungs_index().ausgabe_erfassen(gesamt_path, merged)
 
     # 📝 Speichern des Kategorielogs (nur wenn etwas kategorisiert wurde)
     if logeintraege:
@@ -669,128 +3351,449 @@ def merge_and_enrich(ordner):
     # 📋 Hinweise für den Anwender
     zeige_next_steps_übersicht(ordner)    
 
-def hauptprozess():
-    global anzahl_text, anzahl_ocr, probleme, nicht_rechnungen, dauer_text, dauer_ocr, alle_dfs
-    verarbeitete = lade_verarbeitete_liste()
-    print("🔍 Starte Verarbeitung mit Zwischenspeicherung und Batch-Limit...")
-    pdf_files = list(input_folder.glob("*.pdf"))
-    print(f"📂 {len(pdf_files)} Dateien gefunden.")
-    print("")
-    print("═" * 60)  # 🔽 Visuelle Trennung vor erster Datei
-    for index, pdf_path in enumerate(pdf_files[:BATCH_SIZE], 1):
-        start = time.time()
-        dateiname = pdf_path.name
-        print(f"➞️ {index}/{len(pdf_files)}: {dateiname}")
-        print("🛂 Starte Vorprüfung der Datei")
-        if dateiname in verarbeitete:
-            print("⏭️ Bereits verarbeitet.")
-            print("")  # ✅ NEU: Leerzeile vor continue
-            move_with_folder(pdf_path, bereits_verarbeitet_ordner, dateiname)
-            speichere_verarbeitete_datei(dateiname)
-            continue
-       
-        ist_lesbar = pdf_hat_nutzbaren_text(pdf_path)
-        print(f"🔍 Textlayer vorhanden: {'JA' if ist_lesbar else 'NEIN'}")
-
-        text = extrahiere_text_aus_pdf(pdf_path)
-        text_ok = len(text.strip()) >= 100 and not text.strip().startswith("VL<?LHH")
-
-        if not ist_lesbar or not text_ok:
-            print("⚠️ Kein brauchbarer Text erkannt – wechsle zu GPT-OCR")
-            b64 = konvertiere_erste_seite_zu_base64(pdf_path)
-            if not b64:
-                print("⚠️ Kein OCR möglich → verschoben.")
-                print("")
-                move_with_folder(pdf_path, problemordner, f"unlesbar_{dateiname}")
-                speichere_verarbeitete_datei(dateiname)
-                probleme += 1
-                continue
-            print("🔠 Starte GPT-Klassifikation auf Bildbasis (OCR)")
-            klassifikation = gpt_klassifikation(image_b64=b64)
-            text = gpt_abfrage_ocr_text(b64)
-            if not text.strip():
-                print("⚠️ OCR lieferte keinen brauchbaren Text → Problemrechnungen")
-                move_with_folder(pdf_path, problemordner, f"OCR_unbrauchbar_{dateiname}")
-                speichere_verarbeitete_datei(dateiname)
-                probleme += 1
-                continue
-            verfahren = "gpt-ocr"
-            anzahl_ocr += 1
+class Dokument:
+    """Zustand einer Eingangsdatei auf dem Weg Vorbereitung → GPT-Stufe → Abschluss."""
+
+    def __init__(self, index, pfad):
+        self.index = index
+        self.pfad = pfad
+        self.dateiname = pfad.name
+        self.start = time.time()
+        self.analyse = None
+        self.protokoll = []        # Konsolenausgaben – werden beim Abschluss in Dateireihenfolge gedruckt
+        self.klassifikation = None
+        self.verfahren = None
+        self.text = ""
+        self.b64 = None
+        self.seitenbilder = {}     # Mischdokumente: gerenderte Seiten ohne Textlayer
+        self.df = None
+        self.lokal_df = None
+        self.konfidenz = 0.0
+        self.vorlage_df = None     # Positionen aus einer Lieferanten-Vorlage – gilt erst nach Typ "rechnung"
+        self.kopfdaten = {}
+        self.zaehler = set()       # Statistikzähler, die beim Abschluss erhöht werden
+        self.ziel = None           # (Ordner, Zieldateiname)
+        self.vorlage_lernen = False
+        self.gestreamte_positionen = 0
+        self.inhalts_hash = None
+        self.duplikat_hinweis = None  # Scan, dessen erste Seite einem bekannten Dokument gleicht
+
+    def log(self, meldung=""):
+        self.protokoll.append(meldung)
+
+    def position_empfangen(self, position):
+        # 📡 Rückruf aus dem Stream: die Antwort ist noch nicht vollständig
+        self.gestreamte_positionen += 1
+        if self.gestreamte_positionen == 1:
+            self.log(f"📡 Erste Position nach {time.time() - self.start:.1f}s empfangen – Antwort läuft weiter")
+
+    def beenden(self, ordner, zielname, zaehler=None):
+        self.ziel = (ordner, zielname)
+        if zaehler:
+            self.zaehler.add(zaehler)
+
+    def problem(self, meldung, praefix):
+        self.log(meldung)
+        self.beenden(problemordner, f"{praefix}_{self.dateiname}", "probleme")
+
+    @property
+    def fertig(self):
+        return self.ziel is not None
+
+    @property
+    def lokal_sicher(self):
+        # Positionen liegen schon lokal vor → GPT muss nur noch den Dokumenttyp bestimmen
+        return self.vorlage_df is not None or (self.lokal_df is not None and self.konfidenz >= LOKAL_MIN_KONFIDENZ)
+
+def pruefe_text_aehnlichkeit(dok, text=None):
+    # 👯 Ähnlicher Text mit denselben Zahlen wie ein verarbeitetes Dokument → zur Prüfung, kein GPT-Aufruf
+    text = dok.text if text is None else text
+    signatur = simhash(text)
+    if signatur is None:
+        return False
+    zahlen = zahlen_signatur(text)
+    treffer = aehnlichkeits_index().suchen("text", signatur, zahlen, dateiname=dok.dateiname, inhalts_hash=dok.inhalts_hash)
+    if treffer:
+        DUPLIKAT_STATISTIK["fast_text"] += 1
+        dok.problem(f"👯 Fast-Duplikat von '{treffer[0]}' ({treffer[1]} Bit Abstand, gleiche Zahlen) → Problemrechnungen zur Prüfung",
+                    "Duplikatverdacht")
+        return True
+    aehnlichkeits_index().eintragen(dok.dateiname, "text", signatur, dok.inhalts_hash, zahlen=zahlen)
+    return False
+
+def pruefe_bild_aehnlichkeit(dok):
+    # 👯 Scans: Rechnungen derselben Vorlage sehen sich auch ohne Duplikat ähnlich → nur markieren
+    signaturen = sicher_ausführen(bild_dhash, "Bild-Hash", dok.analyse)
+    if signaturen is None:
+        return
+    grob, fein = signaturen
+    treffer = aehnlichkeits_index().suchen("bild", grob, fein=fein, dateiname=dok.dateiname, inhalts_hash=dok.inhalts_hash)
+    if treffer:
+        DUPLIKAT_STATISTIK["fast_bild"] += 1
+        dok.duplikat_hinweis = treffer[0]
+        dok.log(f"👯 Erste Seite gleicht '{treffer[0]}' ({treffer[1]} Bit Abstand) – wird in der Ausgabe markiert")
+    aehnlichkeits_index().eintragen(dok.dateiname, "bild", grob, dok.inhalts_hash, fein=fein)
+
+def bereite_dokument_vor(dok, anzahl_dateien, verarbeitete):
+    # 📑 Lokale Stufe (PDF-Thread): alles, was PyMuPDF braucht, passiert hier
+    dok.log(f"➞️ {dok.index}/{anzahl_dateien}: {dok.dateiname}")
+    dok.log("🛂 Starte Vorprüfung der Datei")
+    dok.inhalts_hash = verarbeitete.inhalts_hash(dok.pfad)
+    original = verarbeitete.duplikat(dok.dateiname, dok.inhalts_hash)
+    if original == dok.dateiname:
+        dok.log("⏭️ Bereits verarbeitet.")
+        DUPLIKAT_STATISTIK["gleicher_name"] += 1
+    elif original:
+        dok.log(f"♻️ Gleicher Inhalt wurde bereits als '{original}' verarbeitet – umbenanntes Duplikat.")
+        DUPLIKAT_STATISTIK["umbenannt"] += 1
+        UMBENANNTE_DUPLIKATE.append((dok.dateiname, original))
+    if original:
+        dok.beenden(bereits_verarbeitet_ordner, dok.dateiname)
+        return
+    if verarbeitete.bekannter_name(dok.dateiname):
+        dok.log("📛 Dateiname schon verarbeitet, Inhalt aber neu → wird verarbeitet")
+        DUPLIKAT_STATISTIK["name_neuer_inhalt"] += 1
+    verarbeitete.merken(dok.dateiname, dok.inhalts_hash)
+
+    analyse = dok.analyse = PdfAnalyse(dok.pfad)
+    e_rechnung = sicher_ausführen(lese_e_rechnung, "E-Rechnung lesen", analyse)
+    if e_rechnung:
+        # ZUGFeRD-PDFs haben einen Textlayer – eine nachgedruckte Kopie trägt dieselbe XML
+        if AEHNLICHKEIT_AKTIV and analyse.hat_nutzbaren_text and pruefe_text_aehnlichkeit(dok, analyse.nutzbarer_text):
+            return
+        dok.klassifikation, dok.df = e_rechnung
+        dok.log(f"🧾 E-Rechnung (ZUGFeRD/Factur-X/XRechnung) erkannt: {len(dok.df)} Positionen – kein GPT-Aufruf")
+        dok.text = " ".join(str(wert) for wert in dok.df[["Lieferant", "Rechnungsempfänger"]].iloc[0] if wert)
+        dok.verfahren = "xml"
+        dok.zaehler.add("xml")
+        return
+    if analyse.ist_xml:
+        dok.problem("⚠️ XML-Datei ist keine lesbare E-Rechnung → Problemrechnungen", "XML_unlesbar")
+        return
+
+    ist_lesbar = analyse.hat_nutzbaren_text
+    dok.log(f"🔍 Textlayer vorhanden: {'JA' if ist_lesbar else 'NEIN'}")
+    if not ist_lesbar:
+        dok.log("⚠️ Kein brauchbarer Text erkannt – wechsle zu GPT-OCR")
+        dok.b64 = konvertiere_erste_seite_zu_base64(analyse)
+        if not dok.b64:
+            dok.problem("⚠️ Kein OCR möglich → verschoben.", "unlesbar")
+            return
+        if AEHNLICHKEIT_AKTIV:
+            pruefe_bild_aehnlichkeit(dok)
+        dok.verfahren = "gpt-ocr"
+        dok.zaehler.add("ocr")
+        return
+
+    dok.seitenbilder = rendere_schlechte_seiten(analyse)
+    dok.text = extrahiere_text_aus_pdf(analyse)
+    dok.zaehler.add("text")
+    melde_ausgelassene_seiten(dok)
+    if AEHNLICHKEIT_AKTIV and pruefe_text_aehnlichkeit(dok):
+        return
+    dok.verfahren = "text"
+    # 🏷️ Vorlage passt über USt-IdNr/Layout auch auf Gutschriften, Mahnungen oder AGB desselben Lieferanten –
+    # die Positionen gelten deshalb erst, wenn Regeln, Modell oder GPT "rechnung" sagen
+    dok.vorlage_df = sicher_ausführen(lieferanten_vorlagen().wende_an, "Lieferanten-Vorlage", analyse)
+    if dok.vorlage_df is not None:
+        return
+    # 📐 Lokale Tabellenerkennung schon hier – wird nur genutzt, wenn GPT "rechnung" klassifiziert
+    dok.lokal_df, dok.konfidenz = sicher_ausführen(extrahiere_positionen_lokal, "Lokale Tabellenerkennung", analyse) or (None, 0.0)
+    if dok.lokal_df is not None and dok.konfidenz >= LOKAL_MIN_KONFIDENZ:
+        dok.kopfdaten = extrahiere_kopfdaten_lokal(analyse)
+
+async def kombi_stufe(dok):
+    # 🧩 Typ, Kopfdaten und Positionen in einem Aufruf. False → getrennte Aufrufe als Rückfall
+    if dok.verfahren == "gpt-ocr":
+        dok.log("🧩 Kombinierte GPT-Abfrage auf Bildbasis (Typ + Kopfdaten + Positionen)")
+        antwort = await gpt_kombi_abfrage(b64_image=dok.b64, bei_zeile=dok.position_empfangen)
+    else:
+        dok.log("🧩 Kombinierte GPT-Abfrage auf Textbasis (Typ + Kopfdaten + Positionen)")
+        antwort = await gpt_kombi_abfrage(text=dok.text, bei_zeile=dok.position_empfangen)
+    ergebnis = lese_kombi_antwort(antwort, dok.dateiname) if antwort else None
+    if ergebnis is None:
+        dok.log("⚠️ Kombinierte Antwort nicht lesbar → getrennte GPT-Abfragen")
+        return False
+    dok.klassifikation, dok.df = ergebnis
+    if dok.df is not None:
+        dok.log(f"🧩 {len(dok.df)} Positionen aus der kombinierten Antwort")
+        if dok.verfahren == "gpt-ocr":
+            # Kein OCR-Volltext mehr – Zugehörigkeit wie bei E-Rechnungen aus den Kopfdaten
+            dok.text = " ".join(str(wert) for wert in dok.df[["Lieferant", "Rechnungsempfänger"]].iloc[0] if wert)
+    elif dok.klassifikation == "rechnung":
+        dok.problem("⚠️ Kombinierte GPT-Antwort ohne Positionen → Problemrechnungen", "Tabelle_fehlt")
+    return True
+
+def regelstufe(dok):
+    # 🏷️ Lokale Vorklassifikation – eindeutige Fälle brauchen keinen GPT-Aufruf für den Dokumenttyp
+    regel_typ, punkte = klassifiziere_regelbasiert(dok.text)
+    REGEL_STATISTIK["entschieden" if regel_typ else "unklar"] += 1
+    if regel_typ:
+        REGEL_STATISTIK[f"typ_{regel_typ}"] += 1
+        schatten = " (Schattenmodus, GPT entscheidet)" if REGEL_SCHATTENMODUS else ""
+        dok.log(f"🏷️ Regelbasierte Klassifikation: {regel_typ} ({punkte[regel_typ]} Punkte){schatten}")
+    else:
+        verteilung = ", ".join(f"{typ} {wert}" for typ, wert in punkte.most_common(3)) or "keine Treffer"
+        dok.log(f"🏷️ Regelbasierte Klassifikation unklar ({verteilung}) → GPT")
+    return regel_typ
+
+def modellstufe(dok):
+    # 🎓 Gelerntes Modell für Fälle, die die Regeln offen lassen – nur oberhalb der Wahrscheinlichkeitsschwelle
+    typ, wahrscheinlichkeit = dokumenttyp_modell().vorhersagen(dok.text)
+    if typ is None or wahrscheinlichkeit < MODELL_MIN_WAHRSCHEINLICHKEIT:
+        MODELL_STATISTIK["unsicher"] += 1
+        if typ:
+            dok.log(f"🎓 Modell unsicher ({typ}, p={wahrscheinlichkeit:.2f}) → GPT")
+        return None
+    MODELL_STATISTIK["entschieden"] += 1
+    MODELL_STATISTIK[f"typ_{typ}"] += 1
+    schatten = " (Schattenmodus, GPT entscheidet)" if MODELL_SCHATTENMODUS else ""
+    dok.log(f"🎓 Modell-Klassifikation: {typ} (p={wahrscheinlichkeit:.2f}){schatten}")
+    return typ
+
+def lokale_klassifikation(dok):
+    """Regeln, danach das gelernte Modell (nur Textlayer) → (Regel-Typ, Modell-Typ, lokal entschiedener Typ).
+    Der lokal entschiedene Typ ersetzt die GPT-Klassifikation; im Schattenmodus bleibt er None."""
+    regel_typ = modell_typ = None
+    if dok.verfahren == "text":
+        regel_typ = regelstufe(dok) if REGEL_KLASSIFIKATION else None
+        if (regel_typ is None or REGEL_SCHATTENMODUS) and MODELL_KLASSIFIKATION and dokumenttyp_modell():
+            modell_typ = modellstufe(dok)
+    if regel_typ is not None and not REGEL_SCHATTENMODUS:
+        lokal_typ = regel_typ
+    elif modell_typ is not None and not MODELL_SCHATTENMODUS:
+        lokal_typ = modell_typ
+    else:
+        lokal_typ = None
+    if lokal_typ:
+        dok.klassifikation = lokal_typ
+    return regel_typ, modell_typ, lokal_typ
+
+async def gpt_stufe(dok):
+    # 🧠 Netzwerk-Stufe: läuft für mehrere Dokumente gleichzeitig
+    lokal_sicher = dok.lokal_sicher
+    if dok.verfahren == "text" and dok.seitenbilder:
+        dok.log(await ergaenze_schlechte_seiten_per_ocr(dok.analyse, dok.seitenbilder))
+        dok.text = await pdf_arbeit(extrahiere_text_aus_pdf, dok.analyse)
+    regel_typ, modell_typ, lokal_typ = lokale_klassifikation(dok)
+
+    def vergleichen():
+        vergleiche_klassifikation(dok, regel_typ)
+        vergleiche_klassifikation(dok, modell_typ, "Modell", MODELL_STATISTIK, MODELL_ABWEICHUNGEN)
+
+    kombiniert = False
+    if GPT_KOMBI_MODUS and dok.verfahren in ("gpt-ocr", "text") and not lokal_sicher \
+            and not (lokal_typ and lokal_typ != "rechnung"):
+        kombiniert = await kombi_stufe(dok)
+        if kombiniert:
+            vergleichen()
+        if dok.fertig:
+            return
+
+    if not kombiniert and dok.verfahren == "gpt-ocr":
+        dok.log("🔠 Starte GPT-Klassifikation auf Bildbasis (OCR)")
+        dok.klassifikation, dok.text = await asyncio.gather(
+            gpt_klassifikation(image_b64=dok.b64), gpt_abfrage_ocr_text(dok.b64)
+        )
+        if not dok.text.strip():
+            dok.problem("⚠️ OCR lieferte keinen brauchbaren Text → Problemrechnungen", "OCR_unbrauchbar")
+            return
+    elif not kombiniert and dok.verfahren == "text" and not lokal_typ:
+        dok.log("🔠 Starte GPT-Klassifikation auf Textbasis")
+        dok.klassifikation = await gpt_klassifikation(text=dok.text)
+        vergleichen()
+
+    if dok.klassifikation != "rechnung":
+        dok.log(f"📄 Dokumenttyp: {dok.klassifikation}")
+        dok.log(f"❌ Nicht-Rechnung → verschoben nach: {dok.klassifikation}_{dok.dateiname}")
+        dok.beenden(nicht_rechnung_folder, f"{dok.klassifikation}_{dok.dateiname}", "nicht_rechnungen")
+        return
+
+    if dok.verfahren == "text" and not kombiniert:
+        if dok.vorlage_df is not None:
+            dok.log(f"🏷️ Lieferanten-Vorlage '{dok.vorlage_df['Lieferant'].iloc[0]}': {len(dok.vorlage_df)} Positionen "
+                    f"– kein GPT-Aufruf für den Inhalt")
+            dok.df = dok.vorlage_df
+            dok.verfahren = "vorlage"
+            dok.zaehler.add("lokal")
+        elif lokal_sicher:
+            dok.log(f"📐 Lokale Tabellenerkennung: {len(dok.lokal_df)} Positionen (Konfidenz {dok.konfidenz:.2f}) – kein GPT-Aufruf")
+            dok.df = ergaenze_kopfdaten(dok.lokal_df, dok.kopfdaten)
+            dok.verfahren = "text-lokal"
+            dok.zaehler.add("lokal")
+            # 🏷️ Sichere Extraktion mit Rechnungsnummer gilt als Bestätigung für die Lieferanten-Vorlage
+            dok.vorlage_lernen = bool(dok.kopfdaten.get("Rechnungsnummer"))
         else:
-            print("🔠 Starte GPT-Klassifikation auf Textbasis")
-            klassifikation = gpt_klassifikation(text_path=pdf_path)
-            verfahren = "text"
-            anzahl_text += 1
-        if klassifikation != "rechnung":
-            print(f"📄 Dokumenttyp: {klassifikation}")
-            print("")
-            move_with_folder(pdf_path, nicht_rechnung_folder, f"{klassifikation}_{dateiname}")
-            speichere_verarbeitete_datei(dateiname)
-            nicht_rechnungen += 1
-            print(f"❌ Nicht-Rechnung → verschoben nach: {klassifikation}_{dateiname}")
-            print("")
-            continue
-        print("📤 Sende Bild direkt an GPT zur Inhaltsextraktion …")
-        if verfahren == "gpt-ocr":
-            if not b64:
-                print("❌ Kein Bild für GPT-OCR vorhanden → Problemrechnungen")
-                move_with_folder(pdf_path, problemordner, f"fehlendes_bild_{dateiname}")
-                speichere_verarbeitete_datei(dateiname)
-                probleme += 1
-                continue
-            print("📤 Sende Bild an GPT zur Inhaltsextraktion …")
-            antwort = gpt_abfrage_inhalt(b64_image=b64)
+            dok.log(f"📐 Lokale Tabellenerkennung unsicher (Konfidenz {dok.konfidenz:.2f}) → GPT")
+
+    if dok.df is None:
+        if dok.verfahren == "gpt-ocr":
+            dok.log("📤 Sende Bild an GPT zur Inhaltsextraktion …")
+            antwort = await gpt_abfrage_inhalt(b64_image=dok.b64, bei_zeile=dok.position_empfangen)
         else:
-            print("📤 Sende Text an GPT zur Inhaltsextraktion …")
-            antwort = gpt_abfrage_inhalt(text=text)
+            dok.log("📤 Sende Text an GPT zur Inhaltsextraktion …")
+            antwort = await gpt_abfrage_inhalt(text=dok.text, bei_zeile=dok.position_empfangen)
 
         if not antwort or len(antwort.strip()) < 20:
-            print("⚠️ GPT-Antwort zu kurz oder leer → Problemrechnungen")
-            move_with_folder(pdf_path, problemordner, f"Tabelle_fehlt_{dateiname}")
-            speichere_verarbeitete_datei(dateiname)
-            probleme += 1
-            continue
-
+            dok.problem("⚠️ GPT-Antwort zu kurz oder leer → Problemrechnungen", "Tabelle_fehlt")
+            return
         if antwort.strip().lower().startswith("fehler"):
-            print("⚠️ GPT-Inhaltsextraktion meldet Fehler → Problemrechnungen")
-            print("")
-            move_with_folder(pdf_path, problemordner, f"GPT_Fehler_{dateiname}")
-            speichere_verarbeitete_datei(dateiname)
-            probleme += 1
-            continue
-        print("✅ Starte Plausibilitätsprüfung der Tabelle …")
-        print("")
-        df = parse_csv_in_dataframe(antwort, dateiname)
-        if df is None or df.empty:
-            print("⚠️ Tabelle leer oder fehlerhaft → Problemrechnungen")
-            print("")
-            move_with_folder(pdf_path, problemordner, f"Tabelle_unbrauchbar_{dateiname}")
-            speichere_verarbeitete_datei(dateiname)
-            probleme += 1
-            continue
-        df["Dokumententyp"] = klassifikation
-        df["Klassifikation_vor_Plausibilitaet"] = klassifikation
-        df["Verfahren"] = verfahren
-        dauer = time.time() - start
-        df["Verarbeitung_Dauer"] = round(dauer, 2)
-        df["Zugehörigkeit"] = erkenne_zugehoerigkeit(text)
-        alle_dfs.append(df)
-        move_with_folder(pdf_path, archiv_folder, dateiname)
-        speichere_verarbeitete_datei(dateiname)
-        if index % FLUSH_INTERVAL == 0:
+            dok.problem("⚠️ GPT-Inhaltsextraktion meldet Fehler → Problemrechnungen", "GPT_Fehler")
+            return
+        dok.log("✅ Starte Plausibilitätsprüfung der Tabelle …")
+        if GPT_STRUKTURIERTE_AUSGABE:
+            dok.df = lese_strukturierte_antwort(antwort, dok.dateiname)
+        else:
+            dok.df = parse_csv_in_dataframe(antwort, dok.dateiname)
+        if dok.df is None or dok.df.empty:
+            dok.problem("⚠️ Tabelle leer oder fehlerhaft → Problemrechnungen", "Tabelle_unbrauchbar")
+            return
+
+    dok.df["Dokumententyp"] = dok.klassifikation
+    dok.df["Klassifikation_vor_Plausibilitaet"] = dok.klassifikation
+    dok.df["Verfahren"] = f"{dok.verfahren}-kombi" if kombiniert else dok.verfahren
+    dok.df["Verarbeitung_Dauer"] = round(time.time() - dok.start, 2)
+    dok.df["Zugehörigkeit"] = erkenne_zugehoerigkeit(dok.text)
+    if dok.duplikat_hinweis:
+        dok.df["Duplikatverdacht"] = dok.duplikat_hinweis
+    dok.beenden(archiv_folder, dok.dateiname)
+
+def indizes_speichern():
+    # 💾 Gelerntes sichern: bei jeder Zwischenspeicherung, am Laufende und per atexit auch nach einem Abbruch
+    if VORLAGEN is not None:
+        VORLAGEN.speichern()
+    if AEHNLICHKEIT_AKTIV and AEHNLICHKEIT is not None:
+        AEHNLICHKEIT.speichern()
+    if RECHNUNGS_INDEX_AKTIV and RECHNUNGEN is not None:
+        RECHNUNGEN.speichern()
+
+atexit.register(indizes_speichern)
+
+def schliesse_dokument_ab(dok):
+    # 🧾 Abschluss in Eingangsreihenfolge: Ausgabe, Verschieben, Protokoll, Statistik, Zwischenspeicherung
+    global anzahl_eingang, anzahl_text, anzahl_ocr, anzahl_lokal, anzahl_xml, probleme, nicht_rechnungen
+    global seiten_ausgelassen, dauer_text, dauer_ocr
+    if RECHNUNGS_INDEX_AKTIV and dok.ziel[0] == archiv_folder:
+        pruefe_rechnungsschluessel(dok)
+    for zeile in dok.protokoll:
+        print(zeile)
+    ordner, zielname = dok.ziel
+    move_with_folder(dok.pfad, ordner, zielname)
+    speichere_verarbeitete_datei(dok.dateiname, dok.inhalts_hash)
+    if AEHNLICHKEIT_AKTIV and ordner in (archiv_folder, nicht_rechnung_folder):
+        aehnlichkeits_index().bestaetigen(dok.dateiname)
+
+    dauer = time.time() - dok.start
+    anzahl_eingang += 1
+    anzahl_text += "text" in dok.zaehler
+    anzahl_ocr += "ocr" in dok.zaehler
+    anzahl_lokal += "lokal" in dok.zaehler
+    anzahl_xml += "xml" in dok.zaehler
+    probleme += "probleme" in dok.zaehler
+    nicht_rechnungen += "nicht_rechnungen" in dok.zaehler
+    seiten_ausgelassen += "seiten_ausgelassen" in dok.zaehler
+    dauer_text += dauer if "text" in dok.zaehler else 0.0
+    dauer_ocr += dauer if "ocr" in dok.zaehler else 0.0
+
+    if ordner == archiv_folder:
+        alle_dfs.append(dok.df)
+        if dok.index % FLUSH_INTERVAL == 0:
             flush = pd.concat(alle_dfs, ignore_index=True)
-            flush.to_excel(output_excel.parent / f"artikelpositionen_ki_batch_{index}.xlsx", index=False)
-            print(f"📏 Zwischenspeicherung nach {len(flush)} Dateien: artikelpositionen_ki_batch_{index}.xlsx")
+            pfad = schreibe_batchdatei(flush, output_excel.parent, dok.index)
+            print(f"📏 Zwischenspeicherung nach {len(flush)} Dateien: {pfad.name}")
             alle_dfs.clear()
-        print("")  # ➕ Fügt nach jedem Datei-Durchlauf eine Leerzeile ein
+    if dok.index % FLUSH_INTERVAL == 0:
+        indizes_speichern()
+    print("")  # ➕ Fügt nach jedem Datei-Durchlauf eine Leerzeile ein
+
+async def verarbeite_dateien(dateien, anzahl_dateien, verarbeitete):
+    """Produzent/Konsument-Pipeline: lokale PDF-Arbeit überlappt mit GPT-Wartezeiten,
+    Ergebnisse werden trotzdem streng in Eingangsreihenfolge abgeschlossen.
+
+    Es laufen GPT_PARALLEL_MAX Konsumenten; wie viele davon gerade senden, entscheidet der Planer (AIMD).
+    Mit nur GPT_PARALLEL Konsumenten käme eine erhöhte Parallelität nie bei der API an."""
+    konsumenten = GPT_PARALLEL_MAX
+    warteschlange = asyncio.Queue(maxsize=GPT_PARALLEL * 2)
+    fertige = {}
+    signal = asyncio.Condition()
+
+    async def melden(dok):
+        async with signal:
+            fertige[dok.index] = dok
+            signal.notify_all()
+
+    async def produzent():
+        for index, pfad in enumerate(dateien, 1):
+            dok = Dokument(index, pfad)
+            try:
+                await pdf_arbeit(bereite_dokument_vor, dok, anzahl_dateien, verarbeitete)
+            except Exception as e:
+                VERARBEITUNGSFEHLER.append(f"Vorbereitung fehlgeschlagen ({dok.dateiname}):\n{traceback.format_exc()}")
+                dok.problem(f"❌ Unerwarteter Fehler in der Vorbereitung: {e}", "Fehler")
+            if dok.fertig:
+                await melden(dok)
+            else:
+                await warteschlange.put(dok)
+        for _ in range(konsumenten):
+            await warteschlange.put(None)
+
+    async def konsument():
+        while (dok := await warteschlange.get()) is not None:
+            try:
+                await gpt_stufe(dok)
+            except Exception as e:
+                VERARBEITUNGSFEHLER.append(f"GPT-Stufe fehlgeschlagen ({dok.dateiname}):\n{traceback.format_exc()}")
+                dok.problem(f"❌ Unerwarteter Fehler in der GPT-Stufe: {e}", "Fehler")
+            await melden(dok)
+
+    async def abschluss():
+        for index in range(1, len(dateien) + 1):
+            async with signal:
+                await signal.wait_for(lambda: index in fertige)
+            dok = fertige.pop(index)
+            if dok.vorlage_lernen:
+                await pdf_arbeit(sicher_ausführen, lieferanten_vorlagen().lerne, "Vorlagen-Lernen", dok.analyse, {
+                    feld: dok.kopfdaten[feld] for feld in KOPFDATEN_MUSTER if dok.kopfdaten.get(feld)
+                })
+            if dok.analyse:
+                await pdf_arbeit(dok.analyse.schliessen)
+            await asyncio.to_thread(schliesse_dokument_ab, dok)
+
+    await asyncio.gather(produzent(), abschluss(), *(konsument() for _ in range(konsumenten)))
+
+def finde_eingangsdateien():
+    return list(input_folder.glob("*.pdf")) + list(input_folder.glob("*.xml"))  # 🧾 XRechnung auch als reine XML
+
+def hauptprozess():
+    pruefe_tokenizer()
+    # 🔌 TLS-Handshakes laufen parallel zum Einlesen von Liste und Eingangsordner
+    laufzeit = gpt_laufzeit()
+    vorwaermen = laufzeit.starten(verbindungen_vorwaermen(GPT_VORWAERMEN)) if GPT_VORWAERMEN else None
+    print("🔍 Starte Verarbeitung mit Zwischenspeicherung und Batch-Limit...")
+    pdf_files = finde_eingangsdateien()
+    # ♻️ Inhalts-Hashes entstehen im Hintergrund, während das Protokoll geladen wird
+    verarbeitete = lade_bekannte_dateien(starte_inhalts_hashes(pdf_files[:BATCH_SIZE]))
+    print(f"📂 {len(pdf_files)} Dateien gefunden.")
+    if GPT_BASIS_URL:
+        print(f"🧪 GPT-Aufrufe gehen an {GPT_BASIS_URL}")
+    print(f"⚡ Start mit {GPT_PARALLEL} parallelen GPT-Anfragen (adaptiv {GPT_PARALLEL_MIN}–{GPT_PARALLEL_MAX})")
+    print("")
+    print("═" * 60)  # 🔽 Visuelle Trennung vor erster Datei
+    laufzeit.ausfuehren(verarbeite_dateien(pdf_files[:BATCH_SIZE], len(pdf_files), verarbeitete))
+    PROTOKOLL.festschreiben()
+    indizes_speichern()
+    if PROTOKOLL_EXCEL_AM_ENDE:
+        PROTOKOLL.exportieren()
     if alle_dfs:
-        timestamped = output_excel.parent / f"artikelpositionen_ki_batch_final.xlsx"
-        pd.concat(alle_dfs, ignore_index=True).to_excel(timestamped, index=False)
+        schreibe_batchdatei(pd.concat(alle_dfs, ignore_index=True), output_excel.parent, "final")
 
     merge_and_enrich(output_excel.parent)
+    indizes_speichern()  # Rechnungs-Index kennt jetzt auch die neue Gesamtausgabe
+    if GPT_CACHE_AKTIV:
+        GPT_CACHE.abschliessen()
 
     gesamt_dauer = time.time() - gesamt_start
-    gesamt = anzahl_text + anzahl_ocr
+    gesamt = anzahl_eingang  # 📊 auch Duplikate, unlesbare XML usw. – sonst Prozentwerte über 100 %
     print("\n\n" + "═" * 60) # 🔽 Visuelle Trennung vor der Abschlussausgabe zur besseren Lesbarkeit
     
     # ⏱️ Ausgabe der Gesamtdauer in Stunden, Minuten, Sekunden
@@ -804,8 +3807,320 @@ def hauptprozess():
         print(f"📜 Ø/Datei: {gesamt_dauer/gesamt:.2f}s")
         print(f"📄 Textbasiert: {anzahl_text} ({anzahl_text/gesamt:.1%}), Ø {dauer_text/max(1,anzahl_text):.2f}s")
         print(f"🧠 GPT-OCR: {anzahl_ocr} ({anzahl_ocr/gesamt:.1%}), Ø {dauer_ocr/max(1,anzahl_ocr):.2f}s")
+        print(f"🧾 E-Rechnungen (XML): {anzahl_xml} ({anzahl_xml/gesamt:.1%})")
+        print(f"📐 Lokal extrahiert (ohne GPT-Inhaltsabfrage): {anzahl_lokal}")
         print(f"❌ Nicht-Rechnungen: {nicht_rechnungen} ({nicht_rechnungen/gesamt:.1%})")
         print(f"⚠️ Probleme: {probleme} ({probleme/gesamt:.1%})")
+    if seiten_ausgelassen:
+        print(f"📄 Mischdokumente mit mehr als {OCR_MAX_ZUSATZSEITEN} Seiten ohne Text: {seiten_ausgelassen} "
+              f"(ausgelassene Seiten im Fehlerprotokoll)")
+    if DUPLIKAT_STATISTIK["gleicher_name"] or DUPLIKAT_STATISTIK["umbenannt"] or DUPLIKAT_STATISTIK["name_neuer_inhalt"]:
+        print(f"♻️ Duplikate: {DUPLIKAT_STATISTIK['gleicher_name']} mit bekanntem Namen, "
+              f"{DUPLIKAT_STATISTIK['umbenannt']} umbenannt (gleicher Inhalt), "
+              f"{DUPLIKAT_STATISTIK['name_neuer_inhalt']} bekannte Namen mit neuem Inhalt verarbeitet")
+        for neu, original in UMBENANNTE_DUPLIKATE[:10]:
+            print(f"   ↳ {neu} = {original}")
+    if DUPLIKAT_STATISTIK["fast_text"] or DUPLIKAT_STATISTIK["fast_bild"]:
+        print(f"👯 Fast-Duplikate: {DUPLIKAT_STATISTIK['fast_text']} Texte zur Prüfung aussortiert, "
+              f"{DUPLIKAT_STATISTIK['fast_bild']} Scans mit bekannter erster Seite markiert")
+    if DUPLIKAT_STATISTIK["rechnung"]:
+        print(f"🔑 Rechnungen bereits erfasst (Lieferant, Nummer, Betrag): {DUPLIKAT_STATISTIK['rechnung']}, "
+              f"ohne vollständigen Schlüssel: {DUPLIKAT_STATISTIK['ohne_rechnungsschluessel']}")
+        for neu, erfasst in RECHNUNGS_DUPLIKATE[:10]:
+            print(f"   ↳ {neu} = {erfasst}")
+    if GPT_CACHE_AKTIV:
+        cache = GPT_CACHE.statistik
+        quote = cache["treffer"] / max(1, cache["treffer"] + cache["fehlschlaege"])
+        print(f"💾 GPT-Cache: {cache['treffer']} Treffer, {cache['fehlschlaege']} Fehlschläge ({quote:.0%} Trefferquote), "
+              f"{cache['verdraengt']} verdrängt")
+    else:
+        print("💾 GPT-Cache umgangen (--ohne-cache)")
+    if TEXTAUSWAHL_STATISTIK["gekuerzt"]:
+        print(f"✂️ Token-Budget: {TEXTAUSWAHL_STATISTIK['gekuerzt']} Text(e) gekürzt, "
+              f"{TEXTAUSWAHL_STATISTIK['tokens_vorher']} → {TEXTAUSWAHL_STATISTIK['tokens_nachher']} Tokens "
+              f"({'tiktoken' if tokenizer() else 'geschätzt'})")
+    if REGEL_STATISTIK["entschieden"] or REGEL_STATISTIK["unklar"]:
+        entschieden = REGEL_STATISTIK["entschieden"]
+        typen = ", ".join(f"{name[4:]} {wert}" for name, wert in sorted(REGEL_STATISTIK.items()) if name.startswith("typ_"))
+        print(f"🏷️ Regelklassifikation: {entschieden} lokal entschieden ({typen or '–'}), "
+              f"{REGEL_STATISTIK['unklar']} unklar → GPT")
+        if REGEL_STATISTIK["verglichen"]:
+            print(f"🏷️ Übereinstimmung Regel/GPT: {REGEL_STATISTIK['uebereinstimmung']}/{REGEL_STATISTIK['verglichen']} "
+                  f"({REGEL_STATISTIK['uebereinstimmung'] / REGEL_STATISTIK['verglichen']:.0%})")
+        for (regel, gpt), anzahl in REGEL_ABWEICHUNGEN.most_common(5):
+            print(f"   ↳ Regel {regel} / GPT {gpt}: {anzahl}×")
+    if MODELL_STATISTIK["entschieden"] or MODELL_STATISTIK["unsicher"]:
+        typen = ", ".join(f"{name[4:]} {wert}" for name, wert in sorted(MODELL_STATISTIK.items()) if name.startswith("typ_"))
+        print(f"🎓 Modellklassifikation: {MODELL_STATISTIK['entschieden']} lokal entschieden ({typen or '–'}), "
+              f"{MODELL_STATISTIK['unsicher']} unter p {MODELL_MIN_WAHRSCHEINLICHKEIT} → GPT")
+        if MODELL_STATISTIK["verglichen"]:
+            print(f"🎓 Übereinstimmung Modell/GPT: {MODELL_STATISTIK['uebereinstimmung']}/{MODELL_STATISTIK['verglichen']} "
+                  f"({MODELL_STATISTIK['uebereinstimmung'] / MODELL_STATISTIK['verglichen']:.0%})")
+        for (modell, gpt), anzahl in MODELL_ABWEICHUNGEN.most_common(5):
+            print(f"   ↳ Modell {modell} / GPT {gpt}: {anzahl}×")
+    for stufe in [*GPT_MODELLE, "fest"]:
+        antworten = ROUTING_STATISTIK[(stufe, "antworten")]
+        if antworten:
+            live = ROUTING_STATISTIK[(stufe, "live")]
+            print(f"🪜 Modell-Stufe {stufe} ({GPT_MODELLE.get(stufe, 'vom Aufrufer')}): {antworten} Antworten, "
+                  f"{ROUTING_STATISTIK[(stufe, 'gueltig')] / antworten:.0%} gültig, "
+                  f"{ROUTING_STATISTIK[(stufe, 'eskaliert')]} eskaliert, "
+                  f"Ø {ROUTING_STATISTIK[(stufe, 'sekunden')] / max(1, live):.2f}s je Live-Aufruf")
+    if STREAM_STATISTIK["gestreamt"]:
+        abbrueche = sum(wert for name, wert in STREAM_STATISTIK.items() if name.startswith("abbruch_"))
+        print(f"📡 Gestreamt: {STREAM_STATISTIK['gestreamt']} Antworten, {STREAM_STATISTIK['zeilen']} Positionen, "
+              f"{abbrueche} früh abgebrochen (davon Nicht-Rechnung: {STREAM_STATISTIK['abbruch_nicht_rechnung']}), "
+              f"Ø erste Position nach {STREAM_STATISTIK['erste_zeile_sekunden'] / max(1, STREAM_STATISTIK['mit_zeilen']):.2f}s, "
+              f"Ø komplett nach {STREAM_STATISTIK['gesamt_sekunden'] / STREAM_STATISTIK['gestreamt']:.2f}s")
+    if BATCH_ANTWORTEN:
+        print(f"🗂️ Batch-Antworten genutzt: {BATCH_STATISTIK['genutzt']}, zusätzlich live: {BATCH_STATISTIK['live']}, "
+              f"unbrauchbare Batch-Antworten: {BATCH_STATISTIK['unbrauchbar']}")
+    if vorwaermen is not None and vorwaermen.done() and not vorwaermen.exception():
+        offen, dauer = vorwaermen.result()
+        print(f"🔌 {offen}/{GPT_VORWAERMEN} GPT-Verbindungen beim Start vorgewärmt ({dauer:.2f}s, "
+              f"HTTP/2: {'ja' if GPT_HTTP2 else 'nein'})")
+    if laufzeit._planer is not None:
+        planer = laufzeit.planer
+        print(f"🚦 GPT-Anfragen: {planer.statistik['anfragen']}, Tokens: {planer.statistik['tokens']}, "
+              f"429: {planer.statistik['429']}, Wiederholungen: {planer.statistik['wiederholungen']}, "
+              f"Parallelität am Ende: {planer.limit}")
+        aufgaben = sorted({aufgabe for aufgabe, _ in planer.stufen})
+        timeouts = ", ".join(f"{a} {planer.stufen[(a, 'timeouts')]}" for a in aufgaben if planer.stufen[(a, "timeouts")])
+        print(f"⏱️ Deadline-Überschreitungen je Stufe: {timeouts or 'keine'}")
+        for aufgabe in aufgaben:
+            if planer.stufen[(aufgabe, "hedges")]:
+                print(f"🪞 Hedging {aufgabe}: {planer.stufen[(aufgabe, 'hedges')]} Zweitanfragen, "
+                      f"{planer.stufen[(aufgabe, 'hedge_gewonnen')]} davon schneller "
+                      f"(p{GPT_HEDGE_PERZENTIL * 100:.0f} zuletzt {planer.perzentil(aufgabe):.1f}s)")
+
+# ==========================================
+# 🗂️ BATCH-MODUS (OPENAI BATCH API)
+# ==========================================
+# Ablauf mit Zustandsdatei, jeder Aufruf von `--batch` macht dort weiter, wo der letzte aufgehört hat:
+#   vorbereitet → gesendet → abgeholt → eingelesen
+# Beim Einlesen läuft die normale Pipeline; gpt_anfrage nimmt dabei die Batch-Antworten statt Live-Aufrufen.
+
+BATCH_ENDZUSTAENDE = {"completed", "failed", "expired", "cancelled"}
+
+class OpenAIBatchClient:
+    """Batch-API von OpenAI: Datei hochladen, Job starten, Status abfragen, Ergebnisse herunterladen."""
+
+    def __init__(self):
+        self.client = OpenAI(api_key=api_key, base_url=GPT_BASIS_URL, timeout=GPT_TIMEOUT,
+                             http_client=gpt_http_client(False))
+
+    def starten(self, anfragen_datei):
+        with open(anfragen_datei, "rb") as f:
+            datei = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=datei.id, endpoint="/v1/chat/completions", completion_window=BATCH_ZEITFENSTER
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        zaehler = batch.request_counts
+        return {
+            "status": batch.status,
+            "ergebnis_datei": batch.output_file_id,
+            "fehler_datei": batch.error_file_id,
+            "fortschritt": f"{zaehler.completed}/{zaehler.total}" if zaehler else "?",
+        }
+
+    def herunterladen(self, datei_id, ziel):
+        Path(ziel).write_text(self.client.files.content(datei_id).text, encoding="utf-8")
+
+class LokalerBatchClient:
+    """Offline-Stand-in mit demselben Ablauf: beantwortet jede Zeile sofort über `antwort_funktion(body)`.
+
+    Ohne eigene Funktion gibt es neutrale Antworten ("sonstiges"), damit Zustandsdatei, Ergebnisformat
+    und Einlesen ohne API-Zugang durchgespielt werden können.
+    """
+
+    def __init__(self, antwort_funktion=None):
+        self.antwort_funktion = antwort_funktion or self.standard_antwort
+
+    @staticmethod
+    def standard_antwort(body):
+        if body.get("response_format", {}).get("type") in ("json_object", "json_schema"):
+            return json.dumps({"dokumenttyp": "sonstiges", "kopfdaten": {}, "positionen": []})
+        return "sonstiges"
+
+    def starten(self, anfragen_datei):
+        batch_id = f"lokal_{datetime.now():%Y%m%d_%H%M%S}"
+        with open(anfragen_datei, encoding="utf-8") as quelle, \
+                open(BATCH_ORDNER / f"{batch_id}_ergebnisse.jsonl", "w", encoding="utf-8") as ziel:
+            for zeile in quelle:
+                anfrage = json.loads(zeile)
+                antwort = {"choices": [{"index": 0, "message": {"role": "assistant",
+                                                                "content": self.antwort_funktion(anfrage["body"])}}]}
+                ziel.write(json.dumps({"custom_id": anfrage["custom_id"],
+                                       "response": {"status_code": 200, "body": antwort}}, ensure_ascii=False) + "\n")
+        return batch_id
+
+    def status(self, batch_id):
+        return {"status": "completed", "ergebnis_datei": f"{batch_id}_ergebnisse.jsonl", "fehler_datei": None,
+                "fortschritt": "lokal"}
+
+    def herunterladen(self, datei_id, ziel):
+        shutil.copyfile(BATCH_ORDNER / datei_id, ziel)
+
+def batch_anfrage(aufgabe, messages, **parameter):
+    # Batch-Datei enthält nur die erste Modell-Stufe; Eskalationen laufen beim Einlesen live
+    return anfrage_parameter(messages, model=modell_stufen(aufgabe)[0][1], **parameter)
+
+def batch_anfragen_fuer(dok):
+    """Spiegelt die ersten GPT-Schritte von gpt_stufe als fertige Request-Bodies.
+
+    Folgeanfragen, die erst aus einer Antwort entstehen (z. B. der Inhalt eines Mischdokuments nach der
+    Seiten-OCR), fehlen in der Batch-Datei und laufen beim Einlesen live.
+    """
+    if dok.fertig or dok.verfahren not in ("gpt-ocr", "text"):
+        return []
+    if dok.verfahren == "text" and dok.seitenbilder:
+        return [batch_anfrage("ocr", baue_ocr_anfrage(b64)) for b64 in dok.seitenbilder.values()]
+    lokal_sicher = dok.lokal_sicher
+    # Wie gpt_stufe: was Regeln oder Modell entscheiden, kostet keine Batch-Anfrage
+    _, _, lokal_typ = lokale_klassifikation(dok)
+    if lokal_typ and lokal_typ != "rechnung":
+        return []
+    if GPT_KOMBI_MODUS and not lokal_sicher:
+        return [batch_anfrage("kombi", baue_kombi_anfrage(text=dok.text, b64_image=dok.b64), **KOMBI_PARAMETER)]
+    if dok.verfahren == "gpt-ocr":
+        return [
+            batch_anfrage("klassifikation", baue_klassifikations_anfrage(image_b64=dok.b64)),
+            batch_anfrage("ocr", baue_ocr_anfrage(dok.b64)),
+            batch_anfrage("inhalt", baue_inhalts_anfrage(b64_image=dok.b64), **INHALT_PARAMETER),
+        ]
+    anfragen = [] if lokal_typ else [batch_anfrage("klassifikation", baue_klassifikations_anfrage(text=dok.text))]
+    if not lokal_sicher:
+        anfragen.append(batch_anfrage("inhalt", baue_inhalts_anfrage(text=dok.text), **INHALT_PARAMETER))
+    return anfragen
+
+def batch_vorbereiten():
+    # Schritt 1: alle GPT-Anfragen für den Eingangsordner als JSONL schreiben (ohne Dateien zu verschieben)
+    pruefe_tokenizer()
+    dateien = finde_eingangsdateien()[:BATCH_SIZE]
+    verarbeitete = lade_bekannte_dateien(starte_inhalts_hashes(dateien))
+    zeilen = {}
+    for index, pfad in enumerate(dateien, 1):
+        dok = Dokument(index, pfad)
+        try:
+            bereite_dokument_vor(dok, len(dateien), verarbeitete)
+            for kwargs in batch_anfragen_fuer(dok):
+                zeilen[anfrage_schluessel(kwargs)] = kwargs
+        except Exception as e:
+            VERARBEITUNGSFEHLER.append(f"Batch-Vorbereitung fehlgeschlagen ({dok.dateiname}): {e}")
+        finally:
+            if dok.analyse:
+                dok.analyse.schliessen()
+    # Der Hauptlauf geht dieselben Dateien noch einmal durch – die Vorbereitung zählt nicht mit
+    for statistik in (DUPLIKAT_STATISTIK, REGEL_STATISTIK, MODELL_STATISTIK):
+        statistik.clear()
+    UMBENANNTE_DUPLIKATE.clear()
+    with open(BATCH_ANFRAGEN_DATEI, "w", encoding="utf-8") as f:
+        for schluessel, kwargs in zeilen.items():
+            f.write(json.dumps({"custom_id": schluessel, "method": "POST", "url": "/v1/chat/completions",
+                                "body": kwargs}, ensure_ascii=False) + "\n")
+    print(f"🗂️ {len(zeilen)} GPT-Anfragen für {len(dateien)} Dateien in {BATCH_ANFRAGEN_DATEI.name} geschrieben")
+    return len(zeilen)
+
+def batch_antwort_text(eintrag):
+    # Eine Ergebniszeile → (Antworttext, None) oder (None, Grund), warum sie nicht verwertbar ist
+    antwort = eintrag.get("response") or {}
+    body = antwort.get("body") or {}
+    fehler = eintrag.get("error") or body.get("error")
+    if fehler:
+        if isinstance(fehler, dict):
+            fehler = fehler.get("code") or fehler.get("message")
+        return None, f"Fehler {fehler}"
+    if antwort.get("status_code") != 200:
+        return None, f"HTTP-Status {antwort.get('status_code')}"
+    wahl = (body.get("choices") or [{}])[0]
+    nachricht = wahl.get("message") or {}
+    if nachricht.get("refusal"):
+        return None, f"abgelehnt ({nachricht['refusal'][:80]})"
+    inhalt = (nachricht.get("content") or "").strip()
+    if not inhalt:
+        return None, f"ohne Inhalt (finish_reason: {wahl.get('finish_reason')})"
+    return inhalt, None
+
+def lese_batch_ergebnisse(pfad):
+    # Nur verwertbare Zeilen – fehlgeschlagene, abgelehnte oder leere Antworten laufen beim Einlesen live
+    # und werden dort pro Dokument behandelt. Eine kaputte Zeile kostet nicht den Rest des Batches
+    antworten = {}
+    with open(pfad, encoding="utf-8") as f:
+        for nummer, zeile in enumerate(f, 1):
+            if not zeile.strip():
+                continue
+            try:
+                eintrag = json.loads(zeile)
+                kennung = eintrag["custom_id"]
+                inhalt, grund = batch_antwort_text(eintrag)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                kennung, inhalt, grund = f"Zeile {nummer}", None, f"unlesbar ({e})"
+            if inhalt is not None:
+                antworten[kennung] = inhalt
+                continue
+            BATCH_STATISTIK["unbrauchbar"] += 1
+            VERARBEITUNGSFEHLER.append(f"Batch-Antwort {kennung}: {grund} → wird live angefragt")
+    if BATCH_STATISTIK["unbrauchbar"]:
+        print(f"⚠️ {BATCH_STATISTIK['unbrauchbar']} Batch-Antwort(en) nicht verwertbar – diese Anfragen laufen live")
+    return antworten
+
+def lade_batch_status():
+    if not BATCH_STATUS_DATEI.exists():
+        return None
+    status = json.loads(BATCH_STATUS_DATEI.read_text(encoding="utf-8"))
+    return None if status.get("phase") == "eingelesen" else status
+
+def speichere_batch_status(status):
+    BATCH_STATUS_DATEI.write_text(json.dumps(status, ensure_ascii=False, indent=2), encoding="utf-8")
+
+def batch_modus(batch_client):
+    BATCH_ORDNER.mkdir(exist_ok=True)
+    status = lade_batch_status()
+    if status is None:
+        if not batch_vorbereiten():
+            print("ℹ️ Keine GPT-Anfragen nötig – normale Verarbeitung")
+            hauptprozess()
+            return
+        status = {"phase": "vorbereitet", "erstellt": datetime.now().isoformat(timespec="seconds")}
+        speichere_batch_status(status)
+    else:
+        print(f"🗂️ Setze Batch-Lauf fort (Phase: {status['phase']})")
+
+    if status["phase"] == "vorbereitet":
+        status["batch_id"] = batch_client.starten(BATCH_ANFRAGEN_DATEI)
+        status["phase"] = "gesendet"
+        speichere_batch_status(status)
+        print(f"📤 Batch gesendet: {status['batch_id']}")
+
+    if status["phase"] == "gesendet":
+        while True:
+            zustand = batch_client.status(status["batch_id"])
+            print(f"⏳ Batch {status['batch_id']}: {zustand['status']} ({zustand['fortschritt']})")
+            if zustand["status"] in BATCH_ENDZUSTAENDE:
+                break
+            time.sleep(BATCH_ABFRAGE_INTERVALL)
+        # auch abgelaufene/abgebrochene Jobs liefern Teilergebnisse – der Rest läuft beim Einlesen live
+        BATCH_ERGEBNIS_DATEI.write_text("", encoding="utf-8")
+        if zustand["ergebnis_datei"]:
+            batch_client.herunterladen(zustand["ergebnis_datei"], BATCH_ERGEBNIS_DATEI)
+        if zustand["fehler_datei"]:
+            batch_client.herunterladen(zustand["fehler_datei"], BATCH_FEHLER_DATEI)
+            VERARBEITUNGSFEHLER.append(f"Batch {status['batch_id']}: fehlgeschlagene Anfragen, siehe {BATCH_FEHLER_DATEI.name}")
+        status["phase"] = "abgeholt"
+        status["batch_status"] = zustand["status"]
+        speichere_batch_status(status)
+
+    if status["phase"] == "abgeholt":
+        BATCH_ANTWORTEN.update(lese_batch_ergebnisse(BATCH_ERGEBNIS_DATEI))
+        print(f"📥 {len(BATCH_ANTWORTEN)} Batch-Antworten geladen – starte Verarbeitung")
+        hauptprozess()
+        status["phase"] = "eingelesen"
+        status["eingelesen"] = datetime.now().isoformat(timespec="seconds")
+        speichere_batch_status(status)
 
 # ==========================================
 # 🚀 SKRIPTSTART
@@ -814,12 +4129,24 @@ def hauptprozess():
 print("🧪 Aktive Version: Patchstand 20250618_1445")
 if __name__ == "__main__":
     try:
-        hauptprozess()
+        if "--ohne-cache" in sys.argv:
+            GPT_CACHE_AKTIV = False
+        if "--batch" in sys.argv or "--batch-lokal" in sys.argv:
+            batch_modus(LokalerBatchClient() if "--batch-lokal" in sys.argv else OpenAIBatchClient())
+        elif "--modell-trainieren" in sys.argv:
+            trainiere_dokumenttyp_modell()
+        elif "--rechnungsindex-aufbauen" in sys.argv:
+            baue_rechnungs_index_neu()
+        elif "--protokoll-exportieren" in sys.argv:
+            PROTOKOLL.exportieren()
+        else:
+            hauptprozess()
     except Exception as e:
         print("\n❌ Unerwarteter Abbruch im Hauptprozess:")
         print(f"   {e}")
         VERARBEITUNGSFEHLER.append(f"Hauptprozess-Abbruch: {e}")
     finally:
+        sicher_ausführen(laufzeit_beenden, "Laufzeit beenden")
         print("\n🧾 Zusammenfassung nach Skriptlauf:")
         if VERARBEITUNGSFEHLER:
             print("⚠️ Es sind folgende Fehler aufgetreten:")
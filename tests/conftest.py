@@ -0,0 +1,73 @@
+"""Gemeinsame Fixtures: main.py wird als Kopie in einem temporären Verzeichnis importiert.
+
+Das Skript legt beim Import Log-, Protokoll- und Ausgabedateien neben sich an (basisverzeichnis) –
+so landen sie im Temp-Verzeichnis statt im Projektordner. Netzwerkaufrufe gehen höchstens an den Stub-Server
+auf 127.0.0.1; die Basis-URL zeigt auf einen geschlossenen Port, falls doch einmal etwas durchrutscht.
+"""
+
+import importlib.util
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+PROJEKT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    basis = tmp_path_factory.mktemp("basis")
+    shutil.copy(PROJEKT / "main.py", basis / "main.py")
+    os.environ.setdefault("OPENAI_API_KEY", "test")
+    os.environ["OPENAI_BASE_URL"] = "http://127.0.0.1:9/v1"
+    argv, stdout = sys.argv, sys.stdout
+    sys.argv = ["main.py"]
+    try:
+        spec = importlib.util.spec_from_file_location("main", basis / "main.py")
+        modul = importlib.util.module_from_spec(spec)
+        sys.modules["main"] = modul
+        spec.loader.exec_module(modul)
+    finally:
+        sys.argv, sys.stdout = argv, stdout
+    # Ohne tiktoken-Kodierung (z. B. offline) laufen die Tests mit der ausdrücklich erlaubten Schätzung
+    try:
+        modul.tokenizer()
+    except RuntimeError:
+        modul.GPT_TOKEN_SCHAETZUNG = True
+    return modul
+
+
+@pytest.fixture
+def arbeitsordner(main, tmp_path, monkeypatch):
+    """Eigene Ordner, Indizes und Protokoll je Test – nichts bleibt zwischen Tests hängen."""
+    eingang = tmp_path / "zu_verarbeiten"
+    eingang.mkdir()
+    batch = tmp_path / "gpt_batch"
+    batch.mkdir()
+    monkeypatch.setattr(main, "input_folder", eingang)
+    monkeypatch.setattr(main, "BATCH_ORDNER", batch)
+    monkeypatch.setattr(main, "BATCH_ANFRAGEN_DATEI", batch / "anfragen.jsonl")
+    monkeypatch.setattr(main, "AEHNLICHKEITS_INDEX", tmp_path / "aehnlichkeits_index.json")
+    monkeypatch.setattr(main, "AEHNLICHKEIT", None)
+    monkeypatch.setattr(main, "RECHNUNGS_INDEX", tmp_path / "rechnungs_index.json")
+    monkeypatch.setattr(main, "RECHNUNGEN", None)
+    monkeypatch.setattr(main, "PROTOKOLL", main.Protokoll(tmp_path / "verarbeitete_dateien.sqlite"))
+    monkeypatch.setattr(main, "protokoll_excel", tmp_path / "verarbeitete_dateien.xlsx")
+    monkeypatch.setattr(main, "vorlagen_datei", tmp_path / "lieferanten_vorlagen.json")
+    monkeypatch.setattr(main, "VORLAGEN", None)
+    monkeypatch.setattr(main, "MODELL_DATEI", tmp_path / "dokumenttyp_modell.npz")
+    monkeypatch.setattr(main, "MODELL", None)
+    monkeypatch.setattr(main, "DUPLIKAT_STATISTIK", main.Counter())
+    monkeypatch.setattr(main, "VERARBEITUNGSFEHLER", [])
+    return tmp_path
+
+
+@pytest.fixture(scope="session")
+def stub():
+    """gpt_stub_server.py als Modul – Antworten und Chunks wie im Live-Betrieb."""
+    spec = importlib.util.spec_from_file_location("gpt_stub_server", PROJEKT / "gpt_stub_server.py")
+    modul = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modul)
+    return modul
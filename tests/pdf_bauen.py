@@ -0,0 +1,75 @@
+"""Kleine Test-PDFs mit PyMuPDF: Textlayer-Rechnungen und gescannte Seiten (nur Bild)."""
+
+import pymupdf
+
+
+def rechnungszeilen(nummer, lieferant="Baustoffe Nord GmbH", positionen=8, kopf="Rechnung"):
+    zeilen = [
+        lieferant, "Hafenstraße 12, 20457 Hamburg", "USt-IdNr. DE123456789", "",
+        "Wilhelm Wähler GmbH & Co. KG", "Beckersbergstraße 22", "24558 Henstedt-Ulzburg", "",
+        f"{kopf} Nr. {nummer}", f"Rechnungsdatum: 1{nummer % 9}.04.2025", f"Kundennummer: {4711 + nummer}", "",
+        "Pos  Artikel                          Menge  Einheit  Einzelpreis  Gesamtpreis",
+    ]
+    summe = 0.0
+    for pos in range(1, positionen + 1):
+        menge, preis = pos + nummer % 7, 3.5 * pos + nummer % 11
+        summe += menge * preis
+        zeilen.append(f"{pos:<4} Artikel {nummer}-{pos} Schotter 0/32     {menge:>5}  t        "
+                      f"{preis:>9.2f}  {menge * preis:>10.2f}")
+    zeilen += ["", f"Nettobetrag: {summe:.2f} EUR", f"USt. 19 %: {summe * 0.19:.2f} EUR",
+               f"Gesamtbetrag: {summe * 1.19:.2f} EUR", "", "Zahlbar innerhalb von 14 Tagen ohne Abzug.",
+               "Bankverbindung: Sparkasse Holstein, IBAN DE12 2305 0101 0001 2345 67"]
+    return zeilen
+
+
+def _seite_mit_text(doc, zeilen):
+    seite = doc.new_page(width=595, height=842)
+    for i, zeile in enumerate(zeilen):
+        seite.insert_text((40, 50 + i * 14), zeile, fontsize=9, fontname="cour")
+    return seite
+
+
+def text_pdf(pfad, zeilen):
+    doc = pymupdf.open()
+    _seite_mit_text(doc, zeilen)
+    doc.save(pfad)
+    doc.close()
+    return pfad
+
+
+def scan_pdf(pfad, zeilen, dpi=100):
+    # Seite rendern und nur das Bild einbetten → kein Textlayer, wie vom Scanner
+    vorlage = pymupdf.open()
+    _seite_mit_text(vorlage, zeilen)
+    bild = vorlage[0].get_pixmap(dpi=dpi).tobytes("png")
+    doc = pymupdf.open()
+    seite = doc.new_page(width=595, height=842)
+    seite.insert_image(seite.rect, stream=bild)
+    doc.save(pfad)
+    doc.close()
+    vorlage.close()
+    return pfad
+
+
+def misch_pdf(pfad, seiten):
+    # seiten: Folge aus "text" (Textlayer), "scan" (nur Bild), "vektor" (Schrift als Pfade, ohne Font)
+    # und "leer" – wie ein Mischdokument aus dem Scanner
+    doc = pymupdf.open()
+    for nummer, art in enumerate(seiten):
+        zeilen = rechnungszeilen(100 + nummer)
+        if art == "text":
+            _seite_mit_text(doc, zeilen)
+            continue
+        if art in ("vektor", "leer"):
+            seite = doc.new_page(width=595, height=842)
+            for i in range(len(zeilen) if art == "vektor" else 0):
+                seite.draw_line((40, 50 + i * 14), (40 + 8 * len(zeilen[i]), 50 + i * 14))
+            continue
+        vorlage = pymupdf.open()
+        _seite_mit_text(vorlage, zeilen)
+        seite = doc.new_page(width=595, height=842)
+        seite.insert_image(seite.rect, stream=vorlage[0].get_pixmap(dpi=72).tobytes("png"))
+        vorlage.close()
+    doc.save(pfad)
+    doc.close()
+    return pfad
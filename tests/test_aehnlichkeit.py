@@ -0,0 +1,130 @@
+"""👯 Fast-Duplikate: SimHash/dHash-Abstände, Index-Suche und Batch-Vorbereitung + Hauptlauf."""
+
+import pymupdf
+
+from pdf_bauen import rechnungszeilen, scan_pdf, text_pdf
+
+
+def bits(a, b):
+    return bin(a ^ b).count("1")
+
+
+def test_simhash_kleine_aenderung_bleibt_nah(main):
+    text = "\n".join(rechnungszeilen(4731))
+    kopie = "KOPIE - Gedruckt am 30.05.2025\n" + text
+    assert bits(main.simhash(text), main.simhash(kopie)) <= main.SIMHASH_MAX_ABSTAND
+
+
+def test_simhash_andere_rechnung_ist_weit_weg(main):
+    a = "\n".join(rechnungszeilen(4731))
+    b = "\n".join(rechnungszeilen(1234, lieferant="Tiefbau Süd AG", positionen=3))
+    assert bits(main.simhash(a), main.simhash(b)) > main.SIMHASH_MAX_ABSTAND
+
+
+def test_simhash_zu_kurzer_text(main):
+    assert main.simhash("Rechnung") is None
+
+
+def test_zahlen_signatur_unterscheidet_gleiche_vorlage(main):
+    # Gleiche Vorlage, andere Beträge: Text ähnlich, Zahlen nicht
+    a, b = set(main.zahlen_signatur("\n".join(rechnungszeilen(4731)))), set(main.zahlen_signatur("\n".join(rechnungszeilen(4735))))
+    assert len(a & b) / len(a | b) < main.ZAHLEN_MIN_JACCARD
+
+
+def test_dhash_neu_exportierter_scan(main, tmp_path):
+    zeilen = rechnungszeilen(50365)
+    original = main.PdfAnalyse(scan_pdf(tmp_path / "a.pdf", zeilen, dpi=100))
+    neu = main.PdfAnalyse(scan_pdf(tmp_path / "b.pdf", zeilen, dpi=72))
+    anders = main.PdfAnalyse(scan_pdf(tmp_path / "c.pdf", rechnungszeilen(11, lieferant="Kies & Sand KG", positionen=2)))
+    (grob_a, fein_a), (grob_b, fein_b), (grob_c, fein_c) = map(main.bild_dhash, (original, neu, anders))
+    assert bits(grob_a, grob_b) <= main.DHASH_MAX_ABSTAND and bits(fein_a, fein_b) <= main.DHASH_FEIN_MAX_ABSTAND
+    assert bits(fein_a, fein_c) > main.DHASH_FEIN_MAX_ABSTAND
+
+
+def test_index_findet_bestaetigten_eintrag(main, tmp_path):
+    index = main.AehnlichkeitsIndex(tmp_path / "index.json")
+    text = "\n".join(rechnungszeilen(4731))
+    index.eintragen("original.pdf", "text", main.simhash(text), "h1", zahlen=main.zahlen_signatur(text))
+    index.bestaetigen("original.pdf")
+    kopie = "KOPIE\n" + text
+    treffer = index.suchen("text", main.simhash(kopie), main.zahlen_signatur(kopie), dateiname="kopie.pdf", inhalts_hash="h2")
+    assert treffer and treffer[0] == "original.pdf"
+
+
+def test_index_ignoriert_offene_und_eigene_eintraege(main, tmp_path):
+    index = main.AehnlichkeitsIndex(tmp_path / "index.json")
+    text = "\n".join(rechnungszeilen(4731))
+    signatur, zahlen = main.simhash(text), main.zahlen_signatur(text)
+    index.eintragen("offen.pdf", "text", signatur, "h1", zahlen=zahlen)
+    assert index.suchen("text", signatur, zahlen, dateiname="andere.pdf", inhalts_hash="h9") is None
+    index.bestaetigen("offen.pdf")
+    assert index.suchen("text", signatur, zahlen, dateiname="offen.pdf", inhalts_hash="h9") is None
+    assert index.suchen("text", signatur, zahlen, dateiname="umbenannt.pdf", inhalts_hash="h1") is None
+
+
+def test_index_speichert_nur_bestaetigte_ohne_doppelte(main, tmp_path):
+    pfad = tmp_path / "index.json"
+    index = main.AehnlichkeitsIndex(pfad)
+    text = "\n".join(rechnungszeilen(4731))
+    index.eintragen("a.pdf", "text", main.simhash(text), "h1", zahlen=main.zahlen_signatur(text))
+    index.eintragen("a.pdf", "text", main.simhash(text), "h1", zahlen=main.zahlen_signatur(text))  # Hauptlauf nach Batch
+    index.eintragen("b.pdf", "text", 12345, "h2", zahlen=[1])
+    index.bestaetigen("a.pdf")
+    index.speichern()
+    geladen = main.AehnlichkeitsIndex(pfad)
+    assert [eintrag["datei"] for eintrag in geladen.eintraege] == ["a.pdf"]
+
+
+def test_batch_vorbereitung_dann_hauptlauf_ohne_selbsttreffer(main, arbeitsordner):
+    # Regression: die Batch-Vorbereitung trägt in den Index ein, der Hauptlauf im selben Prozess
+    # fand danach jedes Dokument als sein eigenes Fast-Duplikat
+    eingang = main.input_folder
+    text_pdf(eingang / "r1.pdf", rechnungszeilen(4731))
+    text_pdf(eingang / "r2.pdf", rechnungszeilen(1234, lieferant="Tiefbau Süd AG", positionen=5))
+    scan_pdf(eingang / "scan.pdf", rechnungszeilen(50365))
+
+    main.batch_vorbereiten()
+    assert main.BATCH_ANFRAGEN_DATEI.read_text(encoding="utf-8").strip()
+
+    dateien = main.finde_eingangsdateien()
+    verarbeitete = main.lade_bekannte_dateien()
+    for index, pfad in enumerate(dateien, 1):
+        dok = main.Dokument(index, pfad)
+        main.bereite_dokument_vor(dok, len(dateien), verarbeitete)
+        assert not dok.fertig, dok.protokoll
+        assert dok.duplikat_hinweis is None, dok.protokoll
+        dok.analyse.schliessen()
+    assert main.DUPLIKAT_STATISTIK["fast_text"] == 0 and main.DUPLIKAT_STATISTIK["fast_bild"] == 0
+
+
+def test_kopie_wird_im_naechsten_lauf_erkannt(main, arbeitsordner):
+    eingang = main.input_folder
+    text_pdf(eingang / "original.pdf", rechnungszeilen(4731))
+    dok = main.Dokument(1, eingang / "original.pdf")
+    main.bereite_dokument_vor(dok, 1, main.lade_bekannte_dateien())
+    dok.analyse.schliessen()
+    main.aehnlichkeits_index().bestaetigen("original.pdf")  # wie schliesse_dokument_ab nach dem Archivieren
+
+    doc = pymupdf.open(eingang / "original.pdf")
+    doc[0].insert_text((40, 20), "KOPIE - Gedruckt am 30.05.2025", fontsize=9)
+    doc.save(eingang / "kopie.pdf")
+    doc.close()
+    kopie = main.Dokument(2, eingang / "kopie.pdf")
+    main.bereite_dokument_vor(kopie, 1, main.lade_bekannte_dateien())
+    kopie.analyse.schliessen()
+    assert kopie.ziel is not None and kopie.ziel[1].startswith("Duplikatverdacht_")
+
+
+def test_index_wird_im_lauf_gesichert(main, arbeitsordner, monkeypatch):
+    # Ein Abbruch mitten im Lauf verliert höchstens die Einträge seit der letzten Zwischenspeicherung
+    for name in ("anzahl_eingang", "anzahl_text", "nicht_rechnungen"):
+        monkeypatch.setattr(main, name, 0)
+    monkeypatch.setattr(main, "nicht_rechnung_folder", arbeitsordner / "nicht_rechnung")
+    index = main.aehnlichkeits_index()
+    for nummer in (main.FLUSH_INTERVAL - 1, main.FLUSH_INTERVAL):
+        dok = main.Dokument(nummer, text_pdf(main.input_folder / f"m{nummer}.pdf", rechnungszeilen(nummer, kopf="Mahnung")))
+        index.eintragen(dok.dateiname, "text", nummer, f"h{nummer}", zahlen=[nummer])
+        dok.beenden(main.nicht_rechnung_folder, f"mahnung_{dok.dateiname}")
+        main.schliesse_dokument_ab(dok)
+        gespeichert = main.AehnlichkeitsIndex(main.AEHNLICHKEITS_INDEX).eintraege
+        assert len(gespeichert) == (0 if nummer < main.FLUSH_INTERVAL else 2)
@@ -0,0 +1,86 @@
+"""🗂️ Batch-Vorbereitung: nur Anfragen, die die lokale Klassifikation nicht schon erledigt."""
+
+import json
+
+import pytest
+
+from pdf_bauen import rechnungszeilen, text_pdf
+
+ANGEBOT = ["Baustoffe Nord GmbH", "Hafenstraße 12, 20457 Hamburg", "", "Wilhelm Wähler GmbH & Co. KG", "",
+           "Angebot Nr. A-2025-17", "Sehr geehrte Damen und Herren,",
+           "gerne bieten wir Ihnen folgende Leistungen an. Das Angebot ist 30 Tage gültig.",
+           *[f"Position {i}: Schotter 0/32, {i * 10} t zu je 18,50 EUR" for i in range(1, 12)],
+           "Mit freundlichen Grüßen", "Ihr Team von Baustoffe Nord"]
+UNKLAR = ["Wilhelm Wähler GmbH & Co. KG", "Beckersbergstraße 22", "",
+          *[f"Baustelle {i}: Leitungen verlegt, Schacht gesetzt, Oberfläche wiederhergestellt, {i * 3} m" for i in range(1, 16)]]
+
+
+@pytest.fixture
+def vorbereiten(main, arbeitsordner):
+    def vorbereiten(name, zeilen):
+        pfad = text_pdf(main.input_folder / name, zeilen)
+        dok = main.Dokument(1, pfad)
+        main.bereite_dokument_vor(dok, 1, main.lade_bekannte_dateien())
+        dok.analyse.schliessen()
+        return dok
+    return vorbereiten
+
+
+def aufgaben(main, anfragen, dok):
+    klassifikation = main.batch_anfrage("klassifikation", main.baue_klassifikations_anfrage(text=dok.text))
+    return ["klassifikation" if anfrage == klassifikation else anfrage.get("response_format", {}).get("type", "text")
+            for anfrage in anfragen]
+
+
+@pytest.mark.parametrize("kombi", [True, False])
+def test_lokal_erkannte_nicht_rechnung_braucht_keine_anfrage(main, vorbereiten, monkeypatch, kombi):
+    monkeypatch.setattr(main, "GPT_KOMBI_MODUS", kombi)
+    dok = vorbereiten("angebot.pdf", ANGEBOT)
+    assert main.batch_anfragen_fuer(dok) == []
+
+
+def test_lokal_erkannte_rechnung_ohne_klassifikationsanfrage(main, vorbereiten, monkeypatch):
+    monkeypatch.setattr(main, "GPT_KOMBI_MODUS", False)
+    dok = vorbereiten("rechnung.pdf", rechnungszeilen(4731))
+    assert "klassifikation" not in aufgaben(main, main.batch_anfragen_fuer(dok), dok)
+
+
+def test_unklarer_text_bekommt_klassifikationsanfrage(main, vorbereiten, monkeypatch):
+    monkeypatch.setattr(main, "GPT_KOMBI_MODUS", False)
+    dok = vorbereiten("unklar.pdf", UNKLAR)
+    assert "klassifikation" in aufgaben(main, main.batch_anfragen_fuer(dok), dok)
+
+
+def test_batch_vorbereitung_schreibt_nur_offene_faelle(main, arbeitsordner):
+    text_pdf(main.input_folder / "angebot.pdf", ANGEBOT)
+    text_pdf(main.input_folder / "unklar.pdf", UNKLAR)
+    main.batch_vorbereiten()
+    zeilen = [json.loads(zeile) for zeile in main.BATCH_ANFRAGEN_DATEI.read_text(encoding="utf-8").splitlines()]
+    assert len(zeilen) == 1 and "Baustelle 1" in json.dumps(zeilen[0]["body"], ensure_ascii=False)
+    # Der Hauptlauf zählt selbst – die Vorbereitung hinterlässt keine Statistik
+    assert not main.REGEL_STATISTIK and not main.DUPLIKAT_STATISTIK
+
+
+def test_ergebnisse_ueberspringen_unbrauchbare_zeilen(main, arbeitsordner, monkeypatch):
+    monkeypatch.setattr(main, "BATCH_STATISTIK", main.Counter())
+
+    def zeile(kennung, status=200, **nachricht):
+        body = {"choices": [{"message": {"role": "assistant", **nachricht}, "finish_reason": "stop"}]}
+        return {"custom_id": kennung, "response": {"status_code": status, "body": body}, "error": None}
+
+    zeilen = [
+        zeile("ok", content=" rechnung \n"),
+        zeile("abgelehnt", content=None, refusal="I can't help with that."),
+        zeile("filter", content=None),
+        zeile("status", status=500, content="rechnung"),
+        {"custom_id": "fehler", "response": {"status_code": 200, "body": {"error": {"code": "server_error"}}}},
+        {"custom_id": "abgelaufen", "response": None, "error": {"code": "batch_expired", "message": "expired"}},
+        zeile("auch_ok", content="gutschrift"),
+    ]
+    pfad = arbeitsordner / "ergebnisse.jsonl"
+    pfad.write_text("\n".join(json.dumps(z) for z in zeilen) + '\n{"custom_id": "abgeschnitten", "resp\n',
+                    encoding="utf-8")
+
+    assert main.lese_batch_ergebnisse(pfad) == {"ok": "rechnung", "auch_ok": "gutschrift"}
+    assert main.BATCH_STATISTIK["unbrauchbar"] == 6
+    assert any("abgelehnt" in fehler for fehler in main.VERARBEITUNGSFEHLER)
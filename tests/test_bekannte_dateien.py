@@ -0,0 +1,64 @@
+"""🔁 Duplikaterkennung nach Inhalt: gleiche Datei unter anderem Namen, gleicher Name mit neuem Inhalt, alte Protokollzeilen."""
+
+import pytest
+
+from pdf_bauen import rechnungszeilen, text_pdf
+
+
+@pytest.fixture
+def dateien(main, arbeitsordner):
+    ordner = main.input_folder
+    erste = text_pdf(ordner / "3.pdf", rechnungszeilen(4731))
+    zweite = text_pdf(ordner / "4.pdf", rechnungszeilen(4732))
+    return {pfad.name: main.inhalts_hash(pfad) for pfad in (erste, zweite)}
+
+
+def frueherer_lauf(main, *zeilen):
+    for dateiname, inhalts_hash in zeilen:
+        main.PROTOKOLL.anhaengen(dateiname, inhalts_hash)
+    main.PROTOKOLL.festschreiben()
+    return main.lade_bekannte_dateien()
+
+
+def test_gleicher_inhalt_im_selben_lauf(main, arbeitsordner, dateien):
+    bekannt = main.lade_bekannte_dateien()
+    assert bekannt.duplikat("3.pdf", dateien["3.pdf"]) is None
+    bekannt.merken("3.pdf", dateien["3.pdf"])
+    assert bekannt.duplikat("3 (Kopie).pdf", dateien["3.pdf"]) == "3.pdf"
+    assert bekannt.duplikat("4.pdf", dateien["4.pdf"]) is None
+
+
+def test_umbenannte_datei_aus_frueherem_lauf(main, arbeitsordner, dateien):
+    bekannt = frueherer_lauf(main, ("3.pdf", dateien["3.pdf"]))
+    assert bekannt.duplikat("Rechnung_4731.pdf", dateien["3.pdf"]) == "3.pdf"
+    assert bekannt.bekannter_name("3.pdf") and not bekannt.bekannter_name("Rechnung_4731.pdf")
+
+
+def test_gleicher_name_mit_neuem_inhalt(main, arbeitsordner, dateien):
+    # Scanner vergeben 3.pdf immer wieder – ein anderer Inhalt unter bekanntem Namen ist neu
+    bekannt = frueherer_lauf(main, ("3.pdf", dateien["3.pdf"]))
+    assert bekannt.duplikat("3.pdf", dateien["4.pdf"]) is None
+    bekannt.merken("3.pdf", dateien["4.pdf"])
+    assert bekannt.duplikat("neu.pdf", dateien["4.pdf"]) == "3.pdf"
+
+
+def test_alte_protokollzeilen_ohne_hash(main, arbeitsordner, dateien):
+    # Vor der Hash-Spalte protokolliert: nur der Name ist bekannt → weiter nach Name überspringen
+    bekannt = frueherer_lauf(main, ("3.pdf", None))
+    assert bekannt.duplikat("3.pdf", dateien["4.pdf"]) == "3.pdf"
+    assert bekannt.duplikat("4.pdf", dateien["4.pdf"]) is None
+
+
+def test_ohne_hash_zaehlt_der_name(main, arbeitsordner, dateien):
+    bekannt = frueherer_lauf(main, ("3.pdf", dateien["3.pdf"]))
+    assert bekannt.duplikat("3.pdf", None) == "3.pdf"
+    assert bekannt.duplikat("4.pdf", None) is None
+
+
+def test_hash_aus_hintergrund_oder_fehler(main, arbeitsordner, dateien):
+    pfade = sorted(main.input_folder.glob("*.pdf"))
+    bekannt = main.lade_bekannte_dateien(main.starte_inhalts_hashes(pfade))
+    assert [bekannt.inhalts_hash(pfad) for pfad in pfade] == [dateien["3.pdf"], dateien["4.pdf"]]
+    assert bekannt._laufend == {}
+    assert bekannt.inhalts_hash(main.input_folder / "fehlt.pdf") is None
+    assert "fehlt.pdf" in main.VERARBEITUNGSFEHLER[-1]
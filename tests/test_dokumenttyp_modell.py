@@ -0,0 +1,51 @@
+"""🎓 Dokumenttyp-Modell: Training, Speichern/Laden und Ablehnung fremder Formate."""
+
+import numpy as np
+import pytest
+
+from pdf_bauen import rechnungszeilen
+
+
+def mahnung(nummer):
+    return "\n".join([
+        "Stadtwerke Quickborn", "Mahnung", f"Sehr geehrte Damen und Herren, unsere Rechnung {nummer} ist überfällig.",
+        "Bitte überweisen Sie den offenen Betrag innerhalb von 7 Tagen, sonst erheben wir Mahngebühren.",
+    ])
+
+
+@pytest.fixture
+def beispiele(main):
+    texte = ["\n".join(rechnungszeilen(nummer)) for nummer in range(20)] + [mahnung(nummer) for nummer in range(20)]
+    ziele = np.array([0] * 20 + [1] * 20)
+    return texte, ziele
+
+
+@pytest.fixture
+def modell(main, beispiele):
+    texte, ziele = beispiele
+    return main.DokumenttypModell(["rechnung", "mahnung"], *main.trainiere_softmax(
+        [main.text_merkmale(text) for text in texte], ziele, 2, 20), {"beispiele": len(texte)})
+
+
+def test_nur_genutzte_merkmale_bekommen_gewichte(main, modell):
+    assert len(modell.gewichte) == len(modell.merkmal_indizes) + 1 < main.MODELL_MERKMALE // 10
+    assert np.all(np.diff(modell.merkmal_indizes) > 0)
+    assert not modell.gewichte[-1].any()  # Zeile für unbekannte Merkmale bleibt leer
+
+
+def test_speichern_und_laden(main, arbeitsordner, modell):
+    modell.speichern(main.MODELL_DATEI)
+    geladen = main.dokumenttyp_modell()
+    assert geladen.klassen == ["rechnung", "mahnung"] and geladen.info == {"beispiele": 40}
+    for text in ["\n".join(rechnungszeilen(4731, lieferant="Tiefbau Süd AG")), mahnung(99), "völlig unbekannt ÿ"]:
+        typ, p = geladen.vorhersagen(text)
+        assert (typ, p) == modell.vorhersagen(text)
+    assert geladen.vorhersagen("\n".join(rechnungszeilen(4731, lieferant="Tiefbau Süd AG")))[0] == "rechnung"
+    assert geladen.vorhersagen(mahnung(99))[0] == "mahnung"
+
+
+def test_anderes_format_wird_abgelehnt(main, arbeitsordner, modell, monkeypatch, capsys):
+    modell.speichern(main.MODELL_DATEI)
+    monkeypatch.setattr(main, "MODELL_FORMAT", main.MODELL_FORMAT + 1)
+    assert main.dokumenttyp_modell() is None
+    assert "--modell-trainieren" in capsys.readouterr().out
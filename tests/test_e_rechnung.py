@@ -0,0 +1,122 @@
+"""🧾 E-Rechnungen: CII (ZUGFeRD/Factur-X/XRechnung) und UBL, eingebettet oder als reine XML-Datei."""
+
+import pymupdf
+
+from pdf_bauen import rechnungszeilen, text_pdf
+
+CII_NS = ('xmlns:rsm="urn:un:unece:uncefact:data:standard:CrossIndustryInvoice:100" '
+          'xmlns:ram="urn:un:unece:uncefact:data:standard:ReusableAggregateBusinessInformationEntity:100" '
+          'xmlns:udt="urn:un:unece:uncefact:data:standard:UnqualifiedDataType:100"')
+
+
+def cii(typcode="380", positionen=(("Schotter 0/32", "12.5", "TNE", "18.50", "231.25"),)):
+    zeilen = "".join(f"""
+      <ram:IncludedSupplyChainTradeLineItem>
+        <ram:SpecifiedTradeProduct><ram:Name>{name}</ram:Name></ram:SpecifiedTradeProduct>
+        <ram:SpecifiedLineTradeAgreement><ram:NetPriceProductTradePrice><ram:ChargeAmount>{preis}</ram:ChargeAmount>
+        </ram:NetPriceProductTradePrice></ram:SpecifiedLineTradeAgreement>
+        <ram:SpecifiedLineTradeDelivery><ram:BilledQuantity unitCode="{einheit}">{menge}</ram:BilledQuantity>
+        </ram:SpecifiedLineTradeDelivery>
+        <ram:SpecifiedLineTradeSettlement><ram:SpecifiedTradeSettlementLineMonetarySummation>
+          <ram:LineTotalAmount>{gesamt}</ram:LineTotalAmount></ram:SpecifiedTradeSettlementLineMonetarySummation>
+        </ram:SpecifiedLineTradeSettlement>
+      </ram:IncludedSupplyChainTradeLineItem>""" for name, menge, einheit, preis, gesamt in positionen)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<rsm:CrossIndustryInvoice {CII_NS}>
+  <rsm:ExchangedDocument>
+    <ram:ID>RE-2025-0815</ram:ID><ram:TypeCode>{typcode}</ram:TypeCode>
+    <ram:IssueDateTime><udt:DateTimeString format="102">20250419</udt:DateTimeString></ram:IssueDateTime>
+  </rsm:ExchangedDocument>
+  <rsm:SupplyChainTradeTransaction>{zeilen}
+    <ram:ApplicableHeaderTradeAgreement>
+      <ram:SellerTradeParty><ram:Name>Baustoffe Nord GmbH</ram:Name>
+        <ram:SpecifiedTaxRegistration><ram:ID schemeID="FC">12/345/67890</ram:ID></ram:SpecifiedTaxRegistration>
+        <ram:SpecifiedTaxRegistration><ram:ID schemeID="VA">DE123456789</ram:ID></ram:SpecifiedTaxRegistration>
+      </ram:SellerTradeParty>
+      <ram:BuyerTradeParty><ram:Name>Wilhelm Wähler GmbH &amp; Co. KG</ram:Name></ram:BuyerTradeParty>
+    </ram:ApplicableHeaderTradeAgreement>
+    <ram:ApplicableHeaderTradeSettlement><ram:SpecifiedTradeSettlementHeaderMonetarySummation>
+      <ram:GrandTotalAmount>275.19</ram:GrandTotalAmount>
+    </ram:SpecifiedTradeSettlementHeaderMonetarySummation></ram:ApplicableHeaderTradeSettlement>
+  </rsm:SupplyChainTradeTransaction>
+</rsm:CrossIndustryInvoice>""".encode()
+
+
+def ubl(gutschrift=False, menge="4"):
+    art, zeile, mengenfeld = ("CreditNote", "CreditNoteLine", "CreditedQuantity") if gutschrift else \
+        ("Invoice", "InvoiceLine", "InvoicedQuantity")
+    typ = "" if gutschrift else "<cbc:InvoiceTypeCode>380</cbc:InvoiceTypeCode>"
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<{art} xmlns="urn:oasis:names:specification:ubl:schema:xsd:{art}-2"
+  xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+  xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">
+  <cbc:ID>XR-77</cbc:ID><cbc:IssueDate>2025-04-19</cbc:IssueDate>{typ}
+  <cac:AccountingSupplierParty><cac:Party>
+    <cac:PartyTaxScheme><cbc:CompanyID>DE987654321</cbc:CompanyID></cac:PartyTaxScheme>
+    <cac:PartyLegalEntity><cbc:RegistrationName>Tiefbau Süd AG</cbc:RegistrationName></cac:PartyLegalEntity>
+  </cac:Party></cac:AccountingSupplierParty>
+  <cac:AccountingCustomerParty><cac:Party><cac:PartyName><cbc:Name>Wilhelm Wähler GmbH</cbc:Name></cac:PartyName>
+  </cac:Party></cac:AccountingCustomerParty>
+  <cac:LegalMonetaryTotal><cbc:TaxInclusiveAmount currencyID="EUR">119.00</cbc:TaxInclusiveAmount></cac:LegalMonetaryTotal>
+  <cac:{zeile}>
+    <cbc:{mengenfeld} unitCode="HUR">{menge}</cbc:{mengenfeld}>
+    <cbc:LineExtensionAmount currencyID="EUR">100.00</cbc:LineExtensionAmount>
+    <cac:Item><cbc:Name>Baggerarbeiten</cbc:Name></cac:Item>
+    <cac:Price><cbc:PriceAmount currencyID="EUR">25.00</cbc:PriceAmount></cac:Price>
+  </cac:{zeile}>
+</{art}>""".encode()
+
+
+def test_cii_rechnung(main):
+    typ, df = main.parse_e_rechnung(cii(), "r.pdf")
+    assert typ == "rechnung"
+    kopf = df.iloc[0]
+    assert (kopf["Lieferant"], kopf["USt_IdNr"], kopf["Rechnungsnummer"]) == ("Baustoffe Nord GmbH", "DE123456789", "RE-2025-0815")
+    assert kopf["Rechnungsdatum"] == "19.04.2025" and kopf["Gesamtbetrag"] == 275.19
+    assert (kopf["Menge"], kopf["Einheit"], kopf["Gesamtpreis"]) == (12.5, "Tonne", 231.25)
+
+
+def test_cii_gutschrift(main):
+    typ, _ = main.parse_e_rechnung(cii(typcode="381"), "g.pdf")
+    assert typ == "gutschrift"
+
+
+def test_cii_ohne_positionen(main):
+    assert main.parse_e_rechnung(cii(positionen=()), "leer.pdf") is None
+
+
+def test_ubl_rechnung_und_gutschrift(main):
+    typ, df = main.parse_e_rechnung(ubl(), "r.xml")
+    assert typ == "rechnung" and df.iloc[0]["Lieferant"] == "Tiefbau Süd AG" and df.iloc[0]["Menge"] == 4.0
+    typ, df = main.parse_e_rechnung(ubl(gutschrift=True), "g.xml")
+    assert typ == "gutschrift" and df.iloc[0]["Einheit"] == "Stunde"
+
+
+def test_ubl_unlesbare_menge(main):
+    # Regression: float("1 Stk") brach den XML-Pfad ab
+    typ, df = main.parse_e_rechnung(ubl(menge="1 Stk"), "r.xml")
+    assert typ == "rechnung" and df.iloc[0]["Menge"] is None
+
+
+def test_eingebettete_e_rechnung(main, tmp_path):
+    pfad = text_pdf(tmp_path / "zugferd.pdf", rechnungszeilen(4731))
+    doc = pymupdf.open(pfad)
+    doc.embfile_add("kaputt.xml", b"<Invoice><nicht", filename="kaputt.xml")
+    doc.embfile_add("factur-x.xml", cii(), filename="factur-x.xml")
+    doc.saveIncr()
+    doc.close()
+    with main.PdfAnalyse(pfad) as analyse:
+        typ, df = main.lese_e_rechnung(analyse)
+    assert typ == "rechnung" and df.iloc[0]["Dateiname"] == "zugferd.pdf"
+
+
+def test_kaputte_anhaenge_fallen_auf_pdf_zurueck(main, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "VERARBEITUNGSFEHLER", [])
+    pfad = text_pdf(tmp_path / "anhang.pdf", rechnungszeilen(4731))
+    doc = pymupdf.open(pfad)
+    doc.embfile_add("factur-x.xml", b"<rsm:CrossIndustryInvoice", filename="factur-x.xml")
+    doc.saveIncr()
+    doc.close()
+    with main.PdfAnalyse(pfad) as analyse:
+        assert main.lese_e_rechnung(analyse) is None
+    assert main.VERARBEITUNGSFEHLER and "anhang.pdf" in main.VERARBEITUNGSFEHLER[0]
@@ -0,0 +1,76 @@
+"""💾 GPT-Cache: stabile Schlüssel, gruppierte Zugriffszeiten und Verdrängung nach Alter und Größe."""
+
+import time
+
+import pytest
+
+
+def anfrage(**abweichend):
+    kwargs = {"model": "gpt-4o", "temperature": 0.3,
+              "messages": [{"role": "user", "content": [{"type": "text", "text": "Rechnung Nr. 4731"}]}]}
+    return {**kwargs, **abweichend}
+
+
+@pytest.fixture
+def cache(main, tmp_path):
+    cache = main.GptCache(tmp_path / "gpt_cache.sqlite")
+    yield cache
+    cache.db.close()
+
+
+def test_schluessel_unabhaengig_von_reihenfolge(main):
+    umgestellt = {"messages": [{"content": [{"text": "Rechnung Nr. 4731", "type": "text"}], "role": "user"}],
+                  "temperature": 0.3, "model": "gpt-4o"}
+    assert main.GptCache.schluessel("klassifikation", anfrage()) == main.GptCache.schluessel("klassifikation", umgestellt)
+
+
+@pytest.mark.parametrize("abweichend", [
+    {"model": "gpt-4o-mini"}, {"temperature": 0.0}, {"response_format": {"type": "json_object"}},
+    {"messages": [{"role": "user", "content": [{"type": "text", "text": "Rechnung Nr. 4732"}]}]},
+])
+def test_schluessel_aendert_sich_mit_der_anfrage(main, abweichend):
+    assert main.GptCache.schluessel("klassifikation", anfrage()) != main.GptCache.schluessel("klassifikation", anfrage(**abweichend))
+
+
+def test_neue_prompt_version_verfehlt_den_cache(main, monkeypatch):
+    alt = main.GptCache.schluessel("klassifikation", anfrage())
+    monkeypatch.setitem(main.PROMPT_VERSIONEN, "klassifikation", main.PROMPT_VERSIONEN.get("klassifikation", 1) + 1)
+    assert main.GptCache.schluessel("klassifikation", anfrage()) != alt
+    assert main.GptCache.schluessel("inhalt", anfrage()) != alt
+
+
+def test_treffer_schreiben_gruppenweise(main, cache, monkeypatch):
+    monkeypatch.setattr(main, "GPT_CACHE_ZUGRIFFE_GRUPPE", 3)
+    for nummer in range(3):
+        cache.schreiben(f"s{nummer}", "klassifikation", "gpt-4o", "rechnung")
+    aenderungen = cache.db.total_changes
+    assert cache.lesen("s0") == "rechnung" and cache.lesen("s1") == "rechnung"
+    assert cache.lesen("fehlt") is None
+    assert cache.db.total_changes == aenderungen  # Treffer ohne Schreibtransaktion
+    cache.lesen("s2")
+    assert cache.db.total_changes == aenderungen + 3 and not cache.zugriffe
+    assert cache.statistik["treffer"] == 3 and cache.statistik["fehlschlaege"] == 1
+
+
+def test_alte_eintraege_am_laufende_verworfen(main, cache):
+    cache.schreiben("alt", "klassifikation", "gpt-4o", "rechnung")
+    cache.schreiben("neu", "klassifikation", "gpt-4o", "rechnung")
+    with cache.db:
+        cache.db.execute("UPDATE antworten SET erstellt = ? WHERE schluessel = 'alt'",
+                         (time.time() - (main.GPT_CACHE_MAX_TAGE + 1) * 86400,))
+    cache.abschliessen()
+    assert cache.lesen("alt") is None and cache.lesen("neu") == "rechnung"
+    assert cache.statistik["verdraengt"] == 1
+
+
+def test_groessengrenze_greift_im_lauf(main, cache, monkeypatch):
+    monkeypatch.setattr(main, "GPT_CACHE_MAX_MB", 1000 / (1024 * 1024))  # 1000 Bytes
+    antwort = "x" * 400
+    cache.schreiben("a", "inhalt", "gpt-4o", antwort)
+    cache.schreiben("b", "inhalt", "gpt-4o", antwort)
+    time.sleep(0.01)
+    assert cache.lesen("a") == antwort  # a zuletzt genutzt → b wird verdrängt
+    cache.schreiben("c", "inhalt", "gpt-4o", antwort)
+    assert cache.lesen("b") is None
+    assert cache.lesen("a") == antwort and cache.lesen("c") == antwort
+    assert cache.groesse <= 1000
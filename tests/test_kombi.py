@@ -0,0 +1,69 @@
+"""🧩 Kombinierte GPT-Abfrage: Typ, Kopfdaten und Positionen in einem Aufruf – für Text und Bild."""
+
+import asyncio
+import json
+
+import pytest
+
+from pdf_bauen import rechnungszeilen, scan_pdf, text_pdf
+
+UNKLAR = ["Wilhelm Wähler GmbH & Co. KG", "Beckersbergstraße 22", "",
+          *[f"Baustelle {i}: Leitungen verlegt, Schacht gesetzt, Oberfläche wiederhergestellt, {i * 3} m" for i in range(1, 16)]]
+
+
+@pytest.fixture
+def gpt(main, stub, monkeypatch):
+    """Antwort je Aufgabe vorgeben (Standard: schema-konforme Kombi-Antwort mit zwei Positionen)."""
+    antworten = {"kombi": json.dumps(stub.beispiel_aus_schema(main.KOMBI_SCHEMA, 2)), "klassifikation": "rechnung",
+                 "inhalt": json.dumps(stub.beispiel_aus_schema(main.RECHNUNGS_SCHEMA, 3))}
+    aufrufe = []
+
+    async def gpt_anfrage(aufgabe, messages, **kwargs):
+        inhalt = messages[-1]["content"]
+        aufrufe.append((aufgabe, [teil["type"] for teil in inhalt] if isinstance(inhalt, list) else ["text"]))
+        return antworten[aufgabe]
+
+    monkeypatch.setattr(main, "gpt_anfrage", gpt_anfrage)
+    return antworten, aufrufe
+
+
+@pytest.fixture
+def durchlaufen(main, arbeitsordner):
+    def durchlaufen(pfad):
+        dok = main.Dokument(1, pfad)
+        main.bereite_dokument_vor(dok, 1, main.lade_bekannte_dateien())
+        asyncio.run(main.gpt_stufe(dok))
+        dok.analyse.schliessen()
+        return dok
+    return durchlaufen
+
+
+def test_text_ein_aufruf(main, gpt, durchlaufen):
+    _, aufrufe = gpt
+    dok = durchlaufen(text_pdf(main.input_folder / "unklar.pdf", UNKLAR))
+    assert aufrufe == [("kombi", ["text", "text"])]
+    assert dok.klassifikation == "rechnung" and len(dok.df) == 2
+
+
+def test_scan_ein_aufruf_mit_bild(main, gpt, durchlaufen):
+    _, aufrufe = gpt
+    dok = durchlaufen(scan_pdf(main.input_folder / "scan.pdf", rechnungszeilen(4731)))
+    assert dok.verfahren == "gpt-ocr"
+    assert aufrufe == [("kombi", ["text", "image_url"])]  # Bild nur einmal hochgeladen, kein OCR-Aufruf
+    assert len(dok.df) == 2 and dok.text.startswith("Stub")
+
+
+def test_nicht_rechnung_ohne_weitere_aufrufe(main, gpt, durchlaufen):
+    antworten, aufrufe = gpt
+    antworten["kombi"] = json.dumps({"dokumenttyp": "mahnung", "kopfdaten": {}, "positionen": []})
+    dok = durchlaufen(text_pdf(main.input_folder / "unklar.pdf", UNKLAR))
+    assert [aufgabe for aufgabe, _ in aufrufe] == ["kombi"]
+    assert dok.ziel[1] == "mahnung_unklar.pdf"
+
+
+def test_unlesbare_antwort_faellt_auf_getrennte_aufrufe_zurueck(main, gpt, durchlaufen):
+    antworten, aufrufe = gpt
+    antworten["kombi"] = "kein JSON"
+    dok = durchlaufen(text_pdf(main.input_folder / "unklar.pdf", UNKLAR))
+    assert [aufgabe for aufgabe, _ in aufrufe] == ["kombi", "klassifikation", "inhalt"]
+    assert len(dok.df) == 3
@@ -0,0 +1,69 @@
+"""📐 Lokale Tabellenerkennung: Artikelpositionen aus Wortkoordinaten, ohne GPT."""
+
+import pymupdf
+import pytest
+
+from pdf_bauen import rechnungszeilen, scan_pdf, text_pdf
+
+KOPF = "Pos  Bezeichnung                      Menge  Einheit  Einzelpreis  Gesamtpreis"
+
+
+def zeile(pos, text, menge, preis, gesamt):
+    return f"{pos:<4} {text:<32} {menge:>5}  t        {preis:>9}  {gesamt:>10}"
+
+
+def seiten_pdf(pfad, seiten):
+    doc = pymupdf.open()
+    for zeilen in seiten:
+        seite = doc.new_page(width=595, height=842)
+        for i, text in enumerate(zeilen):
+            seite.insert_text((40, 50 + i * 14), text, fontsize=9, fontname="cour")
+    doc.save(pfad)
+    doc.close()
+    return pfad
+
+
+@pytest.mark.parametrize("text, zahl", [
+    ("1.234,56", 1234.56), ("12,50-", -12.5), ("4.500", 4500.0), ("18.50", 18.5), ("€ 7,00", 7.0),
+    ("0/32", None), ("", None), (None, None),
+])
+def test_deutsche_zahlen(main, text, zahl):
+    assert main.parse_deutsche_zahl(text) == zahl
+
+
+def test_rechnung_mit_textlayer(main, tmp_path):
+    with main.PdfAnalyse(text_pdf(tmp_path / "r.pdf", rechnungszeilen(4731))) as analyse:
+        df, konfidenz = main.extrahiere_positionen_lokal(analyse)
+        assert analyse.tabellenlayout["seite"] == 0
+    assert len(df) == 8 and konfidenz >= main.LOKAL_MIN_KONFIDENZ
+    erste = df.iloc[0]
+    menge, preis = 1 + 4731 % 7, 3.5 + 4731 % 11
+    assert erste["Artikelbezeichnung"].startswith("Artikel 4731-1 Schotter")
+    assert (erste["Menge"], erste["Einheit"], erste["Einzelpreis"]) == (menge, "t", preis)
+    assert erste["Gesamtpreis"] == pytest.approx(menge * preis)
+    assert set(df["Dateiname"]) == {"r.pdf"}
+
+
+def test_folgeseite_und_fortsetzungszeile(main, tmp_path):
+    seite1 = ["Baustoffe Nord GmbH", "Rechnung Nr. 4731", "", KOPF,
+              zeile(1, "Schotter 0/32", 10, "18,50", "185,00"),
+              "     gewaschen",
+              zeile(2, "Sand 0/2", 4, "12,00", "48,00"),
+              "Übertrag: 233,00"]
+    seite2 = [zeile(3, "Anfahrt", 1, "43,94", "43,94"), "", "Nettobetrag: 276,94 EUR", "Zahlbar sofort."]
+    with main.PdfAnalyse(seiten_pdf(tmp_path / "zwei.pdf", [seite1, seite2])) as analyse:
+        df, konfidenz = main.extrahiere_positionen_lokal(analyse)
+    assert list(df["Artikelbezeichnung"]) == ["Schotter 0/32 gewaschen", "Sand 0/2", "Anfahrt"]
+    assert list(df["Gesamtpreis"]) == [185.0, 48.0, 43.94]
+    assert konfidenz == 1.0  # alle Zeilen stimmig + Summe passt zur Nettozeile
+
+
+def test_ohne_kopfzeile_keine_positionen(main, tmp_path):
+    zeilen = ["Baustoffe Nord GmbH", "Rechnung Nr. 4731", zeile(1, "Schotter", 10, "18,50", "185,00")]
+    with main.PdfAnalyse(seiten_pdf(tmp_path / "ohne.pdf", [zeilen])) as analyse:
+        assert main.extrahiere_positionen_lokal(analyse) == (None, 0.0)
+
+
+def test_scan_ohne_textlayer(main, tmp_path):
+    with main.PdfAnalyse(scan_pdf(tmp_path / "scan.pdf", rechnungszeilen(4731))) as analyse:
+        assert main.extrahiere_positionen_lokal(analyse) == (None, 0.0)
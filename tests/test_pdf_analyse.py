@@ -0,0 +1,65 @@
+"""📄 PdfAnalyse: einmal öffnen für alle Stufen, Textlayer-Urteil pro Seite und Mischdokumente (Seiten ohne Text gehen an GPT-OCR)."""
+
+from pdf_bauen import misch_pdf, scan_pdf, rechnungszeilen, text_pdf
+
+
+def test_gescannte_erste_seiten_vor_textlayer(main, tmp_path):
+    # Regression: zwei Scan-Seiten vorneweg machten das ganze Dokument zum reinen Scan (nur Seite 1 per OCR)
+    pfad = misch_pdf(tmp_path / "misch.pdf", ["scan", "scan", "text"])
+    with main.PdfAnalyse(pfad) as analyse:
+        assert main.pdf_hat_nutzbaren_text(analyse)
+        assert analyse.ocr_kandidaten(main.OCR_MAX_ZUSATZSEITEN) == [0, 1]
+
+
+def test_reiner_scan_ohne_textlayer(main, tmp_path):
+    with main.PdfAnalyse(scan_pdf(tmp_path / "scan.pdf", rechnungszeilen(4731))) as analyse:
+        assert not main.pdf_hat_nutzbaren_text(analyse)
+        assert not analyse._seitenscores  # Seiten ohne Schrift werden gar nicht erst bewertet
+
+
+def test_seiten_ohne_bild_sind_ocr_kandidaten(main, tmp_path):
+    pfad = misch_pdf(tmp_path / "misch.pdf", ["text", "vektor", "leer", "scan"])
+    with main.PdfAnalyse(pfad) as analyse:
+        assert analyse.ocr_kandidaten(main.OCR_MAX_ZUSATZSEITEN) == [1, 3]
+
+
+def test_ocr_kandidaten_bis_zur_grenze(main, tmp_path):
+    pfad = misch_pdf(tmp_path / "misch.pdf", ["text", "scan", "text", "scan", "scan", "scan", "scan"])
+    with main.PdfAnalyse(pfad) as analyse:
+        assert analyse.ocr_kandidaten(2) == [1, 3]
+        assert max(analyse._seitenscores) == 3  # die Seiten danach werden nicht bewertet
+
+
+def test_reine_textdatei_ohne_ocr(main, tmp_path):
+    with main.PdfAnalyse(misch_pdf(tmp_path / "text.pdf", ["text"] * 4)) as analyse:
+        assert main.rendere_schlechte_seiten(analyse) == {}
+
+
+def test_seiten_ueber_der_grenze_werden_gemeldet(main, arbeitsordner):
+    anzahl = main.OCR_MAX_ZUSATZSEITEN + 2
+    misch_pdf(main.input_folder / "misch.pdf", ["text"] + ["scan"] * anzahl)
+    dok = main.Dokument(1, main.input_folder / "misch.pdf")
+    main.bereite_dokument_vor(dok, 1, main.lade_bekannte_dateien())
+    dok.analyse.schliessen()
+    assert list(dok.seitenbilder) == list(range(1, main.OCR_MAX_ZUSATZSEITEN + 1))
+    assert "seiten_ausgelassen" in dok.zaehler
+    assert any("misch.pdf" in fehler and f"{anzahl}, {anzahl + 1}" in fehler for fehler in main.VERARBEITUNGSFEHLER)
+
+
+def test_vorbereitung_oeffnet_die_datei_einmal(main, arbeitsordner, monkeypatch):
+    geoeffnet = []
+    original = main.fitz.open
+    monkeypatch.setattr(main.fitz, "open", lambda *args, **kwargs: geoeffnet.append(kwargs) or original(*args, **kwargs))
+    dok = main.Dokument(1, text_pdf(main.input_folder / "rechnung.pdf", rechnungszeilen(4731)))
+    main.bereite_dokument_vor(dok, 1, main.lade_bekannte_dateien())
+    assert dok.lokal_df is not None and "4731" in dok.text
+    assert len(geoeffnet) == 1 and geoeffnet[0]["filetype"] == "pdf"  # aus dem Speicher, nicht vom Pfad
+    dok.analyse.schliessen()
+
+
+def test_verschieben_waehrend_der_analyse(main, tmp_path):
+    pfad = text_pdf(tmp_path / "rechnung.pdf", rechnungszeilen(4731))
+    with main.PdfAnalyse(pfad) as analyse:
+        assert analyse.seitenanzahl == 1
+        pfad.rename(tmp_path / "archiv.pdf")  # kein offenes Datei-Handle
+        assert "Rechnung Nr. 4731" in analyse.text
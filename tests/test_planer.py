@@ -0,0 +1,168 @@
+"""🚦 AnfragePlaner: Token-Buckets und adaptive Parallelität (AIMD) – ohne Netzwerk, `_versuch` ist ersetzt."""
+
+import asyncio
+import time
+from collections import deque
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+
+def rate_limit(main, code=None):
+    # Minimal-Antwort statt eines echten Response-Objekts – je nach openai-Version steckt httpx oder httpx2 dahinter
+    antwort = SimpleNamespace(status_code=429, headers={}, request=None)
+    return main.RateLimitError("Rate limit", response=antwort, body={"code": code} if code else None)
+
+
+@pytest.fixture
+def planer(main, monkeypatch):
+    monkeypatch.setattr(main, "GPT_BACKOFF_BASIS", 0.0)  # Backoff ohne Wartezeit
+    monkeypatch.setattr(main, "GPT_PARALLEL_MIN", 1)
+    monkeypatch.setattr(main, "GPT_PARALLEL_MAX", 24)
+    antworten = []  # Ausnahmen oder None (= Erfolg), in Aufrufreihenfolge
+
+    async def versuch(kwargs, stream_leser):
+        ergebnis = antworten.pop(0) if antworten else None
+        if isinstance(ergebnis, Exception):
+            raise ergebnis
+        return SimpleNamespace(headers={}), SimpleNamespace(usage=None)
+
+    monkeypatch.setattr(main.AnfragePlaner, "_versuch", staticmethod(versuch))
+    return antworten
+
+
+def test_eimer_wartet_bis_nachgefuellt(main):
+    async def ablauf():
+        eimer = main.TokenEimer(600)  # 10 pro Sekunde
+        await eimer.entnehmen(600)
+        start = time.monotonic()
+        await eimer.entnehmen(1)
+        return time.monotonic() - start
+    assert 0.05 <= asyncio.run(ablauf()) < 1.0
+
+
+def test_eimer_begrenzt_uebergrosse_anfrage(main):
+    async def ablauf():
+        eimer = main.TokenEimer(100)
+        await asyncio.wait_for(eimer.entnehmen(5000), 1.0)  # größer als das Limit: einmal volle Kapazität
+        return eimer.bestand
+    assert asyncio.run(ablauf()) < 1
+
+
+def test_eimer_folgt_den_headern(main):
+    eimer = main.TokenEimer(30000)
+    eimer.abgleichen(limit=10000, verbleibend=2500)
+    assert eimer.kapazitaet == 10000 and eimer.bestand <= 2500
+    eimer.zurueckbuchen(10 ** 6)
+    assert eimer.bestand == eimer.kapazitaet
+
+
+def test_aimd_erhoeht_nach_fehlerfreier_runde(main, planer):
+    async def ablauf():
+        p = main.AnfragePlaner(4)
+        for _ in range(4):
+            await p.ausfuehren("klassifikation", {}, 10)
+        return p.limit
+    assert asyncio.run(ablauf()) == 5
+
+
+def test_aimd_halbiert_bei_429_und_wiederholt(main, planer):
+    planer.append(rate_limit(main))
+
+    async def ablauf():
+        p = main.AnfragePlaner(8)
+        await p.ausfuehren("klassifikation", {}, 10)
+        return p
+    p = asyncio.run(ablauf())
+    assert p.limit == 4
+    assert p.statistik["429"] == 1 and p.statistik["wiederholungen"] == 1 and p.statistik["anfragen"] == 1
+
+
+def test_aimd_unterschreitet_minimum_nicht(main, planer, monkeypatch):
+    monkeypatch.setattr(main, "GPT_MAX_VERSUCHE", 3)
+    planer.extend([rate_limit(main)] * 3)
+
+    async def ablauf():
+        p = main.AnfragePlaner(2)
+        with pytest.raises(main.RateLimitError):
+            await p.ausfuehren("klassifikation", {}, 10)
+        return p.limit
+    assert asyncio.run(ablauf()) == main.GPT_PARALLEL_MIN
+
+
+def test_aufgebrauchtes_kontingent_wird_nicht_wiederholt(main, planer):
+    planer.append(rate_limit(main, code="insufficient_quota"))
+
+    async def ablauf():
+        p = main.AnfragePlaner(4)
+        with pytest.raises(main.RateLimitError):
+            await p.ausfuehren("klassifikation", {}, 10)
+        return p
+    p = asyncio.run(ablauf())
+    assert p.statistik["wiederholungen"] == 0 and not planer
+
+
+def test_pipeline_nutzt_erhoehte_parallelitaet(main, planer, monkeypatch):
+    # Die Pipeline muss mehr Konsumenten haben als der Startwert, sonst bleibt AIMD-Zuwachs wirkungslos
+    monkeypatch.setattr(main, "GPT_PARALLEL", 2)
+    unterwegs, hoechstens = 0, 0
+
+    async def versuch(kwargs, stream_leser):
+        nonlocal unterwegs, hoechstens
+        unterwegs += 1
+        hoechstens = max(hoechstens, unterwegs)
+        await asyncio.sleep(0.005)
+        unterwegs -= 1
+        return SimpleNamespace(headers={}), SimpleNamespace(usage=None)
+
+    monkeypatch.setattr(main.AnfragePlaner, "_versuch", staticmethod(versuch))
+    monkeypatch.setattr(main, "bereite_dokument_vor", lambda dok, anzahl, verarbeitete: None)
+    monkeypatch.setattr(main, "schliesse_dokument_ab", lambda dok: None)
+
+    async def ablauf():
+        p = main.AnfragePlaner(main.GPT_PARALLEL)
+
+        async def gpt_stufe(dok):
+            await p.ausfuehren("klassifikation", {}, 10)
+
+        monkeypatch.setattr(main, "gpt_stufe", gpt_stufe)
+        dateien = [Path(f"r{i}.pdf") for i in range(80)]
+        await main.verarbeite_dateien(dateien, len(dateien), None)
+        return p.limit
+
+    limit = asyncio.run(ablauf())
+    assert limit > main.GPT_PARALLEL
+    assert hoechstens > main.GPT_PARALLEL
+
+
+def test_timeout_ohne_deadline_eintrag(main, planer):
+    # Regression: die Meldung griff mit GPT_DEADLINES[aufgabe] zu und scheiterte an Aufgaben ohne Eintrag
+    planer.append(asyncio.TimeoutError())
+
+    async def ablauf():
+        p = main.AnfragePlaner(4)
+        await p.ausfuehren("pruefung", {}, 10)
+        return p
+    p = asyncio.run(ablauf())
+    assert p.statistik["wiederholungen"] == 1 and p.stufen[("pruefung", "timeouts")] == 1
+
+
+@pytest.mark.parametrize("hedge_schwelle", [1.0, 0.01])  # Abbruch vor bzw. nach dem Start der Zweitanfrage
+def test_abgebrochener_hedge_hinterlaesst_keine_versuche(main, planer, monkeypatch, hedge_schwelle):
+    async def versuch(kwargs, stream_leser):
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(main.AnfragePlaner, "_versuch", staticmethod(versuch))
+
+    async def ablauf():
+        p = main.AnfragePlaner(4)
+        p.latenzen["klassifikation"] = deque([hedge_schwelle] * main.GPT_HEDGE_MIN_PROBEN)
+        p.stufen[("klassifikation", "anfragen")] = 100
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(p.ausfuehren_abgesichert("klassifikation", {}, 10), 0.1)
+        await asyncio.sleep(0.01)
+        return p, asyncio.all_tasks() - {asyncio.current_task()}
+    p, uebrig = asyncio.run(ablauf())
+    assert not uebrig and p.aktiv == 0
+    assert p.stufen[("klassifikation", "hedges")] == (1 if hedge_schwelle < 0.1 else 0)
@@ -0,0 +1,53 @@
+"""📋 Protokoll verarbeiteter Dateien: Übernahme aus Excel, gruppenweise Commits, Excel-Export."""
+
+import sqlite3
+
+import pandas as pd
+
+
+def zeilen_auf_platte(main):
+    # Eigene Verbindung sieht nur, was committet ist
+    with sqlite3.connect(main.PROTOKOLL.pfad) as db:
+        return db.execute("SELECT COUNT(*) FROM verarbeitet").fetchone()[0]
+
+
+def test_uebernahme_aus_excel(main, arbeitsordner, capsys):
+    pd.DataFrame({"Dateiname": ["1.pdf", "2.pdf", 3], "Verarbeitet am": ["2025-04-16 08:00", None, "2025-04-17 09:30"],
+                  "Inhalts_Hash": ["abc", None, None]}).to_excel(main.protokoll_excel, index=False)
+    assert main.PROTOKOLL.dateinamen() == ["1.pdf", "2.pdf", "3"]
+    assert "3 Einträge aus verarbeitete_dateien.xlsx" in capsys.readouterr().out
+    assert main.PROTOKOLL.datei_mit_hash("abc") == "1.pdf"
+    assert (main.PROTOKOLL.name_bekannt("1.pdf"), main.PROTOKOLL.name_bekannt("2.pdf")) == (True, False)
+    assert main.PROTOKOLL.name_bekannt("4.pdf") is None
+
+    # Nur beim ersten Öffnen – danach ist das Excel nur noch Ansicht
+    pd.DataFrame({"Dateiname": ["neu.pdf"]}).to_excel(main.protokoll_excel, index=False)
+    wieder = main.Protokoll(main.PROTOKOLL.pfad)
+    assert wieder.dateinamen() == ["1.pdf", "2.pdf", "3"]
+
+
+def test_altes_excel_ohne_hash_spalte(main, arbeitsordner):
+    pd.DataFrame({"Dateiname": ["alt.pdf"]}).to_excel(main.protokoll_excel, index=False)
+    assert main.PROTOKOLL.name_bekannt("alt.pdf") is False
+
+
+def test_gruppenweise_commits(main, arbeitsordner, monkeypatch):
+    monkeypatch.setattr(main, "PROTOKOLL_GRUPPE", 3)
+    protokoll = main.PROTOKOLL
+    for nummer in range(4):
+        protokoll.anhaengen(f"{nummer}.pdf", f"hash{nummer}")
+        assert zeilen_auf_platte(main) == (3 if nummer >= 2 else 0)
+    assert protokoll.offen == 1 and protokoll.datei_mit_hash("hash3") == "3.pdf"  # im Lauf sichtbar
+    protokoll.festschreiben()
+    assert zeilen_auf_platte(main) == 4 and protokoll.offen == 0
+
+
+def test_export_in_gewohnter_form(main, arbeitsordner):
+    main.PROTOKOLL.anhaengen("1.pdf", "abc")
+    main.PROTOKOLL.anhaengen("2.pdf")
+    main.PROTOKOLL.exportieren(main.protokoll_excel)
+    df = pd.read_excel(main.protokoll_excel)
+    assert list(df.columns) == ["Dateiname", "Verarbeitet am", "Inhalts_Hash"]
+    assert list(df["Dateiname"]) == ["1.pdf", "2.pdf"] and df["Inhalts_Hash"].iloc[0] == "abc"
+    assert zeilen_auf_platte(main) == 2
+    assert not list(arbeitsordner.glob("~*"))
@@ -0,0 +1,94 @@
+"""🔑 Rechnungs-Index: Schlüssel aus Lieferant + Nummer + Betrag, Nachtragen der Gesamtausgaben, Abgleich im Lauf."""
+
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def ausgaben(main, arbeitsordner, monkeypatch):
+    ordner = arbeitsordner / "ausgaben"
+    ordner.mkdir()
+    monkeypatch.setattr(main, "output_excel", ordner / "artikelpositionen_ki.xlsx")
+    monkeypatch.setattr(main, "RECHNUNGS_DUPLIKATE", [])
+    return ordner
+
+
+def gesamtausgabe(ordner, name, zeilen):
+    df = pd.DataFrame(zeilen, columns=["Lieferant", "Rechnungsnummer", "Gesamtbetrag", "Dateiname", "Artikel"])
+    pfad = ordner / f"artikelpositionen_ki_GESAMT_{name}.xlsx"
+    df.to_excel(pfad, index=False)
+    return pfad
+
+
+def test_schluessel_gleicht_schreibweisen_an(main):
+    a = main.rechnungs_schluessel("Baustoffe Nord GmbH & Co. KG", "RE-0815", "1.234,50")
+    assert a == main.rechnungs_schluessel("BAUSTOFFE NORD", "re 0815", 1234.5)
+    assert main.rechnungs_schluessel("Baustoffe Nord", "0815", 10) == main.rechnungs_schluessel("Baustoffe Nord", "815", 10)
+    assert a != main.rechnungs_schluessel("Baustoffe Nord GmbH", "RE-0815", "1.234,51")
+    assert a != main.rechnungs_schluessel("Baustoffe Süd GmbH", "RE-0815", "1.234,50")
+
+
+@pytest.mark.parametrize("lieferant, nummer, betrag", [
+    (None, "4711", 10.0), ("Baustoffe Nord", "", 10.0), ("Baustoffe Nord", "4711", float("nan")),
+    ("GmbH & Co. KG", "4711", 10.0),
+])
+def test_unvollstaendiger_schluessel(main, lieferant, nummer, betrag):
+    assert main.rechnungs_schluessel(lieferant, nummer, betrag) is None
+
+
+def test_nachtragen_liest_jede_ausgabe_nur_einmal(main, ausgaben):
+    gesamtausgabe(ausgaben, "1", [("Baustoffe Nord GmbH", "0815", 119.0, "a.pdf", "Schotter"),
+                                  ("Baustoffe Nord GmbH", "0815", 119.0, "a.pdf", "Sand")])
+    index = main.RechnungsIndex(main.RECHNUNGS_INDEX)
+    index.nachtragen(ausgaben)
+    # Rechnungsnummer als Text gelesen – als Zahl käme "815.0" an und der Schlüssel passte nicht
+    assert index.suchen(main.rechnungs_schluessel("Baustoffe Nord", "815", "119,00")) == "a.pdf"
+    assert len(index.schluessel) == 1
+    index.speichern()
+
+    geladen = main.RechnungsIndex(main.RECHNUNGS_INDEX)
+    gelesen = []
+    geladen.ausgabe_erfassen = lambda pfad, df: gelesen.append(Path(pfad).name) or 0
+    gesamtausgabe(ausgaben, "2", [("Tiefbau Süd AG", "77", 50.0, "b.pdf", "Kies")])
+    geladen.nachtragen(ausgaben)
+    assert gelesen == ["artikelpositionen_ki_GESAMT_2.xlsx"]
+
+
+def test_anderes_format_wird_neu_aufgebaut(main, ausgaben):
+    main.RECHNUNGS_INDEX.write_text('{"format": 0, "schluessel": {"x": "alt.pdf"}, "ausgaben": {}}', encoding="utf-8")
+    assert main.RechnungsIndex(main.RECHNUNGS_INDEX).schluessel == {}
+
+
+def test_gleiche_rechnung_im_lauf_wird_aussortiert(main, ausgaben):
+    def dokument(index, name, lieferant):
+        dok = main.Dokument(index, main.input_folder / name)
+        dok.df = pd.DataFrame([{"Lieferant": lieferant, "Rechnungsnummer": "4731", "Gesamtbetrag": 99.5}])
+        dok.beenden(main.archiv_folder, name)
+        return dok
+
+    erste, zweite = dokument(1, "mail.pdf", "Baustoffe Nord GmbH"), dokument(2, "scan.pdf", "Baustoffe Nord")
+    main.pruefe_rechnungsschluessel(erste)
+    main.pruefe_rechnungsschluessel(zweite)
+    assert erste.ziel[0] == main.archiv_folder
+    assert zweite.ziel[0] == main.bereits_verarbeitet_ordner
+    assert main.RECHNUNGS_DUPLIKATE == [("scan.pdf", "mail.pdf")]
+    assert main.DUPLIKAT_STATISTIK["rechnung"] == 1
+
+
+def test_index_wird_im_lauf_gesichert(main, ausgaben, monkeypatch):
+    for name in ("anzahl_eingang", "anzahl_text"):
+        monkeypatch.setattr(main, name, 0)
+    monkeypatch.setattr(main, "alle_dfs", [])
+    monkeypatch.setattr(main, "archiv_folder", ausgaben.parent / "archiv")
+    for nummer in (main.FLUSH_INTERVAL - 1, main.FLUSH_INTERVAL):
+        pfad = main.input_folder / f"r{nummer}.pdf"
+        pfad.write_bytes(b"%PDF-1.4")
+        dok = main.Dokument(nummer, pfad)
+        dok.df = pd.DataFrame([{"Lieferant": "Baustoffe Nord GmbH", "Rechnungsnummer": str(nummer), "Gesamtbetrag": 99.5}])
+        dok.beenden(main.archiv_folder, dok.dateiname)
+        main.schliesse_dokument_ab(dok)
+        gespeichert = main.RechnungsIndex(main.RECHNUNGS_INDEX).schluessel
+        assert len(gespeichert) == (0 if nummer < main.FLUSH_INTERVAL else 2)
+    assert not main.RECHNUNGS_INDEX.with_suffix(".tmp").exists()
@@ -0,0 +1,59 @@
+"""🏷️ Regelbasierte Vorklassifikation: Punkte je Typ und wann lokal entschieden wird."""
+
+import pytest
+
+
+def briefkopf(*zeilen):
+    return "\n".join(["Baustoffe Nord GmbH", "Hafenstraße 12, 20457 Hamburg", "", "Wilhelm Wähler GmbH & Co. KG",
+                      "Beckersbergstraße 22", "24558 Henstedt-Ulzburg", "", *zeilen])
+
+
+def test_eindeutige_rechnung(main):
+    typ, _ = main.klassifiziere_regelbasiert(briefkopf(
+        "Rechnung Nr. 2025-4711", "Rechnungsdatum: 19.04.2025", "Kundennummer: 10815",
+        "Pos Artikel Menge Einzelpreis Gesamtpreis", "Gesamtbetrag: 1.190,00 EUR", "Zahlbar innerhalb von 14 Tagen"))
+    assert typ == "rechnung"
+
+
+@pytest.mark.parametrize("zeilen", [
+    ("Zahlungserinnerung", "Sehr geehrte Damen und Herren,",
+     "zu unserer Rechnung Nr. 2025-4711 vom 19.04.2025 (Rechnungsnummer 2025-4711) konnten wir noch keinen",
+     "Zahlungseingang feststellen. Rechnungsbetrag: 1.190,00 EUR"),
+    ("Erinnerung", "Rechnungsnummer: 2025-4711", "Rechnungsdatum: 19.04.2025", "Offener Betrag: 1.190,00 EUR"),
+])
+def test_zahlungserinnerung_mit_rechnungsnummer_ist_keine_rechnung(main, zeilen):
+    typ, punkte = main.klassifiziere_regelbasiert(briefkopf(*zeilen))
+    assert typ != "rechnung", punkte
+    assert punkte["zahlungserinnerung"] >= main.REGEL_MIN_PUNKTE
+
+
+@pytest.mark.parametrize("zeilen", [
+    ("Gutschrift Nr. G-0815", "zur Rechnung Nr. 2025-4711 vom 19.04.2025", "Rechnungsnummer 2025-4711",
+     "Gutschriftsbetrag: 119,00 EUR"),
+    ("Rechnungskorrektur", "Rechnungsnummer: 2025-4711", "Gesamtbetrag: -119,00 EUR"),
+])
+def test_gutschrift_mit_rechnungsnummer_ist_keine_rechnung(main, zeilen):
+    typ, punkte = main.klassifiziere_regelbasiert(briefkopf(*zeilen))
+    assert typ != "rechnung", punkte
+
+
+def test_mahnung_mit_rechnungsnummer_ist_keine_rechnung(main):
+    typ, _ = main.klassifiziere_regelbasiert(briefkopf(
+        "2. Mahnung", "Rechnung Nr. 2025-4711 vom 19.04.2025", "Rechnungsnummer 2025-4711", "Mahngebühr: 5,00 EUR"))
+    assert typ in ("mahnung", None)
+
+
+def test_eindeutige_mahnung(main):
+    typ, _ = main.klassifiziere_regelbasiert(briefkopf("Mahnung", "Bitte begleichen Sie den offenen Betrag."))
+    assert typ == "mahnung"
+
+
+def test_gesperrte_ueberschrift(main):
+    typ, _ = main.klassifiziere_regelbasiert(briefkopf("G E B Ü H R E N B E S C H E I D", "Aktenzeichen 12-345",
+                                                       "Rechtsbehelfsbelehrung"))
+    assert typ == "behördlich"
+
+
+def test_unklarer_text_geht_an_gpt(main):
+    typ, _ = main.klassifiziere_regelbasiert(briefkopf("Sehr geehrte Damen und Herren,", "anbei die Unterlagen."))
+    assert typ is None
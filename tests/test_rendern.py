@@ -0,0 +1,61 @@
+"""🖼️ Seitenbilder im Prozess (PyMuPDF): Formate, Farbraum, Cache je Einstellung und Rückfall auf pdf2image."""
+
+import base64
+
+import pymupdf
+import pytest
+
+from pdf_bauen import rechnungszeilen, scan_pdf
+
+KENNUNG = {"png": b"\x89PNG", "jpeg": b"\xff\xd8\xff", "webp": b"RIFF"}
+
+
+@pytest.fixture
+def analyse(main, tmp_path):
+    analyse = main.PdfAnalyse(scan_pdf(tmp_path / "scan.pdf", rechnungszeilen(4731)))
+    yield analyse
+    analyse.schliessen()
+
+
+@pytest.mark.parametrize("format", ["png", "jpeg", "webp"])
+def test_formate(main, analyse, format):
+    if format == "webp":
+        pytest.importorskip("PIL", reason="WebP kodiert PyMuPDF über Pillow")
+    daten = base64.b64decode(main.rendere_seite_base64(analyse, dpi=72, format=format))
+    assert daten.startswith(KENNUNG[format])
+    if format != "webp":
+        bild = pymupdf.Pixmap(daten)
+        assert (bild.width, bild.height) == (595, 842)  # A4 bei 72 dpi
+    assert main.bild_data_url("abc", format).startswith(f"data:image/{format};base64,")
+
+
+def test_graustufen(main, analyse):
+    bild = pymupdf.Pixmap(base64.b64decode(main.rendere_seite_base64(analyse, dpi=36, farbraum="grau")))
+    assert bild.n == 1 and bild.width == 298
+
+
+def test_cache_je_einstellung(main, analyse, monkeypatch):
+    aufrufe = []
+    original = main.rendere_seite_fitz
+
+    def zaehlen(*args):
+        aufrufe.append(args[1:])
+        return original(*args)
+
+    monkeypatch.setattr(main, "rendere_seite_fitz", zaehlen)
+    erstes = main.rendere_seite_base64(analyse, dpi=36)
+    assert main.rendere_seite_base64(analyse, dpi=36) is erstes
+    main.rendere_seite_base64(analyse, dpi=36, format="jpeg")
+    assert len(aufrufe) == 2
+
+
+def test_rueckfall_auf_pdf2image(main, analyse, monkeypatch):
+    def kaputt(*args):
+        raise RuntimeError("MuPDF kaputt")
+
+    monkeypatch.setattr(main, "rendere_seite_fitz", kaputt)
+    monkeypatch.setattr(main, "rendere_seite_pdf2image", lambda analyse, seite, dpi, farbraum, format: b"\x89PNG ersatz")
+    assert base64.b64decode(main.rendere_seite_base64(analyse, dpi=36)) == b"\x89PNG ersatz"
+    monkeypatch.setattr(main, "rendere_seite_pdf2image", kaputt)
+    with pytest.raises(RuntimeError):
+        main.rendere_seite_base64(analyse, dpi=50)
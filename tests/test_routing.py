@@ -0,0 +1,63 @@
+"""🪜 Modell-Routing: günstige Stufe zuerst, Eskalation nur wenn die Antwort die Prüfung der Aufgabe nicht besteht."""
+
+import asyncio
+from collections import Counter
+
+import pytest
+
+
+@pytest.fixture
+def antworten(main, monkeypatch):
+    """Antwort je Stufe vorgeben; gesendete (Stufe, Modell) werden mitgeschrieben."""
+    vorgaben, gesendet = {}, []
+
+    async def einzelanfrage(aufgabe, stufe, kwargs, bei_zeile=None):
+        gesendet.append((stufe, kwargs["model"]))
+        return vorgaben[stufe]
+
+    monkeypatch.setattr(main, "_gpt_einzelanfrage", einzelanfrage)
+    monkeypatch.setattr(main, "ROUTING_STATISTIK", Counter())
+    return vorgaben, gesendet
+
+
+def anfrage(main, aufgabe, **parameter):
+    return asyncio.run(main.gpt_anfrage(aufgabe, [{"role": "user", "content": "…"}], **parameter))
+
+
+def test_gueltige_antwort_bleibt_auf_kleiner_stufe(main, antworten):
+    vorgaben, gesendet = antworten
+    vorgaben.update(klein="**Rechnung.**", gross="rechnung")
+    assert anfrage(main, "klassifikation") == "**Rechnung.**"
+    assert gesendet == [("klein", main.GPT_MODELLE["klein"])]
+    assert main.ROUTING_STATISTIK == Counter({("klein", "antworten"): 1, ("klein", "gueltig"): 1})
+
+
+@pytest.mark.parametrize("aufgabe, ungueltig, gueltig", [
+    ("klassifikation", "Das ist vermutlich eine Gutschrift", "gutschrift"),
+    ("zahl", "ca. 3 Seiten", "3"),
+    ("kategorie", "Schotter: Baustoff", "Schotter;Baustoff;Tiefbau"),
+])
+def test_fehlgeschlagene_pruefung_eskaliert(main, antworten, aufgabe, ungueltig, gueltig):
+    vorgaben, gesendet = antworten
+    vorgaben.update(klein=ungueltig, gross=gueltig)
+    assert not main.ANTWORT_PRUEFUNGEN[aufgabe](ungueltig)
+    assert anfrage(main, aufgabe) == gueltig
+    assert gesendet == [("klein", main.GPT_MODELLE["klein"]), ("gross", main.GPT_MODELLE["gross"])]
+    assert main.ROUTING_STATISTIK[("klein", "eskaliert")] == 1
+    assert main.ROUTING_STATISTIK[("gross", "gueltig")] == 1
+
+
+def test_letzte_stufe_antwortet_auch_ungueltig(main, antworten):
+    vorgaben, gesendet = antworten
+    vorgaben.update(klein="keine Ahnung", gross="weiß nicht")
+    assert anfrage(main, "zahl") == "weiß nicht"
+    assert len(gesendet) == 2
+    assert main.ROUTING_STATISTIK[("klein", "eskaliert")] == 1
+    assert main.ROUTING_STATISTIK[("gross", "eskaliert")] == 0 and main.ROUTING_STATISTIK[("gross", "gueltig")] == 0
+
+
+def test_festes_modell_wird_nicht_geroutet(main, antworten):
+    vorgaben, gesendet = antworten
+    vorgaben["fest"] = "keine Zahl"
+    assert anfrage(main, "zahl", model="gpt-4.1") == "keine Zahl"
+    assert gesendet == [("fest", "gpt-4.1")]
@@ -0,0 +1,36 @@
+"""📊 Abschlussstatistik: jede Eingangsdatei zählt, auch wenn sie schon in der Vorbereitung aussortiert wird."""
+
+import pytest
+
+from pdf_bauen import rechnungszeilen, text_pdf
+
+
+@pytest.fixture
+def zaehler(main, monkeypatch):
+    for name in ("anzahl_eingang", "anzahl_text", "anzahl_ocr", "anzahl_lokal", "anzahl_xml",
+                 "probleme", "nicht_rechnungen"):
+        monkeypatch.setattr(main, name, 0)
+    monkeypatch.setattr(main, "alle_dfs", [])
+    return main
+
+
+def test_frueh_aussortierte_dateien_zaehlen_mit(zaehler, arbeitsordner):
+    main = zaehler
+    eingang = main.input_folder
+    (eingang / "kaputt.xml").write_text("<Invoice><nicht geschlossen", encoding="utf-8")
+    text_pdf(eingang / "bekannt.pdf", rechnungszeilen(4731))
+    main.speichere_verarbeitete_datei("bekannt.pdf", main.inhalts_hash(eingang / "bekannt.pdf"))
+
+    dateien = sorted(main.finde_eingangsdateien())
+    verarbeitete = main.lade_bekannte_dateien()
+    for index, pfad in enumerate(dateien, 1):
+        dok = main.Dokument(index, pfad)
+        main.bereite_dokument_vor(dok, len(dateien), verarbeitete)
+        assert dok.fertig, dok.protokoll
+        if dok.analyse:
+            dok.analyse.schliessen()
+        main.schliesse_dokument_ab(dok)
+
+    assert main.anzahl_text + main.anzahl_ocr + main.anzahl_xml == 0
+    assert main.anzahl_eingang == 2
+    assert main.probleme <= main.anzahl_eingang
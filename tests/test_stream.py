@@ -0,0 +1,94 @@
+"""📡 Streaming: Positionen werden fertig gemeldet, sobald sie vollständig sind; Ablehnungen und
+Nicht-Rechnungen brechen früh ab. Die Chunks erzeugt der Stub-Server (gpt_stub_server.py) wie im Live-Betrieb."""
+
+import asyncio
+import json
+
+import pytest
+from openai.types.chat import ChatCompletionChunk
+
+POSITIONEN = [
+    {"artikelbezeichnung": "Schotter 0/32, gewaschen", "menge": 12.5, "einheit": "t", "einzelpreis": 18.5, "gesamtpreis": 231.25},
+    {"artikelbezeichnung": "Anfahrt {Kipper}", "menge": 1, "einheit": "pausch", "einzelpreis": 43.94, "gesamtpreis": 43.94},
+]
+
+
+class Stream:
+    """Chunks des Stubs als SDK-Objekte; merkt sich, wie viele gelesen wurden und ob geschlossen wurde."""
+
+    def __init__(self, stub, daten):
+        self.chunks = [ChatCompletionChunk.model_validate(stueck) for stueck in stub.stream_stuecke(daten)]
+        self.gelesen = 0
+        self.geschlossen = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            self.gelesen += 1
+            yield chunk
+
+    async def close(self):
+        self.geschlossen = True
+
+
+def lesen(main, stub, aufgabe, daten, json_modus=True):
+    zeilen = []
+    stream = Stream(stub, daten)
+    leser = asyncio.run(main.StreamLeser(aufgabe, json_modus, zeilen.append).lesen(stream))
+    return leser, stream, zeilen
+
+
+def test_leser_ohne_stream_hat_leere_antwort(main):
+    leser = main.StreamLeser("inhalt", True)
+    assert leser.antwort == "" and leser.abbruch is None
+
+
+def test_position_ueber_mehrere_stuecke(main):
+    text = json.dumps({"kopfdaten": {"lieferant": "Baustoffe Nord"}, "positionen": POSITIONEN}, ensure_ascii=False)
+    parser, gemeldet = main.StreamZeilenParser(True), []
+    for stelle, zeichen in enumerate(text):
+        neu = parser.fuettern(zeichen)
+        gemeldet += neu
+        if neu:  # genau mit der schließenden Klammer der Position, nicht früher
+            assert text[:stelle + 1].endswith("}")
+    assert gemeldet == POSITIONEN
+
+
+def test_textmodus_meldet_ganze_zeilen(main):
+    parser = main.StreamZeilenParser(False)
+    assert parser.fuettern("Pos 1 Schot") == []
+    assert parser.fuettern("ter 0/32\n\nPos 2 Sa") == ["Pos 1 Schotter 0/32"]
+    assert parser.fuettern("nd\n") == ["Pos 2 Sand"]
+
+
+def test_stream_meldet_positionen(main, stub):
+    inhalt = json.dumps({"kopfdaten": {}, "positionen": POSITIONEN}, ensure_ascii=False)
+    leser, stream, zeilen = lesen(main, stub, "inhalt", stub.completion({"messages": []}, inhalt))
+    assert zeilen == POSITIONEN
+    assert leser.antwort == inhalt and leser.abbruch is None and not stream.geschlossen
+    assert leser.usage is not None
+
+
+def test_ablehnung_bricht_ab(main, stub):
+    leser, stream, zeilen = lesen(main, stub, "inhalt", stub.ablehnung({"messages": []}))
+    assert leser.abbruch == "ablehnung" and stream.geschlossen
+    assert leser.antwort == "" and zeilen == []
+
+
+def test_fehlertext_bricht_ab(main, stub):
+    daten = stub.completion({"messages": []}, "Es tut mir leid, ich kann dieses Dokument nicht lesen.\n" * 5)
+    leser, stream, _ = lesen(main, stub, "ocr", daten, json_modus=False)
+    assert leser.abbruch == "fehler" and stream.geschlossen and stream.gelesen < len(stream.chunks)
+
+
+def test_nicht_rechnung_wartet_positionen_nicht_ab(main, stub):
+    inhalt = json.dumps({"dokumenttyp": "mahnung", "kopfdaten": {"lieferant": "Stadtwerke"}, "positionen": POSITIONEN * 10})
+    leser, stream, zeilen = lesen(main, stub, "kombi", stub.completion({"messages": []}, inhalt))
+    assert leser.abbruch == "nicht_rechnung" and stream.geschlossen
+    assert stream.gelesen < len(stream.chunks) // 4 and zeilen == []
+    assert json.loads(leser.antwort) == {"dokumenttyp": "mahnung", "kopfdaten": {}, "positionen": []}
+
+
+def test_rechnung_im_kombi_modus_laeuft_durch(main, stub):
+    inhalt = json.dumps({"dokumenttyp": "rechnung", "kopfdaten": {}, "positionen": POSITIONEN})
+    leser, stream, zeilen = lesen(main, stub, "kombi", stub.completion({"messages": []}, inhalt))
+    assert leser.abbruch is None and zeilen == POSITIONEN and leser.antwort == inhalt
@@ -0,0 +1,49 @@
+"""🧱 Strukturierte Ausgabe: JSON der Inhalts-/Kombi-Abfrage → typisierte Spalten, ohne Textheuristik."""
+
+import json
+
+import pytest
+
+
+def antwort(**kopfdaten):
+    return {
+        "kopfdaten": {"lieferant": " Baustoffe Nord GmbH ", "rechnungsempfaenger": "Wilhelm Wähler GmbH",
+                      "ust_idnr": "DE123456789", "rechnungsnummer": "4731", "rechnungsdatum": "19.04.2025",
+                      "gesamtbetrag": 275.19, **kopfdaten},
+        "positionen": [{"artikelbezeichnung": "Schotter 0/32", "menge": 12.5, "einheit": "t",
+                        "einzelpreis": 18.5, "gesamtpreis": 231.25}],
+    }
+
+
+def test_typisierte_spalten(main):
+    df = main.validiere_rechnungsdaten(antwort(), "r.pdf")
+    zeile = df.iloc[0]
+    assert (zeile["Lieferant"], zeile["Menge"], zeile["Gesamtpreis"], zeile["Gesamtbetrag"]) == \
+        ("Baustoffe Nord GmbH", 12.5, 231.25, 275.19)
+    assert str(df["Menge"].dtype) == "float64" and zeile["Dateiname"] == "r.pdf"
+
+
+@pytest.mark.parametrize("wert", [True, None, "12,50", "12.5", [12.5]])
+def test_nur_json_zahlen_gelten(main, wert):
+    daten = antwort(gesamtbetrag=wert)
+    daten["positionen"][0].update(menge=wert, einzelpreis=wert)
+    zeile = main.validiere_rechnungsdaten(daten, "r.pdf").iloc[0]
+    assert zeile["Gesamtbetrag"] is None
+    assert zeile["Menge"] != zeile["Menge"] and zeile["Einzelpreis"] != zeile["Einzelpreis"]  # NaN
+    assert zeile["Gesamtpreis"] == 231.25
+
+
+def test_fehlende_schluessel(main):
+    df = main.validiere_rechnungsdaten({"positionen": [{"menge": 2}, "kaputt"]}, "r.pdf")
+    assert len(df) == 1
+    zeile = df.iloc[0]
+    assert zeile["Artikelbezeichnung"] == "" and zeile["Menge"] == 2.0 and zeile["Lieferant"] is None
+    assert main.validiere_rechnungsdaten({"kopfdaten": antwort()["kopfdaten"]}, "r.pdf") is None
+    assert main.validiere_rechnungsdaten({"kopfdaten": "kaputt", "positionen": {"menge": 1}}, "r.pdf") is None
+
+
+def test_unlesbare_antworten(main):
+    assert main.lese_strukturierte_antwort("kein JSON", "r.pdf") is None
+    assert main.lese_strukturierte_antwort("[1, 2]", "r.pdf") is None
+    assert main.lese_strukturierte_antwort(None, "r.pdf") is None
+    assert main.lese_kombi_antwort(json.dumps({"dokumenttyp": "quittung", "positionen": []}), "r.pdf") == ("sonstiges", None)
@@ -0,0 +1,62 @@
+"""🧪 Stub-Server über HTTP mit dem echten SDK: synthetische Antworten, Aufzeichnen und Abspielen."""
+
+import threading
+from http.server import ThreadingHTTPServer
+
+import openai
+import pytest
+
+
+@pytest.fixture
+def starten(stub):
+    """Stub-Server im Hintergrund – je Server eine eigene Handler-Klasse, damit mehrere Modi gleichzeitig laufen."""
+    server = []
+
+    def starten(*argv):
+        einstellungen = stub.lies_argumente([*argv, "--latenz", "0"])
+        handler = type("Handler", (stub.StubHandler,), {
+            "einstellungen": einstellungen,
+            "fenster": stub.RateLimitFenster(einstellungen.rpm, einstellungen.tpm),
+            "aufnahmen": stub.lade_aufnahme(einstellungen.aufnahme) if einstellungen.modus == "replay" else {},
+            "aufnahme": stub.Aufnahme(einstellungen.aufnahme) if einstellungen.modus == "record" else None,
+        })
+        server.append(ThreadingHTTPServer(("127.0.0.1", 0), handler))
+        threading.Thread(target=server[-1].serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{server[-1].server_port}/v1"
+
+    yield starten
+    for laufend in server:
+        laufend.shutdown()
+        laufend.server_close()
+
+
+def client(url):
+    return openai.OpenAI(base_url=url, api_key="test", max_retries=0)
+
+
+def anfrage(main, text="Rechnung 4731", **extra):
+    return {**main.anfrage_parameter([{"role": "user", "content": text}], **main.KOMBI_PARAMETER), **extra}
+
+
+def test_synthetische_antwort_passt_zum_schema(main, starten):
+    antwort = client(starten("synth", "--positionen", "3")).chat.completions.create(**anfrage(main))
+    typ, df = main.lese_kombi_antwort(antwort.choices[0].message.content, "r.pdf")
+    assert typ == "rechnung" and len(df) == 3
+    assert antwort.usage.prompt_tokens > 0
+
+
+def test_aufzeichnen_und_abspielen(main, starten, tmp_path):
+    aufnahme = tmp_path / "aufnahme.jsonl"
+    aufzeichnen = client(starten("record", "--ziel", starten("synth"), "--aufnahme", str(aufnahme)))
+    original = aufzeichnen.chat.completions.create(**anfrage(main))
+    gestreamt = "".join(chunk.choices[0].delta.content or "" for chunk in aufzeichnen.chat.completions.create(
+        **anfrage(main, "Rechnung 4732"), stream=True) if chunk.choices)
+    assert len(aufnahme.read_text().splitlines()) == 2
+
+    abspielen = client(starten("replay", "--aufnahme", str(aufnahme)))
+    wieder = abspielen.chat.completions.create(**anfrage(main))
+    assert (wieder.id, wieder.choices[0].message.content) == (original.id, original.choices[0].message.content)
+    assert "".join(chunk.choices[0].delta.content or "" for chunk in abspielen.chat.completions.create(
+        **anfrage(main, "Rechnung 4732"), stream=True) if chunk.choices) == gestreamt
+    with pytest.raises(openai.NotFoundError):
+        abspielen.chat.completions.create(**anfrage(main, "nie aufgezeichnet"))
@@ -0,0 +1,42 @@
+"""✂️ Token-Budget: Auswahl der Textzeilen für GPT und Hinweis auf die Schätzung ohne tiktoken."""
+
+import pytest
+
+from pdf_bauen import rechnungszeilen
+
+
+def test_lange_zeile_sperrt_kuerzere_nicht(main, monkeypatch):
+    monkeypatch.setattr(main, "GPT_TOKEN_BUDGET", {"klassifikation": 100})
+    lang = "Lieferanschrift " + " ".join(f"Baufeld{i}" for i in range(80))
+    text = "\n".join([lang] + rechnungszeilen(4731))
+    auswahl = main.waehle_text(text, "klassifikation")
+    assert lang not in auswahl
+    assert "Rechnung Nr. 4731" in auswahl
+    assert main.zaehle_tokens(auswahl) <= 100 + 10  # Auslassungszeichen kommen zum Budget hinzu
+
+
+def test_kurzer_text_bleibt_unveraendert(main):
+    text = "\n".join(rechnungszeilen(4731, positionen=2))
+    assert main.waehle_text(text, "inhalt") == text
+
+
+def test_ohne_tiktoken_abbruch(main, monkeypatch, capsys):
+    monkeypatch.setattr(main, "tiktoken", None)
+    monkeypatch.setattr(main, "_TOKENIZER", None)
+    monkeypatch.setattr(main, "GPT_TOKEN_SCHAETZUNG", False)
+    with pytest.raises(RuntimeError, match="tiktoken"):
+        main.zaehle_tokens("Rechnung Nr. 4731")
+    with pytest.raises(SystemExit):
+        main.pruefe_tokenizer()
+    assert "GPT_TOKEN_SCHAETZUNG" in capsys.readouterr().out
+
+
+def test_schaetzung_nur_mit_zustimmung(main, monkeypatch, capsys):
+    monkeypatch.setattr(main, "tiktoken", None)
+    monkeypatch.setattr(main, "_TOKENIZER", None)
+    monkeypatch.setattr(main, "GPT_TOKEN_SCHAETZUNG", True)
+    monkeypatch.setattr(main, "VERARBEITUNGSFEHLER", [])
+    assert main.zaehle_tokens("Rechnung Nr. 4731") > 0
+    main.zaehle_tokens("Gesamtbetrag: 12,00 EUR")
+    assert capsys.readouterr().out.count("tiktoken ist nicht installiert") == 1
+    assert main.VERARBEITUNGSFEHLER
@@ -0,0 +1,95 @@
+"""🏷️ Lieferanten-Vorlagen greifen erst nach der Klassifikation als Rechnung."""
+
+import asyncio
+
+import pandas as pd
+import pytest
+
+from pdf_bauen import rechnungszeilen, text_pdf
+
+GUTSCHRIFT = ["Baustoffe Nord GmbH", "Hafenstraße 12, 20457 Hamburg", "USt-IdNr. DE123456789", "",
+              "Wilhelm Wähler GmbH & Co. KG", "", "Gutschrift Nr. G-0815", "zur Rechnung Nr. 4731 vom 19.04.2025",
+              *[f"Position {i}: Rücknahme Paletten, {i} Stück zu je 8,00 EUR" for i in range(1, 12)],
+              "Gutschriftsbetrag: 119,00 EUR"]
+UNKLAR = ["Baustoffe Nord GmbH", "USt-IdNr. DE123456789", "",
+          *[f"Baustelle {i}: Leitungen verlegt, Schacht gesetzt, Oberfläche wiederhergestellt, {i * 3} m" for i in range(1, 16)]]
+
+
+@pytest.fixture
+def gpt(main, monkeypatch):
+    """GPT-Klassifikation mit fester Antwort; Inhaltsabfragen dürfen bei passender Vorlage nicht vorkommen."""
+    aufrufe = []
+
+    def antworten(typ):
+        async def gpt_klassifikation(text=None, image_b64=None):
+            aufrufe.append(text)
+            return typ
+        monkeypatch.setattr(main, "gpt_klassifikation", gpt_klassifikation)
+        return aufrufe
+
+    async def kein_inhalt(*args, **kwargs):
+        raise AssertionError("Vorlage vorhanden – keine Inhaltsabfrage")
+
+    monkeypatch.setattr(main, "gpt_kombi_abfrage", kein_inhalt)
+    monkeypatch.setattr(main, "gpt_abfrage_inhalt", kein_inhalt)
+    return antworten
+
+
+@pytest.fixture
+def mit_vorlage(main, arbeitsordner, monkeypatch):
+    """Vorlage, die auf jedes Dokument passt – wie USt-IdNr-Treffer bei einem bekannten Lieferanten."""
+    positionen = pd.DataFrame({"Artikelbezeichnung": ["Schotter 0/32"], "Menge": [10.0], "Einheit": ["t"],
+                               "Einzelpreis": [18.5], "Gesamtpreis": [185.0], "Lieferant": ["Baustoffe Nord GmbH"],
+                               "Rechnungsnummer": ["4731"], "Gesamtbetrag": [220.15], "Dateiname": ["x.pdf"]})
+    monkeypatch.setattr(main.lieferanten_vorlagen(), "wende_an", lambda analyse: positionen.copy())
+
+    def durchlaufen(name, zeilen):
+        dok = main.Dokument(1, text_pdf(main.input_folder / name, zeilen))
+        main.bereite_dokument_vor(dok, 1, main.lade_bekannte_dateien())
+        if not dok.fertig:
+            asyncio.run(main.gpt_stufe(dok))
+        dok.analyse.schliessen()
+        return dok
+    return durchlaufen
+
+
+def test_rechnung_mit_vorlage_ohne_gpt(main, mit_vorlage):
+    dok = mit_vorlage("rechnung.pdf", rechnungszeilen(4731))
+    assert dok.ziel[0] == main.archiv_folder
+    assert dok.verfahren == "vorlage" and len(dok.df) == 1
+
+
+def test_gutschrift_trotz_vorlage_keine_rechnung(main, mit_vorlage, gpt):
+    # Die Gutschrift zitiert die Rechnungsnummer → Regeln entscheiden nicht, GPT schon
+    aufrufe = gpt("gutschrift")
+    dok = mit_vorlage("gutschrift.pdf", GUTSCHRIFT)
+    assert aufrufe and dok.ziel == (main.nicht_rechnung_folder, "gutschrift_gutschrift.pdf") and dok.df is None
+
+
+def test_unklarer_typ_fragt_gpt_vor_der_vorlage(main, mit_vorlage, gpt):
+    aufrufe = gpt("mahnung")
+    dok = mit_vorlage("unklar.pdf", UNKLAR)
+    assert aufrufe and dok.ziel[0] == main.nicht_rechnung_folder and dok.df is None
+
+
+def test_unklarer_typ_als_rechnung_nutzt_vorlage(main, mit_vorlage, gpt):
+    aufrufe = gpt("rechnung")
+    dok = mit_vorlage("unklar.pdf", UNKLAR)
+    assert aufrufe and dok.ziel[0] == main.archiv_folder and dok.verfahren == "vorlage"
+
+
+def test_gelerntes_wird_gesammelt_gespeichert(main, arbeitsordner):
+    register = main.lieferanten_vorlagen()
+    for nummer in (4731, 4732):
+        with main.PdfAnalyse(text_pdf(arbeitsordner / f"r{nummer}.pdf", rechnungszeilen(nummer))) as analyse:
+            main.extrahiere_positionen_lokal(analyse)  # erkennt das Tabellenlayout, das die Vorlage braucht
+            assert register.lerne(analyse, {"Rechnungsnummer": str(nummer)})
+    assert not main.vorlagen_datei.exists()  # nicht je Dokument schreiben
+
+    main.indizes_speichern()
+    assert not main.vorlagen_datei.with_suffix(".tmp").exists()
+    geladen = main.VorlagenRegister(main.vorlagen_datei)
+    assert [v["bestaetigungen"] for v in geladen.vorlagen.values()] == [2]
+    stand = main.vorlagen_datei.stat().st_mtime_ns
+    main.indizes_speichern()  # ohne Änderung kein erneutes Schreiben
+    assert main.vorlagen_datei.stat().st_mtime_ns == stand
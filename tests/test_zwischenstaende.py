@@ -0,0 +1,42 @@
+"""📦 Batch-Zwischenstände: Parquet bzw. Excel schreiben und verlustfrei wieder einlesen."""
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.fixture
+def positionen():
+    return pd.DataFrame({
+        "Dateiname": ["3.pdf", "3.pdf", "4.pdf"],
+        "Artikelbezeichnung": ["Schotter 0/32", "Anfahrt", "Sand 0/2"],
+        "Menge": [12.5, 1.0, float("nan")],
+        "Einheit": ["t", None, "t"],
+        "Gesamtpreis": [231.25, 43.94, 48.0],
+    })
+
+
+@pytest.mark.parametrize("parquet, endung", [(True, ".parquet"), (False, ".xlsx")])
+def test_hin_und_zurueck(main, tmp_path, monkeypatch, positionen, parquet, endung):
+    monkeypatch.setattr(main, "ZWISCHEN_PARQUET", parquet)
+    pfad = main.schreibe_batchdatei(positionen, tmp_path, "1")
+    assert pfad.name == f"artikelpositionen_ki_batch_1{endung}"
+    pd.testing.assert_frame_equal(main.lese_batchdatei(pfad), positionen, check_dtype=parquet)
+
+
+def test_gemischte_typen_fallen_auf_excel_zurueck(main, tmp_path, positionen, capsys):
+    positionen["Menge"] = [12.5, "pauschal", None]  # Arrow kann die Spalte nicht abbilden
+    pfad = main.schreibe_batchdatei(positionen, tmp_path, "2")
+    assert pfad.suffix == ".xlsx" and "verwende Excel" in capsys.readouterr().out
+    assert [p.name for p in tmp_path.iterdir()] == [pfad.name]  # keine halbe Parquet-Datei
+    assert list(main.lese_batchdatei(pfad)["Menge"].fillna("")) == [12.5, "pauschal", ""]
+
+
+def test_beide_formate_werden_gefunden(main, tmp_path, monkeypatch, positionen):
+    main.schreibe_batchdatei(positionen, tmp_path, "1")
+    monkeypatch.setattr(main, "ZWISCHEN_PARQUET", False)
+    main.schreibe_batchdatei(positionen, tmp_path, "2")
+    (tmp_path / "artikelpositionen_ki_batch_3.csv").write_text("")
+    assert [p.name for p in main.finde_batchdateien(tmp_path)] == \
+        ["artikelpositionen_ki_batch_1.parquet", "artikelpositionen_ki_batch_2.xlsx"]